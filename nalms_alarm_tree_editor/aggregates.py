@@ -0,0 +1,167 @@
+"""
+Totals of the PVs below each group of an alarm tree. Totals are kept per
+group and updated along the ancestor chain of each edit, so a change costs
+O(depth) rather than a recount of the tree.
+"""
+
+
+FIELDS = ("pvs", "enabled", "latching", "annunciating", "with_filter")
+
+# Phoebus values for flags missing from a configuration
+DEFAULTS = {"enabled": True, "latching": True, "annunciating": False}
+
+_ZERO = (0,) * len(FIELDS)
+
+
+def pv_counts(enabled, latching, annunciating, alarm_filter):
+    """
+    Returns the contribution of a single PV to the totals of its groups.
+    Flags that are None take their Phoebus defaults.
+    """
+    flags = []
+    for prop, value in (("enabled", enabled), ("latching", latching), ("annunciating", annunciating)):
+        flags.append(int(DEFAULTS[prop] if value is None else bool(value)))
+
+    return (1,) + tuple(flags) + (1 if alarm_filter else 0,)
+
+
+class SubtreeAggregates:
+    """
+    Per group totals keyed by node. Nodes may be model items or store rows;
+    parent_of returns the parent of a node, or None at the root.
+    """
+
+    def __init__(self, parent_of):
+        self.parent_of = parent_of
+        self._totals = {}
+        self._pvs = {}
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        Computes the totals of every group of a PropertyStore in one pass
+        """
+        aggregates = cls(lambda row: store.parent[row] if row > 0 else None)
+        totals = aggregates._totals
+
+        values = [store.bools[prop] for prop in ("enabled", "latching", "annunciating")]
+        alarm_filter = store.texts["alarm_filter"]
+
+        # children follow their parents, so walking backwards completes each
+        # group before it is added to its own parent
+        for row in range(len(store) - 1, -1, -1):
+            if store.is_group[row]:
+                counts = totals.setdefault(row, list(_ZERO))
+
+            else:
+                counts = pv_counts(*[None if column[row] < 0 else column[row] for column in values],
+                                   alarm_filter[row])
+                aggregates._pvs[row] = counts
+
+            if row > 0:
+                parent_totals = totals.setdefault(store.parent[row], list(_ZERO))
+                for i, count in enumerate(counts):
+                    parent_totals[i] += count
+
+        return aggregates
+
+    def add_tree(self, root, children_of, counts_of):
+        """
+        Adds the totals of the subtree at root without propagating them to
+        its ancestors, see attach. counts_of returns the pv_counts of a PV
+        or None for a group.
+        """
+        # post-order so children are complete before their parents
+        order = []
+        to_process = [root]
+        while to_process:
+            node = to_process.pop()
+            order.append(node)
+            to_process += children_of(node)
+
+        for node in reversed(order):
+            counts = counts_of(node)
+
+            if counts is None:
+                counts = self._totals.setdefault(node, list(_ZERO))
+
+            else:
+                self._pvs[node] = counts
+
+            if node is not root:
+                parent_totals = self._totals.setdefault(self.parent_of(node), list(_ZERO))
+                for i, count in enumerate(counts):
+                    parent_totals[i] += count
+
+    def forget(self, root, children_of):
+        """
+        Drops the entries of a subtree that has been detached
+        """
+        to_process = [root]
+        while to_process:
+            node = to_process.pop()
+            self._totals.pop(node, None)
+            self._pvs.pop(node, None)
+            to_process += children_of(node)
+
+    def totals(self, node):
+        """
+        Returns a dictionary of the totals below a group, or of the PV itself
+        """
+        counts = self._pvs.get(node) or self._totals.get(node) or _ZERO
+        return dict(zip(FIELDS, counts))
+
+    def is_pv(self, node):
+        return node in self._pvs
+
+    def _add(self, node, delta):
+        while node is not None:
+            totals = self._totals.setdefault(node, list(_ZERO))
+            for i, count in enumerate(delta):
+                totals[i] += count
+
+            node = self.parent_of(node)
+
+    def set_pv(self, node, counts):
+        """
+        Sets the counts of a PV and updates its ancestors by the difference
+        """
+        old = self._pvs.get(node, _ZERO)
+        if old == counts:
+            return
+
+        self._totals.pop(node, None)
+        self._pvs[node] = counts
+        self._add(self.parent_of(node), [new - previous for new, previous in zip(counts, old)])
+
+    def remove_pv(self, node):
+        """
+        Removes a PV from its ancestors' totals, for example when it becomes a
+        group
+        """
+        old = self._pvs.pop(node, None)
+        if old is not None:
+            self._add(self.parent_of(node), [-count for count in old])
+
+    def detach(self, node):
+        """
+        Subtracts a subtree from its ancestors, called before the node is
+        moved or removed
+        """
+        counts = self._pvs.get(node) or self._totals.get(node)
+        if counts:
+            self._add(self.parent_of(node), [-count for count in counts])
+
+    def attach(self, node):
+        """
+        Adds a subtree to its ancestors, called once the node is in place
+        """
+        counts = self._pvs.get(node) or self._totals.get(node)
+        if counts:
+            self._add(self.parent_of(node), counts)
+
+
+def format_totals(totals):
+    return (f"{totals['pvs']} PVs: {totals['enabled']} enabled, {totals['pvs'] - totals['enabled']} disabled, "
+            f"{totals['latching']} latching, {totals['annunciating']} annunciating, "
+            f"{totals['with_filter']} with filter")
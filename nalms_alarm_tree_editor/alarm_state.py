@@ -0,0 +1,314 @@
+"""
+Live alarm state from the alarm server's Kafka topic. Messages are
+coalesced by PV until the editor applies them, and group severities are
+rolled up from the PVs below them.
+
+The topic of a configuration carries messages keyed "state:/<path>" whose
+values are JSON objects with a "severity" field. URLs of the form
+"standin://host:port" connect to a StandInBroker instead of Kafka, for use
+without an alarm server.
+"""
+import json
+import socket
+import socketserver
+import threading
+
+
+# Phoebus severity levels, lowest first
+SEVERITIES = ("OK", "MINOR_ACK", "MAJOR_ACK", "INVALID_ACK", "UNDEFINED_ACK",
+              "MINOR", "MAJOR", "INVALID", "UNDEFINED")
+
+_LEVELS = {severity: level for level, severity in enumerate(SEVERITIES)}
+
+STATE_PREFIX = "state:"
+
+
+def parse_state_message(key, value):
+    """
+    Returns (path, severity) for a state message, or None for other
+    messages. Deleted states have a severity of None.
+    """
+    if isinstance(key, bytes):
+        key = key.decode("utf8")
+
+    if not key or not key.startswith(STATE_PREFIX):
+        return None
+
+    path = key[len(STATE_PREFIX):]
+
+    if value is None:
+        return path, None
+
+    try:
+        severity = json.loads(value).get("severity")
+
+    except (ValueError, AttributeError):
+        return None
+
+    return path, severity if severity in _LEVELS else None
+
+
+class StateCoalescer:
+    """
+    Latest state per path, filled from the consumer thread and drained by
+    the editor. Repeated updates of a path between drains cost one entry.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.received = 0
+
+    def put(self, path, severity):
+        with self._lock:
+            self._pending[path] = severity
+            self.received += 1
+
+    def drain(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+
+        return pending
+
+
+class SeverityRollup:
+    """
+    Severity of each PV and the highest severity below each group. Groups
+    keep a count of PVs per severity level, so an update walks the ancestor
+    chain once. parent_of returns the parent of a node, or None at the root.
+    """
+
+    def __init__(self, parent_of):
+        self.parent_of = parent_of
+        self._levels = {}
+        self._counts = {}
+
+    def severity(self, node):
+        level = self._levels.get(node)
+
+        if level is None:
+            counts = self._counts.get(node)
+            if not counts or not any(counts):
+                return None
+
+            level = max(level for level, count in enumerate(counts) if count)
+
+        return SEVERITIES[level]
+
+    def set(self, node, severity):
+        """
+        Sets the severity of a PV and returns the nodes whose displayed
+        severity changed, starting with the PV
+        """
+        old = self._levels.get(node)
+        new = _LEVELS.get(severity)
+
+        if old == new:
+            return []
+
+        if new is None:
+            del self._levels[node]
+
+        else:
+            self._levels[node] = new
+
+        changed = [node]
+        parent = self.parent_of(node)
+
+        while parent is not None:
+            previous = self.severity(parent)
+            counts = self._counts.setdefault(parent, [0] * len(SEVERITIES))
+
+            if old is not None:
+                counts[old] -= 1
+
+            if new is not None:
+                counts[new] += 1
+
+            if self.severity(parent) != previous:
+                changed.append(parent)
+
+            parent = self.parent_of(parent)
+
+        return changed
+
+    def clear(self):
+        self._levels = {}
+        self._counts = {}
+
+
+class KafkaStateSource:
+    """
+    Iterates over the state messages of a configuration's topic, starting
+    from the earliest retained message
+    """
+
+    def __init__(self, bootstrap_servers, config_name):
+        try:
+            from kafka import KafkaConsumer
+
+        except ImportError:
+            raise RuntimeError("The live alarm state requires the kafka-python package")
+
+        self._closed = False
+        self._consumer = KafkaConsumer(config_name, bootstrap_servers=bootstrap_servers,
+                                       auto_offset_reset="earliest", enable_auto_commit=False,
+                                       group_id=None, consumer_timeout_ms=500)
+
+    def __iter__(self):
+        while not self._closed:
+            for message in self._consumer:
+                yield message.key, message.value
+
+                if self._closed:
+                    break
+
+        self._consumer.close()
+
+    def close(self):
+        self._closed = True
+
+
+class StandInStateSource:
+    """
+    Iterates over the messages published on a StandInBroker
+    """
+
+    def __init__(self, address):
+        host, _, port = address.rpartition(":")
+        self._socket = socket.create_connection((host or "127.0.0.1", int(port)))
+        self._file = self._socket.makefile("rb")
+
+    def __iter__(self):
+        try:
+            for line in self._file:
+                message = json.loads(line)
+                yield message["key"], message["value"]
+
+        except (OSError, ValueError):
+            return
+
+    def close(self):
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+
+        except OSError:
+            pass
+
+        self._socket.close()
+
+
+def open_state_source(url, config_name):
+    """
+    Returns a message source for url, either a Kafka bootstrap address or
+    standin://host:port
+    """
+    if url.startswith("standin://"):
+        return StandInStateSource(url[len("standin://"):])
+
+    return KafkaStateSource(url, config_name)
+
+
+class StateListener(threading.Thread):
+    """
+    Feeds state messages from a source into a coalescer until stopped
+    """
+
+    def __init__(self, source, coalescer):
+        super(StateListener, self).__init__(daemon=True)
+        self.source = source
+        self.coalescer = coalescer
+
+    def run(self):
+        for key, value in self.source:
+            state = parse_state_message(key, value)
+
+            if state is not None:
+                self.coalescer.put(*state)
+
+    def stop(self):
+        self.source.close()
+
+
+class _StandInHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        broker = self.server.broker
+        broker.subscribe(self.wfile)
+
+        try:
+            # hold the connection until the client leaves
+            while self.rfile.read(1):
+                pass
+
+        finally:
+            broker.unsubscribe(self.wfile)
+
+
+class StandInBroker:
+    """
+    Local stand-in for the alarm state topic. Published messages are sent
+    to every connected source as JSON lines, and the latest message per key
+    is replayed to new connections like a compacted topic.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self._latest = {}
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+        self._server = socketserver.ThreadingTCPServer((host, port), _StandInHandler)
+        self._server.daemon_threads = True
+        self._server.broker = self
+        self.address = "{}:{}".format(*self._server.server_address[:2])
+
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return f"standin://{self.address}"
+
+    def subscribe(self, stream):
+        with self._lock:
+            for line in self._latest.values():
+                stream.write(line)
+
+            stream.flush()
+            self._subscribers.append(stream)
+
+    def unsubscribe(self, stream):
+        with self._lock:
+            if stream in self._subscribers:
+                self._subscribers.remove(stream)
+
+    def publish(self, key, value):
+        self.publish_many([(key, value)])
+
+    def publish_many(self, messages):
+        """
+        Publishes (key, value) pairs, value being the JSON text or None
+        """
+        lines = []
+        with self._lock:
+            for key, value in messages:
+                line = (json.dumps({"key": key, "value": value}) + "\n").encode("utf8")
+                self._latest[key] = line
+                lines.append(line)
+
+            data = b"".join(lines)
+            for stream in list(self._subscribers):
+                try:
+                    stream.write(data)
+                    stream.flush()
+
+                except OSError:
+                    self._subscribers.remove(stream)
+
+    def publish_state(self, path, severity, message=""):
+        self.publish(STATE_PREFIX + path, json.dumps({"severity": severity, "message": message}))
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
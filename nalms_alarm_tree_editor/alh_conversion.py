@@ -1,15 +1,18 @@
 import xml.etree.ElementTree as ET
 import os
 import copy
-from treelib import Node, Tree
+import hashlib
+import re
+from collections import Counter
 
+from nalms_alarm_tree_editor.phoebus_config import _quote_attrib
 
-# TODO: ADD HANDLING OF SEVRCOMMAND, STATCOMMAND, ALARMCOUNTERFILETER, BEEPSEVERITY, BEEPSEVR
-# TODO: Fix path handling for include files
 
 class HeartbeatPV:
     def __init__(self, name, value=None, seconds=None):
         self.name = name
+        self.value = value
+        self.seconds = seconds
 
 class AckPV:
     def __init__(self, name, ack_value):
@@ -33,6 +36,29 @@ class ForcePV:
     def add_calc(self, expression):
         self.calc_expressions.append(expression)
 
+class Guidance:
+    """
+    Location of a $GUIDANCE block in an ALH file. The text is read from the
+    file when it is written out. Identical blocks within the files of one
+    include graph share one Guidance.
+    """
+
+    def __init__(self, filename, start, end, digest):
+        self.filename = filename
+        self.start = start
+        self.end = end
+        self.digest = digest
+
+    def read(self):
+        with open(self.filename, "rb") as f:
+            f.seek(self.start)
+            data = f.read(self.end - self.start)
+
+        if hashlib.sha1(data).digest() != self.digest:
+            raise ValueError(f"Guidance in {self.filename} changed since it was parsed")
+
+        return data.decode("utf8", errors="replace")
+
 class AlarmNode:
     def __init__(self, group_name, filename=None):
         self.name = group_name
@@ -42,18 +68,30 @@ class AlarmNode:
         self.force_pv = None
         self.parent = None
         self.node_children = []
+        # membership of node_children, which keeps adding children linear
+        self._child_set = set()
         self.guidance = []
         self.guidance_url = ""
         self.main_calc = ""
         self.calcs = {}
         self.filename = filename
+        self.sevr_commands = []
+        self.stat_commands = []
+        self.ack_pv = None
+        self.heartbeat_pv = None
+        self.alarm_count_filter = None
+        self.beep_severity = None
 
     def add_child(self, child):
-        if child in self.node_children:
-            print(f"DUPLICATE CHILD FOR GROUP {self.name}: {child}")
+        """
+        Adds a child path, returning False if the group already has it
+        """
+        if child in self._child_set:
+            return False
 
-        else:
-            self.node_children.append(child)
+        self._child_set.add(child)
+        self.node_children.append(child)
+        return True
 
 
 class AlarmLeaf:
@@ -69,10 +107,19 @@ class AlarmLeaf:
         self.guidance_url = []
         self.main_calc = ""
         self.calcs = {}
-        self.filename = ""
+        self.filename = filename
+        self.sevr_commands = []
+        self.stat_commands = []
+        self.ack_pv = None
+        self.heartbeat_pv = None
+        self.alarm_count_filter = None
+        self.beep_severity = None
 
 
 def build_tree(items, top_level_node):
+    # treelib is only needed for conversion, keep it out of module import
+    from treelib import Tree
+
     tree = Tree()
 
     # create root
@@ -87,7 +134,6 @@ def build_tree(items, top_level_node):
 
         if children:
             for child in children:
-                print(items[child].name)
                 tree.create_node(items[child].name, child, parent=node, data=items[child])
 
             # add children to process
@@ -98,255 +144,572 @@ def build_tree(items, top_level_node):
     return tree
 
 
-def parse_tree(top_level_file):
-    items = {}
-    # track inclusions
-    # map filename to group 
-    inclusions = {}
+class IncludeCycleError(Exception):
+    """
+    Raised when ALH configuration files include each other in a cycle
+    """
 
-    directory = "/".join(top_level_file.split("/")[:-1])
-    top_level_filename = top_level_file.split("/")[-1]
-    to_process = [top_level_filename]
 
-    in_top_level = True
-    top_level_node = None
-    current_level_node = None
-    node_path = None
-    parent_path = None
-    while len(to_process) > 0:
+def resolve_include(including_file, include_filename):
+    """
+    Resolves the filename of an INCLUDE directive relative to the directory
+    of the file that includes it
+    """
+    if os.path.isabs(include_filename):
+        return os.path.normpath(include_filename)
+
+    directory = os.path.dirname(including_file)
+    return os.path.normpath(os.path.join(directory, include_filename))
+
+
+def _join_path(parent_path, name):
+    if not parent_path:
+        return name
+
+    return f"{parent_path}/{name}"
 
-        filename = to_process.pop(0)
 
-        with open(f"{directory}/{filename}") as f:
-            lines = f.readlines()
+class AlhFile:
+    """
+    Parsed contents of a single ALH configuration file. Items are keyed by
+    their path relative to the point at which the file is included.
+    """
 
-        if not lines:
-            print(f.path)
+    def __init__(self, filename, guidance=None, resolved=None):
+        self.filename = filename
+        self.items = {}
+        self.roots = []
+        # (local parent path, resolved filename)
+        self.includes = []
+        self.warnings = []
+        # directive -> number of uses dropped by the conversion
+        self.unconverted = Counter()
+        self._group_paths = {}
+
+        # parser state
+        self.target = None
+        self.in_guidance = False
+        # end of the line being parsed
+        self.offset = 0
+        self._guidance_target = None
+        self._guidance_start = None
+        self._guidance_hash = None
+        # digest -> Guidance, shared by the files of an include graph
+        self._guidance = {} if guidance is None else guidance
+        # (directory, INCLUDE argument) -> resolved filename, shared likewise
+        self._resolved = {} if resolved is None else resolved
+
+
+    def group_path(self, group_name):
+        """
+        Returns the local path of a named parent group, creating the group at
+        the root of the file if it has not been defined
+        """
+        if group_name == "NULL":
+            return None
+
+        path = self._group_paths.get(group_name)
+        if path is None:
+            path = group_name
+            self._group_paths[group_name] = path
+
+            if path not in self.items:
+                self.items[path] = AlarmNode(group_name, filename=self.filename)
+                self.roots.append(path)
+
+        return path
+
+
+    def add_node(self, parent_name, node):
+        parent_path = self.group_path(parent_name)
+        node_path = _join_path(parent_path, node.name)
+
+        if isinstance(node, AlarmNode) and node_path in self.items:
+            # group redefined, keep original
+            node = self.items[node_path]
 
         else:
-            filename = f.name.split("/")[-1]
-         #   try:
-            in_guidance = False
-            in_calc = False
-            target = None
-            parent_group = None
-            if not in_top_level:
-                current_level_node = inclusions[filename]
+            node.parent = parent_path
+            self.items[node_path] = node
+
+            if parent_path is None:
+                self.roots.append(node_path)
+
+            elif not self.items[parent_path].add_child(node_path):
+                self.warnings.append(f"{self.filename}: duplicate child {node_path} of group {parent_path}")
+
+        if isinstance(node, AlarmNode):
+            self._group_paths[node.name] = node_path
+
+        return node_path
+
+
+    def add_include(self, parent_name, include_filename):
+        parent_path = self.group_path(parent_name)
+        key = (os.path.dirname(self.filename), include_filename)
+
+        resolved = self._resolved.get(key)
+        if resolved is None:
+            resolved = resolve_include(self.filename, include_filename)
+            self._resolved[key] = resolved
+
+        self.includes.append((parent_path, resolved))
+
+
+    def begin_guidance(self):
+        """
+        Starts a guidance block on the line after the current one
+        """
+        self._guidance_target = _target(self)
+        self._guidance_start = self.offset
+        self._guidance_hash = hashlib.sha1()
+        self.in_guidance = True
+
+
+    def add_guidance_line(self, raw_line):
+        self._guidance_hash.update(raw_line)
+
+
+    def end_guidance(self, end):
+        """
+        Records the guidance block ending at byte offset end on its node
+        """
+        digest = self._guidance_hash.digest()
+        guidance = self._guidance.get(digest)
+
+        if guidance is None:
+            guidance = Guidance(self.filename, self._guidance_start, end, digest)
+            self._guidance[digest] = guidance
+
+        self._guidance_target.guidance.append(guidance)
+
+        self._guidance_target = None
+        self._guidance_hash = None
+        self.in_guidance = False
+
+
+# directive name -> handler(alh_file, split)
+DIRECTIVE_HANDLERS = {}
+
+# directives that are parsed but have no Phoebus equivalent
+UNCONVERTED_DIRECTIVES = set()
+
+
+def register_directive(*names, converted=True):
+    """
+    Registers a handler for one or more ALH directives. Handlers are called
+    with the AlhFile being parsed and the whitespace split line. Directives
+    registered with converted=False are reported in the parser warnings,
+    since the Phoebus configuration drops them.
+    """
+    def decorator(handler):
+        for name in names:
+            DIRECTIVE_HANDLERS[name] = handler
+
+            if converted:
+                UNCONVERTED_DIRECTIVES.discard(name)
+
+            else:
+                UNCONVERTED_DIRECTIVES.add(name)
 
-            for line in lines:
-                split = line.split()
+        return handler
 
-                if len(split) > 0:
+    return decorator
 
-                    if in_guidance:
-                        if split[0] == "$END":
-                            in_guidance = False
 
-                        else: 
-                            items[target].guidance.append(line)
+def _target(alh_file):
+    if alh_file.target is None:
+        raise ValueError("directive precedes any GROUP or CHANNEL")
 
-                    else:
-                        if in_calc:
-                            if split[0] == "FORCEPV_CALC":
-                                items[target].main_calc = split[1]
+    return alh_file.items[alh_file.target]
 
-                            elif "FORCE_PV_CALC_" in split[0]:
-                                identifier = split[0][-1]
-                                items[target].calcs[identifier] = split[1]
 
-                            else:
-                                in_calc = False
+@register_directive("GROUP")
+def _handle_group(alh_file, split):
+    alh_file.target = alh_file.add_node(split[1], AlarmNode(split[2], filename=alh_file.filename))
 
 
-                        # Process group
-                        if split[0] == "GROUP":
+@register_directive("CHANNEL")
+def _handle_channel(alh_file, split):
+    leaf = AlarmLeaf(split[2], filename=alh_file.filename)
 
-                            # collect name
-                            group_name = split[2]
+    #store mask
+    if len(split) == 4:
+        leaf.mask = split[3]
 
-                            # store top level 
-                            if in_top_level:
-                                top_level_node = copy.copy(group_name)
-                                node_path = copy.copy(group_name)
+    alh_file.target = alh_file.add_node(split[1], leaf)
 
-                            parent = None
-                            if split[1] != "NULL":
-                                parent = split[1]
 
+@register_directive("INCLUDE")
+def _handle_include(alh_file, split):
+    alh_file.add_include(split[1], split[2])
 
-                            if not in_top_level:
-                                if parent:
-                                    parent_path = f"{current_level_node}/{parent}"
-                                    node_path = f"{current_level_node}/{parent}/{group_name}"
-                                else:
-                                    parent_path = current_level_node
-                                    node_path = f"{current_level_node}/{group_name}"
 
-                                items[parent_path].add_child(node_path)
+@register_directive("$COMMAND")
+def _handle_command(alh_file, split):
+    command = " ".join(split[1:])
+    _target(alh_file).commands += command.split("!")
 
 
-                            if node_path not in items:
-                                items[node_path] = AlarmNode(group_name, filename=filename)
+@register_directive("$SEVRCOMMAND", converted=False)
+def _handle_sevr_command(alh_file, split):
+    # severity change, such as UP_MAJOR, and the command to run
+    _target(alh_file).sevr_commands.append((split[1], " ".join(split[2:])))
 
-                            # update target 
-                            target = node_path
-                            parent_group = parent
 
-                        # process channel
-                        elif split[0] == "CHANNEL":
-                            channel_name = split[2]
-                            parent = split[1]
+@register_directive("$STATCOMMAND", converted=False)
+def _handle_stat_command(alh_file, split):
+    # alarm status and the command to run
+    _target(alh_file).stat_commands.append((split[1], " ".join(split[2:])))
 
-                            if parent_group and parent_group != parent:
-                                parent_path = f"{current_level_node}/{parent_group}/{parent}"
-                                node_path = f"{current_level_node}/{parent_group}/{parent}/{channel_name}"
 
-                            else:
-                                parent_path = f"{current_level_node}/{parent}"
-                                node_path = f"{current_level_node}/{parent}/{channel_name}"
+@register_directive("$SEVRPV", converted=False)
+def _handle_sevr_pv(alh_file, split):
+    _target(alh_file).sevr_pv = SevrPV(split[1])
 
-                            items[node_path] = AlarmLeaf(channel_name, filename=filename)
-                            items[node_path].parent = parent_path
 
-                            # store parent node
-                            if parent_path not in items:
-                                items[parent_path] = AlarmNode(parent, filename=filename)
-                                items[current_level_node].add_child(parent_path)
+@register_directive("$FORCEPV")
+def _handle_force_pv(alh_file, split):
+    force_mask = split[2]
 
-                            items[node_path].parent = parent_path
-                            items[parent_path].add_child(node_path)
+    force_value = None
+    reset_value = None
 
-                            #store mask
-                            if len(split) == 4:
-                                items[node_path].mask = split[3]
+    if len(split) >= 4:
+        force_value = split[3]
 
-                            target = node_path
+    if len(split) == 5:
+        reset_value = split[4]
 
+    force_pv = ForcePV(force_mask, force_value, reset_value)
 
-                        elif split[0] == "$COMMAND":
-                            command = " ".join(split[1:])
-                            commands = command.split("!")
-                            items[target].commands += commands
+    if split[1] == "CALC":
+        force_pv.is_calc = True
 
-                        elif split[0] == "$SEVRPV":
-                            items[target].sevr_pv = SevrPV(split[1])
+    else:
+        force_pv.name = split[1]
 
+    _target(alh_file).force_pv = force_pv
 
-                        # CONFIGURE THE FORCEPV
-                        elif split[0] == "$FORCEPV":
-                            force_mask = split[2]
 
-                            force_value = None
-                            reset_value = None
+@register_directive("$FORCEPV_CALC")
+def _handle_force_pv_calc(alh_file, split):
+    _target(alh_file).main_calc = split[1]
 
-                            if len(split) >= 4:
-                                force_value = split[3]
 
-                            if len(split) == 5:
-                                reset_value = split[4]
+@register_directive(*[f"$FORCEPV_CALC_{letter}" for letter in "ABCDEFGHIJKL"])
+def _handle_force_pv_calc_input(alh_file, split):
+    _target(alh_file).calcs[split[0][-1]] = split[1]
 
-                            items[target].force_pv = ForcePV(force_mask, force_value, reset_value)
 
-                            if split[1] == "CALC":
-                                items[target].force_pv.is_calc = True
-                            
-                            else:
-                                force_pv_name = split[1]
-                                items[target].force_pv.name = force_pv_name
+@register_directive("$GUIDANCE")
+def _handle_guidance(alh_file, split):
+    if len(split) == 1:
+        alh_file.begin_guidance()
 
+    else:
+        _target(alh_file).guidance_url = split[1]
 
-                        # CONFIGURE GUIDANCE
-                        elif split[0] == "$GUIDANCE":
-                            if len(split) == 1:
-                                in_guidance = True
 
-                            else:
-                                urlname = split[1]
-                                items[target].guidance_url = urlname
+@register_directive("$ALIAS")
+def _handle_alias(alh_file, split):
+    # aliases may contain spaces
+    _target(alh_file).alias = " ".join(split[1:])
 
 
-                        elif split[0] == "$ALIAS":
-                            items[target].alias = split[1]
+@register_directive("$ACKPV", converted=False)
+def _handle_ack_pv(alh_file, split):
+    # value to write when the pv is acknowledged
+    _target(alh_file).ack_pv = AckPV(split[1], split[2])
 
-                        # track inclusions
-                        elif split[0] == "INCLUDE":
-                            parent = split[1]
 
-                            #HACK FIX
-                            include_filename = split[2]
-                            if include_filename[:2] == "./":
-                                include_filename = include_filename.replace("./", "")
+@register_directive("$HEARTBEATPV", converted=False)
+def _handle_heartbeat_pv(alh_file, split):
+    heartbeat_val = None
+    seconds = None
+    if len(split) >= 3:
+        heartbeat_val = split[2]
 
-                            to_process.append(include_filename)
+    if len(split) == 4:
+        seconds = split[3]
 
-                            if in_top_level:
-                                inclusions[include_filename] = parent
-                            
-                            else:
-                                inclusions[include_filename] = f"{current_level_node}/{parent}"
+    _target(alh_file).heartbeat_pv = HeartbeatPV(split[1], value=heartbeat_val, seconds=seconds)
 
-                        # INCOMPLETE HANDLING
-                        elif split[0] == "$ACKPV":
-                            ack_pv_name = split[1]
-                            # value to write when the pv is acknowledged
-                            ack_value = split[2]
-                            items[target] = AckPV(ack_pv_name, ack_value)
 
-                        # Skip comments
-                        elif split[0][0] == "#":
-                            pass
+@register_directive("$ALARMCOUNTFILTER")
+def _handle_alarm_count_filter(alh_file, split):
+    # alarm count within the number of seconds
+    _target(alh_file).alarm_count_filter = (split[1], split[2])
 
 
-                        ### HANDLED INCORRECTLY!!!! ONLY ONE HEARTBEATPV
-                        elif split[0] == "$HEARTBEATPV":
+@register_directive("$BEEPSEVERITY", "$BEEPSEVR", converted=False)
+def _handle_beep_severity(alh_file, split):
+    _target(alh_file).beep_severity = split[1]
 
-                            heartbeat_pv_name = split[1]
-                            
-                            heartbeat_val = None
-                            seconds = None
-                            if len(split) >= 3:
-                                heartbeat_val = split[2]
 
-                            if len(split) == 4:
-                                seconds = split[3]
-                            
-                            items[target] = HeartbeatPV(heartbeat_pv_name, seconds=seconds, value =heartbeat_val)
+def parse_alh_file(filename, guidance=None, resolved=None):
+    """
+    Parses a single ALH configuration file without following its inclusions.
+    Problems are collected in the warnings of the returned AlhFile. Files
+    given the same guidance dictionary share identical guidance blocks, and
+    files given the same resolved dictionary share resolved include paths.
+    """
+    alh_file = AlhFile(filename, guidance=guidance, resolved=resolved)
 
+    # read as bytes to track the offsets of guidance blocks
+    with open(filename, "rb") as f:
+        for line_number, raw_line in enumerate(f, start=1):
+            line_start = alh_file.offset
+            alh_file.offset += len(raw_line)
+            split = raw_line.decode("utf8", errors="replace").split()
 
-                        else:
-                            print(f"Not found! {line}")
-                            pass
+            if alh_file.in_guidance:
+                if split and split[0] == "$END":
+                    alh_file.end_guidance(line_start)
 
-            in_top_level = False
+                else:
+                    alh_file.add_guidance_line(raw_line)
 
-           # except Exception as e:
-           #     print(e)
-           #     print(f"ERROR PROCESSING FILE {filename}")
+                continue
 
+            if not split:
+                continue
 
-    for item_name, value in items.items():
-        if not value.parent:
-            if value.filename in inclusions:
-                items[item_name].parent = inclusions[value.filename]
+            _parse_directive(alh_file, split, line_number)
 
+    if alh_file.in_guidance:
+        alh_file.warnings.append(f"{filename}: $GUIDANCE without $END")
+        alh_file.end_guidance(alh_file.offset)
 
+    if alh_file.offset == 0:
+        alh_file.warnings.append(f"{filename}: empty configuration file")
+
+    for directive, count in sorted(alh_file.unconverted.items()):
+        alh_file.warnings.append(f"{filename}: {directive} has no Phoebus equivalent, not converted on {count} nodes")
+
+    return alh_file
+
+
+def _parse_directive(alh_file, split, line_number):
+    filename = alh_file.filename
+
+    # Skip comments
+    if split[0][0] == "#":
+        return
+
+    handler = DIRECTIVE_HANDLERS.get(split[0])
+
+    if handler is None:
+        alh_file.warnings.append(f"{filename}:{line_number}: unknown directive {split[0]}")
+        return
+
+    try:
+        handler(alh_file, split)
+
+    except (IndexError, KeyError, ValueError) as e:
+        alh_file.warnings.append(f"{filename}:{line_number}: malformed {split[0]} ({e or type(e).__name__})")
+        return
+
+    if split[0] in UNCONVERTED_DIRECTIVES:
+        alh_file.unconverted[split[0]] += 1
+
+
+def load_include_graph(top_level_file):
+    """
+    Parses the top level file and every file reachable through INCLUDE
+    directives. Each unique file is parsed once regardless of how many times
+    it is included.
+
+    Returns a dictionary mapping resolved filenames to AlhFile objects.
+    Raises IncludeCycleError if the inclusions form a cycle.
+    """
+    parsed = {}
+    # guidance blocks and include paths are only shared within this graph,
+    # whose files are reloaded together
+    guidance = {}
+    resolved = {}
+
+    def visit(filename, chain):
+        if filename in chain:
+            cycle = chain[chain.index(filename):] + [filename]
+            raise IncludeCycleError("Include cycle: " + " -> ".join(cycle))
+
+        if filename in parsed:
+            return
+
+        alh_file = parse_alh_file(filename, guidance=guidance, resolved=resolved)
+        parsed[filename] = alh_file
+
+        for _, include_filename in alh_file.includes:
+            visit(include_filename, chain + [filename])
+
+    visit(os.path.normpath(os.path.abspath(top_level_file)), [])
+
+    return parsed
+
+
+def _instantiate(parsed, alh_file, prefix, items, warnings):
+    """
+    Places the items of a parsed file under the inclusion point prefix. Nodes
+    are shallow copies, so parsed data is shared by reference between every
+    inclusion of the same file.
+    """
+    for local_path, node in alh_file.items.items():
+        instance = copy.copy(node)
+
+        if node.node_children is not None:
+            instance.node_children = [_join_path(prefix, child) for child in node.node_children]
+            instance._child_set = set(instance.node_children)
+
+        if node.parent:
+            instance.parent = _join_path(prefix, node.parent)
+
+        else:
+            instance.parent = prefix or None
+
+        items[_join_path(prefix, local_path)] = instance
+
+    if prefix in items:
+        for root in alh_file.roots:
+            if not items[prefix].add_child(_join_path(prefix, root)):
+                warnings.append(f"{alh_file.filename}: duplicate child {_join_path(prefix, root)} of group {prefix}")
+
+    for parent_path, include_filename in alh_file.includes:
+        include_prefix = _join_path(prefix, parent_path) if parent_path else prefix
+        _instantiate(parsed, parsed[include_filename], include_prefix, items, warnings)
+
+
+def parse_tree(top_level_file, warnings=None):
+    parsed = load_include_graph(top_level_file)
+
+    if warnings is not None:
+        warnings += collect_warnings(parsed)
+
+    return build_items(parsed, top_level_file, warnings=warnings)
+
+
+def collect_warnings(parsed):
+    """
+    Returns the parser warnings of every file in an include graph
+    """
+    warnings = []
+    for alh_file in parsed.values():
+        warnings += alh_file.warnings
+
+    return warnings
+
+
+def build_items(parsed, top_level_file, warnings=None):
+    """
+    Instantiates the items of an include graph returned by load_include_graph.
+    Files included twice at the same point are added to warnings.
+    """
+    top_level_filename = os.path.normpath(os.path.abspath(top_level_file))
+    top_level = parsed[top_level_filename]
+
+    items = {}
+    _instantiate(parsed, top_level, "", items, [] if warnings is None else warnings)
+
+    top_level_node = None
+    if top_level.roots:
+        top_level_node = top_level.roots[0]
 
     return items, top_level_node
 
 
+class _GraphWalker:
+    """
+    Adds the groups and channels of an include graph to an XMLBuilder by
+    walking the parsed files directly, so a file included at many points is
+    never copied. Its channels are only written at the first inclusion point,
+    at any other XMLBuilder.add_pv would drop them as duplicates.
+    """
 
+    def __init__(self, builder, parsed, warnings):
+        self.builder = builder
+        self.parsed = parsed
+        self.warnings = warnings
+        # filename -> prefix of the inclusion whose channels are written
+        self._written_at = {}
+
+    def walk(self, alh_file, local_path, prefix, parent_group=None):
+        group = _join_path(prefix, local_path)
+        children = self._children(alh_file, local_path, prefix)
+
+        if not children:
+            return
+
+        self.builder.add_group(group, alh_file.items[local_path], parent_group=parent_group)
+
+        for child_file, child_path, child_prefix in children:
+            child = child_file.items[child_path]
+
+            if isinstance(child, AlarmLeaf):
+                if self._written_at.setdefault(child_file.filename, child_prefix) == child_prefix:
+                    self.builder.add_pv(child.name, group, child)
+
+            elif isinstance(child, AlarmNode):
+                self.walk(child_file, child_path, child_prefix, parent_group=group)
+
+    def _children(self, alh_file, local_path, prefix):
+        # (file, local path, prefix) of each child, in the order _instantiate adds them
+        children = [(alh_file, child, prefix) for child in alh_file.items[local_path].node_children]
+
+        for parent_path, include_filename in alh_file.includes:
+            if parent_path == local_path:
+                self._add_roots(children, self.parsed[include_filename], _join_path(prefix, local_path))
+
+        return self._unique(children)
+
+    def _add_roots(self, children, alh_file, prefix):
+        children += [(alh_file, root, prefix) for root in alh_file.roots]
+
+        # files included outside of any group attach to the same point
+        for parent_path, include_filename in alh_file.includes:
+            if parent_path is None:
+                self._add_roots(children, self.parsed[include_filename], prefix)
+
+    def _unique(self, children):
+        seen = set()
+        unique = []
+
+        for child in children:
+            path = _join_path(child[2], child[1])
+
+            if path not in seen:
+                seen.add(path)
+                unique.append(child)
+
+            else:
+                self.warnings.append(f"{child[0].filename}: duplicate child {path}")
+
+        return unique
+
+
+def walk_include_graph(builder, parsed, top_level_file, warnings=None):
+    """
+    Adds the tree of an include graph returned by load_include_graph to an
+    XMLBuilder. Gives the same configuration as building the treelib tree of
+    build_items, without instantiating every inclusion. Files included twice
+    at the same point are added to warnings.
+    """
+    top_level_filename = os.path.normpath(os.path.abspath(top_level_file))
+    top_level = parsed[top_level_filename]
+
+    if top_level.roots:
+        _GraphWalker(builder, parsed, [] if warnings is None else warnings).walk(top_level, top_level.roots[0], "")
 
 
 class XMLBuilder:
     def __init__(self, config_name, root):
         self.configuration = ET.Element("config", name=config_name)
         self.groups = {}
-        self.added_pvs = []
+        self.added_pvs = set()
         self.settings_artifacts = []
 
 
     def add_group(self, group, data, parent_group = None):
-        group_name = group
+        group_name = data.name
         if data.alias:
             group_name = data.alias
 
@@ -356,71 +719,263 @@ class XMLBuilder:
             else:
                 self.groups[group] = ET.SubElement(self.groups[parent_group], 'component', name=group_name)
 
+            self._add_records(self.groups[group], data)
+
 
     def add_pv(self, pvname, group, data):
         if pvname in self.added_pvs:
             pass
 
         else:
-            self.added_pvs.append(pvname)
-            pv = ET.SubElement(self.groups[group], "pv", name=pvname)
-        #    description = ET.SubElement(pv, "description")
-            enabled = ET.SubElement(pv, "enabled")
-            enabled.text = 'true'
+            self.added_pvs.add(pvname)
+            self.groups[group].append(self._pv_element(pvname, data))
+
+
+    def _pv_element(self, pvname, data):
+        pv = ET.Element("pv", name=pvname)
+
+        if data.alias:
+            description = ET.SubElement(pv, "description")
+            description.text = data.alias
+
+        # mask characters: Cancel, Disable, Ack, ackT, Log
+        mask = data.mask or ""
+        enabled = ET.SubElement(pv, "enabled")
+        enabled.text = 'false' if ("C" in mask or "D" in mask) else 'true'
 
-            if data.force_pv is not None:
+        # transient alarms need no acknowledgement
+        if "T" in mask:
+            ET.SubElement(pv, "latching").text = 'false'
+
+        self._add_records(pv, data)
+
+        # alarm after count alarms within the number of seconds
+        if data.alarm_count_filter is not None:
+            count, seconds = data.alarm_count_filter
+            ET.SubElement(pv, "delay").text = seconds
+            ET.SubElement(pv, "count").text = count
+
+        if data.force_pv is not None:
+            text = self._process_forcepv(data.force_pv, data)
+
+            if text:
                 filter_pv = ET.SubElement(pv, "filter")
-                filter_pv.text = self._process_forcepv(data.force_pv)
+                filter_pv.text = text
+
+        return pv
 
 
-    def _process_forcepv(self, force_pv):
+    def _add_records(self, elem, data):
+        for guidance in data.guidance:
+            text = guidance.read().strip()
+
+            guidance_elem = ET.SubElement(elem, "guidance")
+            ET.SubElement(guidance_elem, "title").text = "Guidance"
+            ET.SubElement(guidance_elem, "details").text = text
+
+        for command in data.commands:
+            if command.strip():
+                command_elem = ET.SubElement(elem, "command")
+                ET.SubElement(command_elem, "title").text = "Command"
+                ET.SubElement(command_elem, "details").text = command.strip()
+
+
+    def _process_forcepv(self, force_pv, data):
 
         text = force_pv.name
         if force_pv.is_calc:
-            formatting = force_pv.calc_expressions.pop("A")
+            if not data.main_calc:
+                return None
+
+            # substitute calc inputs A-L with their pv names
+            text = re.sub(r"\b([A-L])\b", lambda match: data.calcs.get(match.group(1), match.group(1)),
+                          data.main_calc)
 
-            for key, value in force_pv.calc_expressions.items():
-                formatting.replace(key, value)
+            if force_pv.force_value:
+                text = f"({text})"
 
         if force_pv.force_value:
             text += f" != {force_pv.force_value}"
 
         return text
-               
-    
+
+
+class XMLWriter(XMLBuilder):
+    """
+    Writes a configuration to a binary file as groups and pvs are added,
+    instead of building an element tree. Groups and pvs must be added in
+    document order, as handle_children and walk_include_graph do. Guidance
+    is read from the ALH files as each element is written, so the text of
+    the whole configuration is never held at once.
+    """
+
+    def __init__(self, config_name, output):
+        self.output = output
+        self.groups = set()
+        self.added_pvs = set()
+        self.settings_artifacts = []
+
+        # open groups, innermost last, and whether the last start tag
+        # still lacks its closing ">"
+        self._open = [None]
+        self._in_start_tag = False
+
+        output.write(b"<?xml version='1.0' encoding='utf8'?>\n")
+        self._start("config", config_name)
+
+
+    def add_group(self, group, data, parent_group=None):
+        if group in self.groups:
+            return
+
+        self.groups.add(group)
+        self._close_to(parent_group)
+        self._start("component", data.alias or data.name)
+        self._open.append(group)
+
+        elem = ET.Element("component")
+        self._add_records(elem, data)
+        for record in elem:
+            self._write(ET.tostring(record, encoding="unicode"))
+
+
+    def add_pv(self, pvname, group, data):
+        if pvname in self.added_pvs:
+            return
+
+        self.added_pvs.add(pvname)
+        self._close_to(group)
+        self._write(ET.tostring(self._pv_element(pvname, data), encoding="unicode"))
+
+
+    def close(self):
+        """
+        Writes the end tags of the open groups and the configuration
+        """
+        while self._open:
+            self._end()
+
+
+    def _start(self, tag, name):
+        # the start tag is completed by the first child, or made empty
+        self._write(f"<{tag} name={_quote_attrib(name)}")
+        self._in_start_tag = True
+
+
+    def _end(self):
+        group = self._open.pop()
+        tag = "config" if group is None and not self._open else "component"
+
+        if self._in_start_tag:
+            self.output.write(b" />")
+            self._in_start_tag = False
+
+        else:
+            self.output.write(f"</{tag}>".encode("utf8"))
+
+
+    def _close_to(self, group):
+        while self._open[-1] != group:
+            self._end()
+
+
+    def _write(self, text):
+        if self._in_start_tag:
+            self.output.write(b">")
+            self._in_start_tag = False
+
+        self.output.write(text.encode("utf8"))
+
 
 def handle_children(builder, tree, node, parent_group=None):
     children = tree.children(node.identifier)
 
     if children:
-        builder.add_group(node.tag, node.data, parent_group=parent_group)
+        builder.add_group(node.identifier, node.data, parent_group=parent_group)
 
         for child in children:
             if isinstance(child.data, AlarmLeaf):
-                builder.add_pv(child.tag, node.tag, child.data)
+                builder.add_pv(child.tag, node.identifier, child.data)
 
             elif isinstance(child.data, AlarmNode):
-                handle_children(builder, tree, child, parent_group=node.tag)
-
+                handle_children(builder, tree, child, parent_group=node.identifier)
 
 
-def build_config_file(tree, config_name, output_filename):
 
+def build_config(tree, config_name):
+    """
+    Builds the Phoebus configuration element for a tree
+    """
     root = tree.root
     builder = XMLBuilder(config_name, root)
     root_node = tree.get_node(root)
     handle_children(builder, tree, root_node)
 
+    return builder.configuration
+
+
+def write_graph_config(parsed, top_level_file, config_name, output):
+    """
+    Streams the configuration of an include graph to a binary file object
+    """
+    writer = XMLWriter(config_name, output)
+    walk_include_graph(writer, parsed, top_level_file)
+    writer.close()
+
+
+def write_config_file(populate, config_name, output_filename, sharded=False):
+    """
+    Writes a configuration whose groups and pvs are added by
+    populate(builder), in document order. Plain files are streamed, sharded
+    configurations are split from an element tree. Returns the number of
+    pvs written, each name once.
+    """
+    if sharded:
+        from nalms_alarm_tree_editor.sharding import write_config_shards
+
+        builder = XMLBuilder(config_name, None)
+        populate(builder)
+
+        # output_filename is the shard directory
+        write_config_shards(builder.configuration, output_filename)
+        return len(builder.added_pvs)
+
     with open (output_filename, "wb") as f : 
-        file_str = ET.tostring(builder.configuration, encoding='utf8') 
-        f.write(file_str)
+        writer = XMLWriter(config_name, f)
+        populate(writer)
+        writer.close()
+
+    return len(writer.added_pvs)
+
+
+def build_config_file(tree, config_name, output_filename, sharded=False):
+    write_config_file(lambda builder: handle_children(builder, tree, tree.get_node(tree.root)),
+                      config_name, output_filename, sharded=sharded)
+
+
+def build_graph_config_file(parsed, top_level_file, config_name, output_filename, sharded=False, warnings=None):
+    write_config_file(lambda builder: walk_include_graph(builder, parsed, top_level_file, warnings=warnings),
+                      config_name, output_filename, sharded=sharded)
+
+
+
+def convert_alh_to_phoebus(input_filename, output_filename, sharded=False, warnings=None):
+    """
+    Converts an ALH configuration. Parser warnings are added to warnings when
+    a list is given and printed together otherwise.
+    """
+    report = warnings is None
+    if report:
+        warnings = []
 
+    config_name = output_filename.rstrip("/").split("/")[-1].replace(".xml", "")
+    parsed = load_include_graph(input_filename)
+    warnings += collect_warnings(parsed)
 
+    build_graph_config_file(parsed, input_filename, config_name, output_filename, sharded=sharded, warnings=warnings)
 
-def convert_alh_to_phoebus(input_filename, output_filename):
-    config_name = output_filename.split("/")[-1].replace(".xml", "")
-    items, top_level_node = parse_tree(input_filename)
-    tree = build_tree(items, top_level_node)
-    build_config_file(tree, config_name, output_filename)
+    if report and warnings:
+        print(f"{len(warnings)} warnings converting {input_filename}:")
+        print("\n".join(warnings))
 
-    return True
\ No newline at end of file
+    return True
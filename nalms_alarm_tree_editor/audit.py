@@ -0,0 +1,305 @@
+"""
+Connectivity audit of the PVs in an alarm configuration. PVs are looked up
+with Channel Access name searches sent over UDP from a single asyncio
+socket, so large configurations can be checked without creating a channel
+for every PV.
+"""
+import asyncio
+import os
+import struct
+import time
+import xml.etree.ElementTree as ET
+
+
+CA_SERVER_PORT = 5064
+CA_MINOR_VERSION = 13
+CA_PROTO_VERSION = 0
+CA_PROTO_SEARCH = 6
+DONT_REPLY = 5
+
+# keep datagrams under the ethernet MTU
+MAX_DATAGRAM_SIZE = 1400
+
+_HEADER = struct.Struct(">HHHHII")
+_VERSION_MESSAGE = _HEADER.pack(CA_PROTO_VERSION, 0, 0, CA_MINOR_VERSION, 0, 0)
+
+
+def search_message(pvname, search_id):
+    payload = pvname.encode("utf8") + b"\0"
+    payload += b"\0" * (-len(payload) % 8)
+
+    return _HEADER.pack(CA_PROTO_SEARCH, len(payload), DONT_REPLY, CA_MINOR_VERSION,
+                        search_id, search_id) + payload
+
+
+def iter_messages(datagram):
+    """
+    Yields (command, data_type, parameter2, payload) for each Channel Access
+    message in a datagram
+    """
+    offset = 0
+    while offset + _HEADER.size <= len(datagram):
+        command, payload_size, data_type, _, _, parameter2 = _HEADER.unpack_from(datagram, offset)
+        offset += _HEADER.size
+        yield command, data_type, parameter2, datagram[offset:offset + payload_size]
+        offset += payload_size
+
+
+def ca_addresses():
+    """
+    Returns the search addresses configured by the EPICS_CA_* environment
+    variables
+    """
+    port = int(os.environ.get("EPICS_CA_SERVER_PORT", CA_SERVER_PORT))
+    addresses = []
+
+    for address in os.environ.get("EPICS_CA_ADDR_LIST", "").split():
+        host, _, address_port = address.partition(":")
+        addresses.append((host, int(address_port or port)))
+
+    if os.environ.get("EPICS_CA_AUTO_ADDR_LIST", "YES").upper() != "NO":
+        addresses.append(("255.255.255.255", port))
+
+    return addresses
+
+
+class AuditCache:
+    """
+    Caches audit results for ttl seconds
+    """
+
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self._results = {}
+
+    def get(self, pvname):
+        entry = self._results.get(pvname)
+
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            return None
+
+        return entry[0]
+
+    def set(self, pvname, connected):
+        self._results[pvname] = (connected, time.monotonic())
+
+    def clear(self):
+        self._results = {}
+
+
+class AuditReport:
+
+    def __init__(self):
+        self.connected = []
+        self.disconnected = []
+        # errors reported by the search socket, such as unreachable addresses
+        self.errors = []
+        self.cached = 0
+        self.elapsed = 0.0
+
+    def summary(self):
+        total = len(self.connected) + len(self.disconnected)
+        errors = f", {len(self.errors)} search errors" if self.errors else ""
+
+        return (f"{len(self.connected)} of {total} PVs reachable, {len(self.disconnected)} unreachable "
+                f"({self.cached} cached, {self.elapsed:.1f} s{errors})")
+
+
+class _SearchProtocol(asyncio.DatagramProtocol):
+    """
+    Sends queued search requests in batched datagrams and resolves the
+    futures of the requests that get a reply
+    """
+
+    def __init__(self, addresses, errors):
+        self.addresses = addresses
+        self.errors = errors
+        self.transport = None
+        self.pending = {}
+        self._queue = []
+        self._queued_size = 0
+        self._flush_handle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        for command, _, search_id, _ in iter_messages(data):
+            if command == CA_PROTO_SEARCH:
+                future = self.pending.pop(search_id, None)
+
+                if future is not None and not future.done():
+                    future.set_result(True)
+
+    def error_received(self, exc):
+        self.errors.append(str(exc))
+
+    def search(self, message):
+        if self._queued_size + len(message) > MAX_DATAGRAM_SIZE - len(_VERSION_MESSAGE):
+            self._flush()
+
+        self._queue.append(message)
+        self._queued_size += len(message)
+
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self._queue or self.transport is None:
+            return
+
+        datagram = _VERSION_MESSAGE + b"".join(self._queue)
+        self._queue = []
+        self._queued_size = 0
+
+        for address in self.addresses:
+            self.transport.sendto(datagram, address)
+
+
+async def audit_pvs(pvnames, addresses=None, concurrency=1000, timeout=2.0, retries=1, cache=None):
+    """
+    Checks that each PV answers a Channel Access search.
+
+    At most concurrency searches are outstanding at once and each PV is
+    given timeout seconds, split across retries + 1 attempts. Results found
+    in cache are reused and new results are stored there.
+    """
+    start = time.monotonic()
+    report = AuditReport()
+
+    if addresses is None:
+        addresses = ca_addresses()
+
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: _SearchProtocol(addresses, report.errors), local_addr=("0.0.0.0", 0), allow_broadcast=True
+    )
+
+    semaphore = asyncio.Semaphore(concurrency)
+    attempt_timeout = timeout / (retries + 1)
+    search_ids = iter(range(1, 2 ** 32))
+
+    async def check(pvname):
+        async with semaphore:
+            search_id = next(search_ids)
+            future = loop.create_future()
+            protocol.pending[search_id] = future
+            message = search_message(pvname, search_id)
+
+            try:
+                for _ in range(retries + 1):
+                    protocol.search(message)
+
+                    try:
+                        return await asyncio.wait_for(asyncio.shield(future), attempt_timeout)
+
+                    except asyncio.TimeoutError:
+                        pass
+
+                return False
+
+            finally:
+                protocol.pending.pop(search_id, None)
+
+    unique = list(dict.fromkeys(pvnames))
+    to_check = []
+    for pvname in unique:
+        connected = cache.get(pvname) if cache is not None else None
+
+        if connected is None:
+            to_check.append(pvname)
+
+        else:
+            report.cached += 1
+
+            if connected:
+                report.connected.append(pvname)
+
+            else:
+                report.disconnected.append(pvname)
+
+    try:
+        results = await asyncio.gather(*[check(pvname) for pvname in to_check])
+
+    finally:
+        transport.close()
+
+    for pvname, connected in zip(to_check, results):
+        if cache is not None:
+            cache.set(pvname, connected)
+
+        if connected:
+            report.connected.append(pvname)
+
+        else:
+            report.disconnected.append(pvname)
+
+    report.elapsed = time.monotonic() - start
+
+    return report
+
+
+def audit(pvnames, **kwargs):
+    """
+    Synchronous wrapper around audit_pvs
+    """
+    return asyncio.run(audit_pvs(pvnames, **kwargs))
+
+
+def config_pvnames(filename):
+    """
+    Returns the PV names in a Phoebus configuration file or, for files ending
+    in alhConfig, in the converted ALH tree
+    """
+    if filename.endswith("alhConfig"):
+        from nalms_alarm_tree_editor.alh_conversion import load_include_graph, AlarmLeaf
+
+        # each file once, however many times it is included
+        parsed = load_include_graph(filename)
+        return list({item.name: None for alh_file in parsed.values()
+                     for item in alh_file.items.values() if isinstance(item, AlarmLeaf)})
+
+    return [elem.attrib["name"] for _, elem in ET.iterparse(filename) if elem.tag == "pv"]
+
+
+class _StandInProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, pvnames, tcp_port):
+        self.pvnames = pvnames
+        self.tcp_port = tcp_port
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        replies = []
+
+        for command, _, search_id, payload in iter_messages(data):
+            if command == CA_PROTO_SEARCH:
+                pvname = payload.rstrip(b"\0").decode("utf8")
+
+                if pvname in self.pvnames:
+                    replies.append(_HEADER.pack(CA_PROTO_SEARCH, 8, self.tcp_port, 0, 0xFFFFFFFF, search_id)
+                                   + struct.pack(">H6x", CA_MINOR_VERSION))
+
+        if replies:
+            self.transport.sendto(_VERSION_MESSAGE + b"".join(replies), addr)
+
+
+async def start_stand_in_server(pvnames, host="127.0.0.1", port=0):
+    """
+    Starts a local server that answers Channel Access searches for the given
+    PV names, for auditing without a control system network. Returns the
+    transport and the (host, port) it is bound to.
+    """
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _StandInProtocol(set(pvnames), CA_SERVER_PORT), local_addr=(host, port)
+    )
+
+    return transport, transport.get_extra_info("sockname")[:2]
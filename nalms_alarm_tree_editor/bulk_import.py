@@ -0,0 +1,176 @@
+"""
+Bulk placement of PVs into alarm groups. Operates on the node list format
+returned by PhoebusConfigTool.parse_config, a list of [data, parent_idx]
+entries with the configuration root at index 0.
+"""
+import fnmatch
+import re
+
+
+class PlacementRule:
+    """
+    Maps PV names matching a pattern to a group path such as "AREA/SUBAREA".
+    Patterns prefixed with "re:" are regular expressions, anything else is
+    treated as a glob.
+    """
+
+    def __init__(self, pattern, group_path):
+        self.pattern = pattern
+        self.group_path = group_path.strip("/")
+
+        if pattern.startswith("re:"):
+            self._regex = re.compile(pattern[3:])
+
+        else:
+            self._regex = re.compile(fnmatch.translate(pattern))
+
+    def matches(self, pvname):
+        return self._regex.fullmatch(pvname) is not None
+
+    def group_for(self, name, **fields):
+        """
+        Returns the group path for a matching name, or None. {field}
+        placeholders in the group path are filled from fields and the named
+        groups of a regular expression.
+        """
+        match = self._regex.fullmatch(name)
+        if match is None:
+            return None
+
+        if "{" not in self.group_path:
+            return self.group_path
+
+        return self.group_path.format(**dict(fields, **match.groupdict()))
+
+
+def read_pv_list(text):
+    """
+    Reads PV names from pasted text or file contents. Names may be separated
+    by newlines, commas or whitespace; lines starting with # are skipped.
+    """
+    pvs = []
+    for line in text.splitlines():
+        line = line.strip()
+
+        if not line or line[0] == "#":
+            continue
+
+        pvs += line.replace(",", " ").split()
+
+    return pvs
+
+
+def read_rules(text):
+    """
+    Reads placement rules, one "<pattern> <group path>" pair per line
+    """
+    rules = []
+    for line in text.splitlines():
+        split = line.split()
+
+        if not split or split[0][0] == "#":
+            continue
+
+        if len(split) != 2:
+            raise ValueError(f"Invalid placement rule: {line.strip()}")
+
+        rules.append(PlacementRule(split[0], split[1]))
+
+    return rules
+
+
+def place_pvs(pvnames, rules, default_group=None):
+    """
+    Assigns each PV to the group of the first matching rule. Group paths
+    may use the named groups of regular expression rules.
+
+    Returns a dictionary mapping group path to PV names and the list of PVs
+    that matched no rule. Unmatched PVs are placed in default_group instead
+    when one is given.
+    """
+    placements = {}
+    unmatched = []
+
+    for pvname in pvnames:
+        group_path = default_group
+
+        for rule in rules:
+            rule_group = rule.group_for(pvname)
+
+            if rule_group is not None:
+                group_path = rule_group
+                break
+
+        if group_path is None:
+            unmatched.append(pvname)
+
+        else:
+            placements.setdefault(group_path, []).append(pvname)
+
+    return placements, unmatched
+
+
+def add_pvs_to_nodes(nodes, placements):
+    """
+    Appends the placed PVs to a node list, creating missing groups. Existing
+    nodes are reused as groups even when they have no children yet, and PVs
+    already present in the configuration are skipped.
+
+    Returns the number of PVs added.
+    """
+    # index existing nodes by path, whether or not they have children
+    paths = {0: ""}
+    groups = {"": 0}
+    leaves = set(range(1, len(nodes))) - {parent_idx for _, parent_idx in nodes[1:]}
+
+    for idx, (data, parent_idx) in enumerate(nodes[1:], start=1):
+        path = data["label"]
+        if parent_idx:
+            path = f"{paths[parent_idx]}/{path}"
+
+        paths[idx] = path
+        groups.setdefault(path, idx)
+
+    # childless nodes on a placement path are groups that are about to be
+    # filled, the other ones are pvs
+    group_paths = set()
+    for group_path in placements:
+        while group_path and group_path not in group_paths:
+            group_paths.add(group_path)
+            group_path = group_path.rpartition("/")[0]
+
+    existing_pvs = set()
+    for idx in leaves:
+        if paths[idx] in group_paths:
+            # promote to a group, dropping pv properties
+            nodes[idx][0] = {"label": nodes[idx][0]["label"]}
+
+        else:
+            existing_pvs.add(nodes[idx][0]["label"])
+
+    added = 0
+    for group_path, pvnames in placements.items():
+        group_idx = _get_group(nodes, groups, group_path)
+
+        for pvname in pvnames:
+            if pvname in existing_pvs:
+                continue
+
+            existing_pvs.add(pvname)
+            nodes.append([{"label": pvname, "enabled": "true"}, group_idx])
+            added += 1
+
+    return added
+
+
+def _get_group(nodes, groups, group_path):
+    if group_path in groups:
+        return groups[group_path]
+
+    parent_path, _, label = group_path.rpartition("/")
+    parent_idx = _get_group(nodes, groups, parent_path)
+
+    nodes.append([{"label": label}, parent_idx])
+    groups[group_path] = len(nodes) - 1
+
+    return groups[group_path]
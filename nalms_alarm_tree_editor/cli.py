@@ -0,0 +1,240 @@
+"""
+Command line tools for alarm configurations. Nothing imported here may pull
+in Qt or PyDM, so that batch jobs start quickly.
+"""
+import argparse
+import sys
+
+
+def convert(args):
+    from nalms_alarm_tree_editor.alh_conversion import IncludeCycleError, convert_alh_to_phoebus
+
+    try:
+        convert_alh_to_phoebus(args.input_filename, args.output_filename, sharded=args.sharded)
+
+    except IncludeCycleError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+
+
+def to_alh(args):
+    from nalms_alarm_tree_editor.phoebus_conversion import convert_phoebus_to_alh
+
+    filenames = convert_phoebus_to_alh(args.input_filename, args.output_filename, split_includes=args.split_includes)
+    print(f"{len(filenames)} ALH files written", file=sys.stderr)
+
+
+def generate(args):
+    from nalms_alarm_tree_editor.bulk_import import read_rules
+    from nalms_alarm_tree_editor.db_generation import DEFAULT_RULES, generate_config, parse_macro_definitions
+
+    rules = DEFAULT_RULES
+    if args.rules:
+        with open(args.rules) as f:
+            rules = read_rules(f.read())
+
+    errors = []
+    pv_count, skipped = generate_config(args.directories, args.output_filename, rules=rules,
+                                        config_name=args.name, macros=parse_macro_definitions(args.macros or ""),
+                                        include_paths=args.include or (), workers=args.workers,
+                                        sharded=args.sharded, errors=errors)
+
+    for error in errors:
+        print(error, file=sys.stderr)
+
+    print(f"{pv_count} PVs written, {skipped} records with unexpanded macros skipped", file=sys.stderr)
+
+
+def summary(args):
+    from nalms_alarm_tree_editor.phoebus_config import PhoebusConfigTool
+
+    config_tool = PhoebusConfigTool()
+    nodes = config_tool.parse_config(args.filename)
+
+    # groups are the nodes referenced as a parent
+    parents = {parent_idx for _, parent_idx in nodes[1:]}
+    group_count = len([idx for idx in parents if idx != 0])
+    print(f"{nodes[0][0]['label']}: {group_count} groups, {len(nodes) - 1 - group_count} pvs")
+
+    if args.depth is not None:
+        from nalms_alarm_tree_editor.aggregates import SubtreeAggregates, format_totals
+
+        store = config_tool.store
+        aggregates = SubtreeAggregates.from_store(store)
+
+        for row, path in enumerate(store.paths()):
+            if store.is_group[row] and (row == 0 or path.count("/") <= args.depth):
+                print(f"{path}: {format_totals(aggregates.totals(row))}")
+
+
+def audit(args):
+    from nalms_alarm_tree_editor.alh_conversion import IncludeCycleError
+    from nalms_alarm_tree_editor.audit import audit as audit_pvs, config_pvnames
+
+    addresses = None
+    if args.address:
+        addresses = []
+        for address in args.address:
+            host, _, port = address.partition(":")
+            addresses.append((host, int(port or 5064)))
+
+    try:
+        pvnames = config_pvnames(args.filename)
+
+    except IncludeCycleError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+
+    report = audit_pvs(pvnames, addresses=addresses, concurrency=args.concurrency, timeout=args.timeout)
+
+    for pvname in report.disconnected:
+        print(pvname)
+
+    for error in report.errors:
+        print(f"Search error: {error}", file=sys.stderr)
+
+    print(report.summary(), file=sys.stderr)
+
+    if report.disconnected:
+        sys.exit(1)
+
+
+def query(args):
+    from nalms_alarm_tree_editor.phoebus_config import PhoebusConfigTool
+    from nalms_alarm_tree_editor.query import run_query, QuerySyntaxError
+
+    config_tool = PhoebusConfigTool()
+    config_tool.parse_config(args.filename)
+    store = config_tool.store
+
+    try:
+        rows = run_query(store, args.query, dry_run=args.dry_run)
+
+    except QuerySyntaxError as e:
+        print(f"Invalid query: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    if args.dry_run or args.query.split()[0].lower() == "select":
+        for row in rows:
+            print(store.path(row))
+
+        print(f"{len(rows)} nodes matched", file=sys.stderr)
+
+    else:
+        config_tool.save_store(args.output or args.filename)
+        print(f"{len(rows)} nodes updated", file=sys.stderr)
+
+
+def serve(args):
+    import asyncio
+    from nalms_alarm_tree_editor.service import DEFAULT_SOCKET, ConversionService, serve as serve_requests
+
+    if args.port is not None and not args.output_dir:
+        print("Serving on TCP requires --output-dir", file=sys.stderr)
+        sys.exit(2)
+
+    address = f"127.0.0.1:{args.port}" if args.port is not None else f"unix:{args.socket or DEFAULT_SOCKET}"
+    print(f"Serving on {address}", file=sys.stderr)
+
+    try:
+        asyncio.run(serve_requests(address, ConversionService(args.cache_size, args.output_dir), workers=args.workers))
+
+    except KeyboardInterrupt:
+        pass
+
+
+def shard(args):
+    import xml.etree.ElementTree as ET
+    from nalms_alarm_tree_editor.sharding import write_config_shards
+
+    written = write_config_shards(ET.parse(args.filename).getroot(), args.directory)
+    print(f"{written} shards written to {args.directory}", file=sys.stderr)
+
+
+def assemble(args):
+    from nalms_alarm_tree_editor.sharding import assemble as assemble_shards
+
+    assemble_shards(args.directory, args.output_filename)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="NALMS alarm configuration tools")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    convert_parser = subparsers.add_parser("convert", help="Convert an ALH configuration to Phoebus format")
+    convert_parser.add_argument("input_filename")
+    convert_parser.add_argument("output_filename")
+    convert_parser.add_argument("--sharded", action="store_true",
+                                help="write one file per top-level component, output_filename is a directory")
+    convert_parser.set_defaults(func=convert)
+
+    to_alh_parser = subparsers.add_parser("to-alh", help="Convert a Phoebus configuration to ALH format")
+    to_alh_parser.add_argument("input_filename")
+    to_alh_parser.add_argument("output_filename")
+    to_alh_parser.add_argument("--split-includes", action="store_true",
+                               help="write each top-level component to its own included file")
+    to_alh_parser.set_defaults(func=to_alh)
+
+    generate_parser = subparsers.add_parser("generate", help="Generate a Phoebus configuration from IOC databases")
+    generate_parser.add_argument("directories", nargs="+", help="directories to scan for .db and .substitutions files")
+    generate_parser.add_argument("-o", "--output", dest="output_filename", required=True)
+    generate_parser.add_argument("--rules", help='file of "<pattern> <group path>" lines matched against ioc/record')
+    generate_parser.add_argument("--name", help="configuration name (default: output file name)")
+    generate_parser.add_argument("--macros", help="macro definitions applied to every file, NAME=value,...")
+    generate_parser.add_argument("-I", "--include", action="append", help="template search directory, may be repeated")
+    generate_parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    generate_parser.add_argument("--sharded", action="store_true",
+                                 help="write one file per top-level component, the output is a directory")
+    generate_parser.set_defaults(func=generate)
+
+    summary_parser = subparsers.add_parser("summary", help="Print a summary of a Phoebus configuration")
+    summary_parser.add_argument("filename")
+    summary_parser.add_argument("--depth", type=int,
+                                help="also print pv totals for groups down to this depth")
+    summary_parser.set_defaults(func=summary)
+
+    audit_parser = subparsers.add_parser("audit", help="Check that every PV in a configuration is reachable")
+    audit_parser.add_argument("filename", help="Phoebus configuration or ALH .alhConfig file")
+    audit_parser.add_argument("--address", action="append",
+                              help="host[:port] to search, may be repeated (default: EPICS_CA_ADDR_LIST)")
+    audit_parser.add_argument("--concurrency", type=int, default=1000)
+    audit_parser.add_argument("--timeout", type=float, default=2.0, help="seconds allowed per PV")
+    audit_parser.set_defaults(func=audit)
+
+    query_parser = subparsers.add_parser("query", help="Select or bulk edit PVs with a query")
+    query_parser.add_argument("filename")
+    query_parser.add_argument("query", help='e.g. \'set delay=5 where path ~ "/LINAC/**/BPM*" and enabled=true\'')
+    query_parser.add_argument("--dry-run", action="store_true", help="list affected nodes without editing")
+    query_parser.add_argument("-o", "--output", help="output file (default: edit in place)")
+    query_parser.set_defaults(func=query)
+
+    shard_parser = subparsers.add_parser("shard", help="Split a configuration into per-component shards")
+    shard_parser.add_argument("filename")
+    shard_parser.add_argument("directory")
+    shard_parser.set_defaults(func=shard)
+
+    assemble_parser = subparsers.add_parser("assemble", help="Join a sharded configuration into a single file")
+    assemble_parser.add_argument("directory")
+    assemble_parser.add_argument("output_filename")
+    assemble_parser.set_defaults(func=assemble)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the conversion and validation service")
+    serve_parser.add_argument("--socket", help="Unix socket path (default: nalms_service.sock in $XDG_RUNTIME_DIR or ~)")
+    serve_parser.add_argument("--port", type=int, help="serve on this localhost TCP port instead, requires --output-dir")
+    serve_parser.add_argument("--output-dir", help="directory convert requests may write to")
+    serve_parser.add_argument("--workers", type=int, default=4)
+    serve_parser.add_argument("--cache-size", type=int, default=32, help="number of parsed configurations to keep")
+    serve_parser.set_defaults(func=serve)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,631 @@
+"""
+Generation of alarm trees from EPICS IOC databases. Directories are scanned
+for .db and .substitutions files, which are tokenized and expanded on a pool
+of worker processes. Records with an alarm severity configured become PVs,
+placed in groups by rules on the IOC and record name, and the tree is
+written by the same builder as converted ALH configurations.
+"""
+import functools
+import os
+import re
+
+from nalms_alarm_tree_editor.bulk_import import PlacementRule
+
+
+DATABASE_EXTENSIONS = (".db", ".vdb")
+SUBSTITUTIONS_EXTENSIONS = (".substitutions", ".substitution")
+TEMPLATE_EXTENSIONS = (".template", ".db", ".vdb")
+
+# severity fields of analog, binary and multi-bit records
+SEVERITY_FIELDS = ("HHSV", "HSV", "LSV", "LLSV", "ZSV", "OSV", "COSV", "UNSV",
+                   "ZRSV", "ONSV", "TWSV", "THSV", "FRSV", "FVSV", "SXSV", "SVSV",
+                   "EISV", "NISV", "TESV", "ELSV", "TVSV", "TTSV", "FTSV", "FFSV")
+
+ALARM_SEVERITIES = ("MINOR", "MAJOR", "INVALID")
+
+ALARM_FIELDS = frozenset(SEVERITY_FIELDS + ("DESC",))
+
+# default layout, one group per IOC
+DEFAULT_RULES = (PlacementRule("*", "{ioc}"),)
+
+_TOKEN = re.compile(r'\s+|#[^\n]*|(?P<string>"(?:[^"\\]|\\.)*")|(?P<punct>[(){},=])'
+                    r'|(?P<word>(?:[^\s(){},="#$]|\$\([^)]*\)|\$\{[^}]*\}|\$)+)')
+
+_MACRO = re.compile(r"\$(?:\(([^(){}$]*)\)|\{([^(){}$]*)\})")
+
+_MACRO_NAME = re.compile(r"\$[({]([A-Za-z0-9_]+)")
+
+# nesting depth of macro references that is expanded
+_MAX_EXPANSIONS = 10
+
+
+class DatabaseSyntaxError(ValueError):
+    pass
+
+
+def tokenize(text, filename="<string>"):
+    """
+    Returns the strings, punctuation and words of a database or substitutions
+    file. Words may contain macro references.
+    """
+    tokens = []
+    position = 0
+
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            line = text.count("\n", 0, position) + 1
+            raise DatabaseSyntaxError(f"{filename}:{line}: unexpected {text[position]!r}")
+
+        kind = match.lastgroup
+        if kind == "string":
+            tokens.append(("word", re.sub(r"\\(.)", r"\1", match.group(kind)[1:-1])))
+
+        elif kind is not None:
+            tokens.append((kind, match.group(kind)))
+
+        position = match.end()
+
+    return tokens
+
+
+def expand_macros(text, macros):
+    """
+    Expands $(NAME), ${NAME} and $(NAME=default) references. References to
+    undefined macros without a default are left in place.
+    """
+    if "$" not in text:
+        return text
+
+    def replace(match):
+        reference = match.group(1) if match.group(1) is not None else match.group(2)
+        name, has_default, default = reference.partition("=")
+
+        if name in macros:
+            return macros[name]
+
+        if has_default:
+            return default
+
+        # keep the reference, marked so it isn't expanded again
+        return "\0" + match.group(0)[1:]
+
+    for _ in range(_MAX_EXPANSIONS):
+        expanded = _MACRO.sub(replace, text)
+        if expanded == text:
+            break
+
+        text = expanded
+
+    return text.replace("\0", "$")
+
+
+def parse_macro_definitions(text):
+    """
+    Parses "NAME=value,NAME2=value2" macro definitions
+    """
+    macros = {}
+    for definition in text.split(","):
+        name, _, value = definition.partition("=")
+
+        if name.strip():
+            macros[name.strip()] = value.strip()
+
+    return macros
+
+
+class _TokenReader:
+
+    def __init__(self, tokens, filename):
+        self.tokens = tokens
+        self.position = 0
+        self.filename = filename
+
+    def at_end(self):
+        return self.position >= len(self.tokens)
+
+    def peek(self):
+        return self.tokens[self.position][1] if not self.at_end() else None
+
+    def take(self, expected=None):
+        if self.at_end():
+            raise DatabaseSyntaxError(f"{self.filename}: unexpected end of file")
+
+        kind, value = self.tokens[self.position]
+        if expected is not None and value != expected:
+            raise DatabaseSyntaxError(f"{self.filename}: expected {expected!r}, found {value!r}")
+
+        self.position += 1
+        return value
+
+    def skip_block(self):
+        """
+        Skips a parenthesized or braced block starting at the current token
+        """
+        depth = 0
+        while True:
+            value = self.take()
+            depth += {"(": 1, "{": 1, ")": -1, "}": -1}.get(value, 0)
+
+            if depth == 0:
+                return
+
+
+def _may_alarm(value):
+    return "$" in value or value.upper() in ALARM_SEVERITIES
+
+
+class DatabaseTemplate:
+    """
+    The records of a database file with macros unexpanded. Only records with
+    a severity field that is, or may expand to, an alarm severity are kept,
+    with their description and those severity fields.
+    """
+
+    def __init__(self, records, includes):
+        # (record type, name, {field: value})
+        self.records = []
+        self.includes = includes
+
+        for record_type, name, fields in records:
+            severities = {field: value for field, value in fields.items()
+                          if field != "DESC" and _may_alarm(value)}
+
+            if severities:
+                if "DESC" in fields:
+                    severities["DESC"] = fields["DESC"]
+
+                self.records.append((record_type, name, severities))
+
+        used = set()
+        for record_type, name, fields in self.records:
+            for text in (name,) + tuple(fields.values()):
+                used.update(_MACRO_NAME.findall(text))
+
+        self.used_macros = tuple(sorted(used))
+
+
+def _parse_database_text(text, filename):
+    reader = _TokenReader(tokenize(text, filename), filename)
+    records = []
+    includes = []
+
+    while not reader.at_end():
+        keyword = reader.take()
+
+        if keyword in ("record", "grecord"):
+            reader.take("(")
+            record_type = reader.take()
+            reader.take(",")
+            name = reader.take()
+            reader.take(")")
+
+            fields = {}
+            if reader.peek() == "{":
+                reader.take("{")
+
+                while reader.peek() != "}":
+                    item = reader.take()
+
+                    if item == "field":
+                        reader.take("(")
+                        field = reader.take()
+                        reader.take(",")
+                        value = reader.take() if reader.peek() != ")" else ""
+                        reader.take(")")
+
+                        if field in ALARM_FIELDS:
+                            fields[field] = value
+
+                    elif reader.peek() == "(":
+                        # info, alias
+                        reader.skip_block()
+
+                reader.take("}")
+
+            records.append((record_type, name, fields))
+
+        elif keyword == "include":
+            includes.append(reader.take())
+
+        elif reader.peek() == "(":
+            # path, addpath, alias, menu, recordtype definitions
+            reader.skip_block()
+
+            if reader.peek() == "{":
+                reader.skip_block()
+
+    return records, includes
+
+
+@functools.lru_cache(maxsize=4096)
+def _load_template(filename, stamp):
+    with open(filename, encoding="utf8", errors="replace") as f:
+        records, includes = _parse_database_text(f.read(), filename)
+
+    return DatabaseTemplate(records, includes)
+
+
+def load_template(filename):
+    """
+    Returns the parsed DatabaseTemplate of a file. Files are parsed once per
+    process and reparsed when they change.
+    """
+    stat = os.stat(filename)
+    return _load_template(filename, (stat.st_mtime_ns, stat.st_size))
+
+
+class TemplateResolver:
+    """
+    Finds database files named in include directives and substitutions
+    files. Names are tried relative to the including file, then in the
+    include paths, then by file name anywhere in the scanned directories.
+    """
+
+    def __init__(self, include_paths=(), index=None):
+        self.include_paths = list(include_paths)
+        # file name -> path
+        self.index = index or {}
+        self._resolved = {}
+
+    def resolve(self, name, including_file):
+        key = (name, os.path.dirname(including_file))
+        path = self._resolved.get(key)
+
+        if path is None:
+            path = self._resolve(name, including_file)
+            self._resolved[key] = path
+
+        return path
+
+    def _resolve(self, name, including_file):
+        for directory in [os.path.dirname(including_file)] + self.include_paths:
+            path = os.path.join(directory, name)
+
+            if os.path.isfile(path):
+                return os.path.normpath(path)
+
+        path = self.index.get(os.path.basename(name))
+        if path is None:
+            raise FileNotFoundError(f"{including_file}: can't find {name}")
+
+        return path
+
+
+class AlarmRecord:
+
+    def __init__(self, ioc, name, record_type, description, severities):
+        self.ioc = ioc
+        self.name = name
+        self.record_type = record_type
+        self.description = description
+        # severity field -> severity, for alarm severities only
+        self.severities = severities
+
+
+@functools.lru_cache(maxsize=65536)
+def _expand_template(filename, stamp, macro_values):
+    template = _load_template(filename, stamp)
+    macros = dict(macro_values)
+    records = []
+
+    for record_type, name, fields in template.records:
+        severities = {}
+        for field, value in fields.items():
+            if field == "DESC":
+                continue
+
+            value = expand_macros(value, macros).upper()
+            if value in ALARM_SEVERITIES:
+                severities[field] = value
+
+        if severities:
+            description = fields.get("DESC")
+            records.append((record_type, expand_macros(name, macros),
+                            expand_macros(description, macros) if description else None, severities))
+
+    return records
+
+
+def expand_database(filename, macros, resolver, include_chain=()):
+    """
+    Returns (record type, name, description, severities) for each record of
+    a database file and its includes that raises alarms, with macros
+    expanded. Expansions are
+    cached on the values of the macros the file actually uses.
+    """
+    stat = os.stat(filename)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    template = _load_template(filename, stamp)
+
+    macro_values = tuple((name, macros[name]) for name in template.used_macros if name in macros)
+    records = list(_expand_template(filename, stamp, macro_values))
+
+    for include in template.includes:
+        include_filename = resolver.resolve(expand_macros(include, macros), filename)
+
+        if include_filename in include_chain:
+            raise DatabaseSyntaxError(f"{filename}: include cycle through {include_filename}")
+
+        records += expand_database(include_filename, macros, resolver, include_chain + (filename,))
+
+    return records
+
+
+def parse_substitutions(filename):
+    """
+    Returns the (template name, macros) instances of a substitutions file
+    """
+    with open(filename, encoding="utf8", errors="replace") as f:
+        reader = _TokenReader(tokenize(f.read(), filename), filename)
+
+    instances = []
+    global_macros = {}
+
+    def read_macro_block():
+        # { A=1, B=2 } or, after pattern, { 1, 2 }
+        values = []
+        reader.take("{")
+
+        while reader.peek() != "}":
+            token = reader.take()
+
+            if token == ",":
+                continue
+
+            if reader.peek() == "=":
+                reader.take("=")
+                value = reader.take() if reader.peek() not in (",", "}") else ""
+                values.append((token, value))
+
+            else:
+                values.append(token)
+
+        reader.take("}")
+        return values
+
+    while not reader.at_end():
+        keyword = reader.take()
+
+        if keyword == "global":
+            global_macros.update(read_macro_block())
+            continue
+
+        template_name = reader.take() if keyword == "file" else keyword
+        reader.take("{")
+        pattern = None
+
+        while reader.peek() != "}":
+            if reader.peek() == "global":
+                reader.take()
+                global_macros.update(read_macro_block())
+
+            elif reader.peek() == "pattern":
+                reader.take()
+                pattern = read_macro_block()
+
+            else:
+                values = read_macro_block()
+                macros = dict(global_macros)
+
+                if pattern is not None:
+                    macros.update(zip(pattern, values))
+
+                else:
+                    macros.update(values)
+
+                instances.append((template_name, macros))
+
+        reader.take("}")
+
+    return instances
+
+
+def ioc_name(filename, root):
+    """
+    Returns the IOC a file belongs to: the nearest directory named ioc*,
+    else the first directory below the scanned root, else the root itself
+    """
+    relative = os.path.relpath(filename, root)
+    directories = relative.split(os.sep)[:-1]
+
+    for directory in reversed(directories):
+        if directory.lower().startswith("ioc") and directory.lower() != "iocboot":
+            return directory
+
+    if directories:
+        return directories[0]
+
+    return os.path.basename(os.path.abspath(root))
+
+
+def scan_file(filename, ioc, macros, resolver):
+    """
+    Returns the alarm records of a database or substitutions file and the
+    number of them skipped because their names still contain unexpanded
+    macros
+    """
+    records = []
+
+    if filename.endswith(SUBSTITUTIONS_EXTENSIONS):
+        for template_name, instance_macros in parse_substitutions(filename):
+            template_filename = resolver.resolve(expand_macros(template_name, macros), filename)
+            records += expand_database(template_filename, dict(macros, **instance_macros), resolver)
+
+    else:
+        records = expand_database(filename, macros, resolver)
+
+    alarm_records = []
+    skipped = 0
+    for record_type, name, description, severities in records:
+        if "$(" in name or "${" in name:
+            skipped += 1
+
+        else:
+            alarm_records.append(AlarmRecord(ioc, name, record_type, description, severities))
+
+    return alarm_records, skipped
+
+
+def find_database_files(directories):
+    """
+    Returns the database and substitutions files under the directories,
+    and an index of template file names to paths
+    """
+    files = []
+    index = {}
+
+    for root in directories:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+
+                if name.endswith(DATABASE_EXTENSIONS + SUBSTITUTIONS_EXTENSIONS):
+                    files.append((path, root))
+
+                if name.endswith(TEMPLATE_EXTENSIONS):
+                    index.setdefault(name, path)
+
+    return files, index
+
+
+# template index of the scan, set per worker process
+_resolver = None
+
+
+def _set_resolver(resolver):
+    global _resolver
+    _resolver = resolver
+
+
+def _safe_scan_batch(tasks):
+    results = []
+    for filename, ioc, macros in tasks:
+        try:
+            results.append(scan_file(filename, ioc, macros, _resolver))
+
+        except (OSError, DatabaseSyntaxError) as e:
+            results.append(e)
+
+    return results
+
+
+def scan_databases(directories, macros=None, include_paths=(), workers=None, errors=None):
+    """
+    Scans directories for alarm records. Files are processed in batches on a
+    process pool. Problems with individual files are added to errors when a
+    list is given and raised otherwise.
+
+    Returns the alarm records and the number of records skipped for
+    unexpanded macros.
+    """
+    files, index = find_database_files(directories)
+    resolver = TemplateResolver(include_paths, index)
+    tasks = [(filename, ioc_name(filename, root), macros or {}) for filename, root in files]
+
+    # batches amortize the cost of sending tasks to workers
+    batch_size = max(1, min(64, len(tasks) // (4 * (workers or os.cpu_count() or 1)) or 1))
+    batches = [tasks[start:start + batch_size] for start in range(0, len(tasks), batch_size)]
+
+    def run_batches(run):
+        return [result for batch_results in run(batches) for result in batch_results]
+
+    if len(batches) > 1 and workers != 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # the resolver's index is sent once per worker rather than per batch
+        with ProcessPoolExecutor(max_workers=workers, initializer=_set_resolver, initargs=(resolver,)) as pool:
+            results = run_batches(lambda batches: pool.map(_safe_scan_batch, batches))
+
+    else:
+        _set_resolver(resolver)
+        results = run_batches(lambda batches: map(_safe_scan_batch, batches))
+
+    alarm_records = []
+    skipped = 0
+    for result in results:
+        if isinstance(result, Exception):
+            if errors is None:
+                raise result
+
+            errors.append(str(result))
+            continue
+
+        alarm_records += result[0]
+        skipped += result[1]
+
+    return alarm_records, skipped
+
+
+def place_records(alarm_records, rules=DEFAULT_RULES, default_group="{ioc}"):
+    """
+    Returns a dictionary mapping group paths to alarm records. Rules are
+    matched against "<ioc>/<record name>" and their group paths may use
+    {ioc}, {record} and the named groups of regular expression rules.
+    """
+    placements = {}
+
+    for alarm_record in alarm_records:
+        key = f"{alarm_record.ioc}/{alarm_record.name}"
+        group_path = None
+
+        for rule in rules:
+            group_path = rule.group_for(key, ioc=alarm_record.ioc, record=alarm_record.name)
+
+            if group_path is not None:
+                break
+
+        if group_path is None:
+            group_path = default_group.format(ioc=alarm_record.ioc, record=alarm_record.name)
+
+        placements.setdefault(group_path.strip("/"), []).append(alarm_record)
+
+    return placements
+
+
+def add_placements(builder, placements, config_name):
+    """
+    Adds placed alarm records to an alh_conversion.XMLBuilder, in document
+    order. Top-level groups, such as the IOC groups, sit directly under the
+    configuration; records placed at the root go to a group named after it.
+    """
+    from nalms_alarm_tree_editor.alh_conversion import AlarmNode, AlarmLeaf
+
+    for group_path in sorted(placements, key=lambda path: path.split("/")):
+        labels = group_path.split("/") if group_path else [config_name]
+        parent = None
+
+        for depth, label in enumerate(labels, start=1):
+            path = "/".join(labels[:depth])
+
+            if path not in builder.groups:
+                builder.add_group(path, AlarmNode(label), parent_group=parent)
+
+            parent = path
+
+        for alarm_record in sorted(placements[group_path], key=lambda alarm_record: alarm_record.name):
+            leaf = AlarmLeaf(alarm_record.name)
+            leaf.alias = alarm_record.description or ""
+            builder.add_pv(alarm_record.name, parent, leaf)
+
+
+def generate_config(directories, output_filename, rules=DEFAULT_RULES, config_name=None, macros=None,
+                    include_paths=(), workers=None, sharded=False, errors=None):
+    """
+    Generates a Phoebus configuration from the IOC databases under the
+    directories. Returns the number of PVs written, a PV defined more than
+    once counting once, and the number of skipped records.
+    """
+    from nalms_alarm_tree_editor.alh_conversion import write_config_file
+
+    config_name = config_name or os.path.basename(output_filename.rstrip("/")).replace(".xml", "")
+    alarm_records, skipped = scan_databases(directories, macros=macros, include_paths=include_paths,
+                                            workers=workers, errors=errors)
+
+    placements = place_records(alarm_records, rules)
+    written = write_config_file(lambda builder: add_placements(builder, placements, config_name),
+                                config_name, output_filename, sharded=sharded)
+
+    return written, skipped
@@ -1,208 +1,432 @@
 import os
-import json
-from qtpy import QtCore
 from pydm import Display
-from pydm import exception
-from pydm.widgets import PyDMEmbeddedDisplay, PyDMAlarmTree
-from pydm.utilities import connection
+from pydm.widgets import PyDMAlarmTree
 
-from qtpy.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QTreeView, QTableWidgetItem, QCheckBox,
+from qtpy.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QCheckBox,
                             QAbstractItemView, QSpacerItem, QSizePolicy, QLineEdit, QToolBar, QAction,
-                            QDialogButtonBox, QPushButton, QMenu, QGridLayout, QTableWidget, QLabel, QApplication, QFileDialog)
-from qtpy.QtCore import Qt, Slot, QModelIndex, QItemSelection
+                            QDialogButtonBox, QPushButton, QGridLayout, QLabel, QApplication, QFileDialog,
+                            QPlainTextEdit, QMessageBox, QStyledItemDelegate)
+from qtpy.QtCore import Qt, Slot, Signal, QModelIndex, QThread
 from qtpy import QtCore, QtGui
-from qtpy.QtDesigner import QDesignerFormWindowInterface
 
-from nalms_alarm_tree_editor.alh_conversion import convert_alh_to_phoebus
+from nalms_alarm_tree_editor.phoebus_config import PhoebusConfigTool
+from nalms_alarm_tree_editor.bulk_import import read_pv_list, read_rules, place_pvs, add_pvs_to_nodes
+from nalms_alarm_tree_editor.audit import AuditCache, audit
+from nalms_alarm_tree_editor.property_store import PropertyStore, BOOL_PROPERTIES, TEXT_PROPERTIES
+from nalms_alarm_tree_editor.query import run_query, parse_query, QuerySyntaxError
+from nalms_alarm_tree_editor.sharding import MANIFEST
+from nalms_alarm_tree_editor.aggregates import SubtreeAggregates, pv_counts, format_totals
+from nalms_alarm_tree_editor.alarm_state import StateCoalescer, SeverityRollup, StateListener, open_state_source
+from nalms_alarm_tree_editor.node_store import NodeStore, StoredAggregates
 
-from collections import OrderedDict
-import xml.etree.ElementTree as ET
 
 
+def move_item(model, source, parent, row=-1):
+    """
+    Moves the item at source to row of parent by reparenting the existing
+    item, so its subtree is neither copied nor rebuilt. Views keep their
+    selection and expansion state through a single move notification.
+    Returns False if the move is not possible.
+    """
+    item = model.getItem(source)
+    old_parent = item.parent_item
+    new_parent = model.getItem(parent)
+
+    # an item can't be moved into its own subtree
+    ancestor = new_parent
+    while ancestor is not None:
+        if ancestor is item:
+            return False
+
+        ancestor = ancestor.parent_item
+
+    source_row = source.row()
+    if row < 0:
+        row = new_parent.child_count()
+
+    # rejects moves that leave the item in place
+    if not model.beginMoveRows(source.parent(), source_row, source_row, parent, row):
+        return False
+
+    if new_parent is old_parent and row > source_row:
+        row -= 1
+
+    if isinstance(model, StoredTreeModel):
+        model.store.move_node(item.node_id, new_parent.node_id, row)
 
-class PhoebusConfigTool:
+    else:
+        del old_parent.children[source_row]
+        new_parent.children.insert(row, item)
+        item.parent_item = new_parent
+
+    model.endMoveRows()
+
+    return True
+
+
+class AlarmTreeView(PyDMAlarmTree):
     """
-    Tool for building and parsing Phoebus configuration files
+    Alarm tree whose internal drops reparent the dragged item instead of
+    serializing and recreating it through mime data
+    """
+
+    def dropEvent(self, event):
+        if event.source() is not self:
+            super(AlarmTreeView, self).dropEvent(event)
+            return
+
+        model = self.model()
+        source = self.currentIndex()
+        target = self.indexAt(event.pos())
+        position = self.dropIndicatorPosition()
 
+        if not source.isValid():
+            event.ignore()
+            return
+
+        if position == QAbstractItemView.OnViewport or not target.isValid():
+            parent, row = QModelIndex(), -1
+
+        elif position == QAbstractItemView.OnItem and model.getItem(target).is_group:
+            parent, row = target, -1
+
+        elif position == QAbstractItemView.AboveItem:
+            parent, row = target.parent(), target.row()
+
+        else:
+            # below or onto a pv
+            parent, row = target.parent(), target.row() + 1
+
+        move_item(model, source, parent, row)
+
+        # the move is done, keep the view from removing the source row
+        event.setDropAction(Qt.IgnoreAction)
+        event.accept()
+
+
+class StoredItem:
     """
+    Handle on a node of a NodeStore with the attributes of a tree model
+    item. Handles hold only the node id; labels and properties are read
+    through the store's cache.
+    """
+    __slots__ = ("model", "node_id")
 
-    def __init__(self):
-        self._nodes = []
-        self._tree = None
-        self._root = None
+    def __init__(self, model, node_id):
+        self.model = model
+        self.node_id = node_id
 
-    def _clear(self):
-        self._tree = None
-        self._root = None
-        self._nodes = []
+    def __getattr__(self, name):
+        if name in BOOL_PROPERTIES or name in TEXT_PROPERTIES or name in ("label", "is_group"):
+            return getattr(self.model.store.node(self.node_id), name)
 
-    def parse_config(self, filename):
-        """
-        Parses a configuration file
-        """
-        #clear
-        self._clear()
+        raise AttributeError(name)
 
-        # parse filename
-        self._tree = ET.parse(filename)
-        self._root = self._tree.getroot()
+    @property
+    def parent_item(self):
+        parent = self.model.store.node(self.node_id).parent
+        return self.model.item(parent) if parent is not None else None
 
-        if self._root.tag == "config":
-            self._config_name = self._root.attrib["name"]
+    @property
+    def children(self):
+        return [self.model.item(child) for child in self.model.store.children(self.node_id)]
 
-            # add root item to tree
-            self._nodes.append([{"label": self._config_name}, None])
-            
-            for child in self._root:
-                if child.tag == "component":
-                    self._handle_group_parse(child, 0)
+    def child_count(self):
+        return self.model.store.child_count(self.node_id)
 
-                elif child.tag == "pv":
-                    self._handle_pv_parse(child, 0)
 
-        return self._nodes
+class StoredTreeModel(QtCore.QAbstractItemModel):
+    """
+    Tree model over a disk-backed NodeStore, with the interface of the
+    PyDM alarm tree model used by the editor. Rows are read from the store
+    as the view asks for them, so only visible and recently used nodes are
+    held in memory. Model indexes point at StoredItem handles, which are
+    kept for the life of the model because Qt may hold indexes to them.
+    """
 
+    def __init__(self, store, parent=None):
+        super(StoredTreeModel, self).__init__(parent)
+        self.store = store
+        self._items = {}
+        self._root_item = self.item(store.root)
 
-    def _build_data(self, elem):
-        data = {"label": elem.attrib.get("name")}
+    def item(self, node_id):
+        item = self._items.get(node_id)
 
-        for child in elem:
-            if child.tag == "description":
-                data["description"] = child.text
-            
-            elif child.tag == "enabled":
-                data["enabled"] = child.text
+        if item is None:
+            item = StoredItem(self, node_id)
+            self._items[node_id] = item
 
-            elif child.tag == "latching":
-                data["latching"] = child.text
+        return item
 
-            elif child.tag == "annunciating":
-                data["annunciating"] = child.text
+    def getItem(self, index):
+        if index.isValid():
+            return index.internalPointer()
 
-            elif child.tag == "delay":
-                data["delay"] = child.text
+        return self._root_item
 
-            elif child.tag == "count":
-                data["count"] = child.text
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() and parent.column() != 0:
+            return QModelIndex()
 
-            elif child.tag == "filter":
-                data["alarm_filter"] = child.text
+        children = self.store.children(self.getItem(parent).node_id)
+        if not 0 <= row < len(children) or column != 0:
+            return QModelIndex()
 
-            elif child.tag == "command":
-                pass # TODO
+        return self.createIndex(row, column, self.item(children[row]))
 
-            elif child.tag == "automated_action":
-                pass # TODO 
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
 
-        return data
+        parent = self.store.node(index.internalPointer().node_id).parent
+        if parent is None or parent == self.store.root:
+            return QModelIndex()
 
+        return self.createIndex(self.store.node(parent).position, 0, self.item(parent))
 
-    def _handle_pv_parse(self, pv, parent_idx):
-        data = self._build_data(pv)
-        self._nodes.append([data, parent_idx])
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
 
-    
-    def _handle_group_parse(self, group, parent_idx):
-        # add group
-        data = self._build_data(group)
-        self._nodes.append([data, parent_idx])
-        group_idx = len(self._nodes) - 1 
+        return self.store.child_count(self.getItem(parent).node_id)
 
-        for child in group:
-            if child.tag == "component":
-                self._handle_group_parse(child, group_idx)
+    def columnCount(self, parent=QModelIndex()):
+        return 1
 
-            elif child.tag == "pv":
-                self._handle_pv_parse(child, group_idx)
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
 
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self.getItem(index).label
 
-    def save_configuration(self, root_node, filename):
-        # disregard root and create new
-        self._build_config(root_node)
+        return None
 
-        with open (filename, "wb") as f : 
-            file_str = ET.tostring(self._tree, encoding='utf8')
-            f.write(file_str)
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemIsDropEnabled
 
-    
-    def _build_config(self, root_node):
-        # clear tree and start again
-        self._tree = ET.ElementTree()
-        self._tree = ET.Element("config", name=root_node.label)
+        return (Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+                | Qt.ItemIsDragEnabled | Qt.ItemIsDropEnabled)
 
-        for node in root_node.children:
-            
-            #if children, is a group
-            if node.child_count():
-                self._handle_group_add(node, self._tree)
+    def supportedDropActions(self):
+        return Qt.MoveAction
 
-            else:
-                self._handle_pv_add(node, self._tree)
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or not index.isValid():
+            return False
 
-    def _handle_property_add(self, elem, alarm_tree_item):
+        self.set_data(index, label=str(value))
+        return True
 
-        if alarm_tree_item.enabled is not None:
-            enabled = ET.SubElement(elem, "enabled")
-           
-            if alarm_tree_item.enabled:
-                enabled.text = 'true'
+    def set_data(self, index, role=Qt.EditRole, **properties):
+        item = self.getItem(index)
+        self.store.set_properties(item.node_id, **properties)
+        self.dataChanged.emit(index, index, [role])
 
-            else:
-                enabled.text = 'false'
+    def insertRows(self, row, count, parent=QModelIndex()):
+        parent_item = self.getItem(parent)
 
-        if alarm_tree_item.latching is not None:
-            latching = ET.SubElement(elem, "latching")
+        self.beginInsertRows(parent, row, row + count - 1)
+        for position in range(row, row + count):
+            self.store.insert_node(parent_item.node_id, position, "")
 
-            if alarm_tree_item.latching:
-                latching.text = 'true'
+        self.endInsertRows()
+        return True
 
-            else:
-                latching.text = 'false'
+    def removeRows(self, row, count, parent=QModelIndex()):
+        children = self.store.children(self.getItem(parent).node_id)
+        if row < 0 or count < 1 or row + count > len(children):
+            return False
 
-        if alarm_tree_item.annunciating is not None:
-            annunciating = ET.SubElement(elem, "annunciating")
+        children = children[row:row + count]
 
-            if alarm_tree_item.annunciating:
-                annunciating.text = 'true'
+        self.beginRemoveRows(parent, row, row + count - 1)
+        for child in children:
+            self.store.remove_node(child)
 
-            else:
-                annunciating.text = 'false'
+        self.endRemoveRows()
+        return True
+
+    def add_pvs(self, placements):
+        self.beginResetModel()
+        added = self.store.add_pvs(placements)
+        self.endResetModel()
+
+        return added
+
+    def set_many(self, node_ids, role=Qt.EditRole, **properties):
+        """
+        Sets the same properties on many nodes in one transaction. Only the
+        items a view has seen can be displayed, so only their rows are
+        reported as changed.
+        """
+        self.store.set_many(node_ids, **properties)
+
+        for node_id in node_ids:
+            item = self._items.get(node_id)
+
+            if item is not None:
+                index = self.createIndex(self.store.node(node_id).position, 0, item)
+                self.dataChanged.emit(index, index, [role])
+
+
+# role of the dataChanged notifications sent for live severity updates
+SEVERITY_ROLE = Qt.UserRole + 100
 
+# background colors of the live severities
+SEVERITY_COLORS = {
+    "MINOR_ACK": (255, 230, 150),
+    "MAJOR_ACK": (255, 150, 150),
+    "INVALID_ACK": (255, 150, 255),
+    "UNDEFINED_ACK": (220, 150, 220),
+    "MINOR": (255, 200, 0),
+    "MAJOR": (255, 0, 0),
+    "INVALID": (255, 0, 255),
+    "UNDEFINED": (200, 0, 200),
+}
 
-        if alarm_tree_item.description:
-            description = ET.SubElement(elem, "description")
-            description.text = alarm_tree_item.description
 
+class AlarmStateOverlay(QtCore.QObject):
+    """
+    Live severity of the tree's items from the alarm state topic. Messages
+    are coalesced by PV on the listener thread and applied at most once per
+    frame, with one dataChanged per contiguous range of changed rows.
+    """
+    FRAME_INTERVAL = 16
+
+    def __init__(self, model, url, config_name, parent=None):
+        super(AlarmStateOverlay, self).__init__(parent)
+        self.model = model
+        self.coalescer = StateCoalescer()
+        self.rollup = SeverityRollup(lambda item: item.parent_item)
+        self.listener = StateListener(open_state_source(url, config_name), self.coalescer)
+
+        # latest severity by path, reapplied when the tree changes
+        self._states = {}
+        self._items = None
+        self._rows = None
 
-        if alarm_tree_item.delay:
-            delay = ET.SubElement(elem, "delay")
-            delay.text = alarm_tree_item.delay
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(self.FRAME_INTERVAL)
+        self.timer.timeout.connect(self.apply_updates)
 
-        if alarm_tree_item.count:
-            count = ET.SubElement(elem, "count")
-            count.text = alarm_tree_item.count
+        model.modelReset.connect(self.invalidate)
+        model.rowsInserted.connect(self.invalidate)
+        model.rowsRemoved.connect(self.invalidate)
+        model.rowsMoved.connect(self.invalidate)
 
-        if alarm_tree_item.alarm_filter:
-            alarm_filter = ET.SubElement(elem, "filter")
-            alarm_filter.text = alarm_tree_item.alarm_filter
+    def start(self):
+        self.listener.start()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.listener.stop()
+
+    def severity(self, item):
+        return self.rollup.severity(item)
+
+    @Slot()
+    def invalidate(self, *args):
+        self._items = None
+        self._rows = None
 
-    def _handle_group_add(self, group, parent):
-        group_comp = ET.SubElement(parent, 'component', name=group.label)
+    def _index_items(self):
+        root = self.model._root_item
+        self._items = {}
+        self._rows = {}
 
-        # don't add properties for group
-        for child in group.children:
+        to_process = [(root, "/" + root.label)]
+        while to_process:
+            item, path = to_process.pop()
+            self._items[path] = item
 
-            if child.child_count():
-                self._handle_group_add(child, group_comp)
+            for row, child in enumerate(item.children):
+                self._rows[child] = row
+                to_process.append((child, f"{path}/{child.label}"))
+
+    @Slot()
+    def apply_updates(self):
+        updates = self.coalescer.drain()
+
+        if self._items is None:
+            # items moved or changed, roll up every known state again
+            self._index_items()
+            self.rollup.clear()
+            updates = dict(self._states, **updates)
+
+        if not updates:
+            return
+
+        changed = set()
+        for path, severity in updates.items():
+            if severity is None:
+                self._states.pop(path, None)
 
             else:
-                self._handle_pv_add(child, group_comp)
+                self._states[path] = severity
+
+            item = self._items.get(path)
 
+            # group severities are rolled up here rather than taken from the server
+            if item is not None and not item.child_count():
+                changed.update(self.rollup.set(item, severity))
 
-    def _handle_pv_add(self, pv, parent):
-        pv_comp = ET.SubElement(parent, 'pv', name=pv.label)
-        self._handle_property_add(pv_comp, pv)
+        self._emit_changed(changed)
 
+    def _emit_changed(self, items):
+        rows_by_parent = {}
+        for item in items:
+            if item.parent_item is not None:
+                rows_by_parent.setdefault(item.parent_item, []).append(self._rows[item])
+
+        last_column = self.model.columnCount(QModelIndex()) - 1
+        parent_indexes = {}
+
+        for parent, rows in rows_by_parent.items():
+            parent_index = self._index(parent, parent_indexes)
+            rows.sort()
+
+            first = previous = rows[0]
+            for row in rows[1:] + [None]:
+                if row != previous + 1:
+                    self.model.dataChanged.emit(self.model.index(first, 0, parent_index),
+                                                self.model.index(previous, last_column, parent_index),
+                                                [SEVERITY_ROLE])
+                    first = row
+
+                previous = row
+
+    def _index(self, item, cache):
+        if item.parent_item is None:
+            return QModelIndex()
+
+        index = cache.get(item)
+        if index is None:
+            index = self.model.index(self._rows[item], 0, self._index(item.parent_item, cache))
+            cache[item] = index
+
+        return index
+
+
+class SeverityDelegate(QStyledItemDelegate):
+    """
+    Paints the live severity of each item behind its label
+    """
+
+    def __init__(self, overlay, parent=None):
+        super(SeverityDelegate, self).__init__(parent)
+        self.overlay = overlay
+
+    def initStyleOption(self, option, index):
+        super(SeverityDelegate, self).initStyleOption(option, index)
+        severity = self.overlay.severity(self.overlay.model.getItem(index))
+
+        if severity in SEVERITY_COLORS:
+            option.backgroundBrush = QtGui.QBrush(QtGui.QColor(*SEVERITY_COLORS[severity]))
+            option.text = f"{option.text} [{severity}]"
 
 
 class AlarmTreeEditorDisplay(Display):
@@ -219,12 +443,16 @@ class AlarmTreeEditorDisplay(Display):
         self.remove_button.clicked.connect(self.removeItem)
         self.remove_button.setEnabled(True)
 
+        # query console
+        self.preview_query_button.clicked.connect(self.preview_query)
+        self.apply_query_button.clicked.connect(self.apply_query)
+        self.query_edit.returnPressed.connect(self.preview_query)
+
         # connect save changes
         self.button_box.accepted.connect(self.save_property_changes)
 
         # upon tree view selection, change the item view
         self.tree_view.selectionModel().selectionChanged.connect(self.handle_selection)
-        self.tree_view.tree_model.dataChanged.connect(self.item_change)
 
         self.file_dialog = QFileDialog()
         self.open_config_action = QAction("Open", self)
@@ -235,6 +463,32 @@ class AlarmTreeEditorDisplay(Display):
         self.save_config_action.triggered.connect(self.save_configuration)
         self.toolbar.addAction(self.save_config_action)
 
+        self.save_sharded_action = QAction("Save Sharded", self)
+        self.save_sharded_action.triggered.connect(self.save_sharded_configuration)
+        self.toolbar.addAction(self.save_sharded_action)
+
+        self.import_pvs_action = QAction("Import PVs", self)
+        self.import_pvs_action.triggered.connect(self.import_pvs)
+        self.toolbar.addAction(self.import_pvs_action)
+
+        self.audit_action = QAction("Audit PVs", self)
+        self.audit_action.triggered.connect(self.audit_pvs)
+        self.toolbar.addAction(self.audit_action)
+        self.audit_cache = AuditCache()
+        self.audit_thread = None
+
+        self.disk_store_action = QAction("Disk-Backed", self)
+        self.disk_store_action.setCheckable(True)
+        self.disk_store_action.setToolTip("Open configurations into an on-disk store, keeping memory use bounded")
+        self.toolbar.addAction(self.disk_store_action)
+
+        self.live_state_action = QAction("Live State", self)
+        self.live_state_action.setCheckable(True)
+        self.live_state_action.toggled.connect(self.toggle_live_state)
+        self.toolbar.addAction(self.live_state_action)
+        self.state_overlay = None
+        self._default_delegate = self.tree_view.itemDelegate()
+
         # update configuration name
         self.tree_label.editingFinished.connect(self._update_config_name)
 
@@ -243,6 +497,66 @@ class AlarmTreeEditorDisplay(Display):
 
         self.config_tool = PhoebusConfigTool()
 
+        # pv totals of each group, updated along the ancestors of each edit
+        self.aggregates = SubtreeAggregates(lambda item: item.parent_item)
+        self._moving_items = []
+
+        # property store of the model's items for queries, kept in step with
+        # data edits and rebuilt after structural changes
+        self._query_store = None
+        self._query_items = []
+        self._query_rows = {}
+
+        # the PyDM model, replaced by a StoredTreeModel for disk-backed configurations
+        self._item_model = self.tree_view.model()
+        self._connect_model(self._item_model)
+        self._rebuild_aggregates()
+
+
+    def _connect_model(self, model):
+        # track edits for incremental saves
+        model.dataChanged.connect(self._data_changed)
+        model.rowsInserted.connect(self._mark_rows_dirty)
+        model.rowsRemoved.connect(self._mark_rows_dirty)
+        model.rowsMoved.connect(self._mark_rows_moved)
+        model.modelReset.connect(self.config_tool.invalidate)
+
+        model.rowsInserted.connect(self._invalidate_query_store)
+        model.rowsRemoved.connect(self._invalidate_query_store)
+        model.rowsMoved.connect(self._invalidate_query_store)
+        model.modelReset.connect(self._invalidate_query_store)
+
+        model.modelReset.connect(self._rebuild_aggregates)
+        model.rowsInserted.connect(self._aggregate_rows_inserted)
+        model.rowsAboutToBeRemoved.connect(self._aggregate_rows_removing)
+        model.rowsRemoved.connect(self._aggregate_rows_removed)
+        model.rowsAboutToBeMoved.connect(self._aggregate_rows_moving)
+        model.rowsMoved.connect(self._aggregate_rows_moved)
+
+    def _set_model(self, model):
+        """
+        Shows model in the tree view, closing the store of a replaced
+        disk-backed model
+        """
+        previous = self.tree_view.model()
+        if model is previous:
+            return
+
+        if self.live_state_action.isChecked():
+            self.live_state_action.setChecked(False)
+
+        self.tree_view.setModel(model)
+        self.tree_view.selectionModel().selectionChanged.connect(self.handle_selection)
+        self._rebuild_aggregates()
+        self._invalidate_query_store()
+
+        if isinstance(previous, StoredTreeModel):
+            previous.store.close()
+            previous.deleteLater()
+
+    def _stored_model(self):
+        model = self.tree_view.model()
+        return model if isinstance(model, StoredTreeModel) else None
 
     def setup_ui(self):
         self.main_layout = QGridLayout()
@@ -254,7 +568,7 @@ class AlarmTreeEditorDisplay(Display):
 
         # create the tree view layout and add/remove buttons
         self.tree_view_layout = QVBoxLayout()
-        self.tree_view = PyDMAlarmTree(self, config_name="UNITITLED", edit_mode=True)
+        self.tree_view = AlarmTreeView(self, config_name="UNITITLED", edit_mode=True)
         self.tree_view.setEditTriggers(QAbstractItemView.DoubleClicked)
         self.tree_view.setSelectionMode(QAbstractItemView.SingleSelection)
         self.tree_view.setSelectionBehavior(QAbstractItemView.SelectRows)
@@ -292,6 +606,19 @@ class AlarmTreeEditorDisplay(Display):
         self.add_remove_layout.addWidget(self.remove_button)
         self.tree_view_layout.addLayout(self.add_remove_layout)
 
+        # query console for bulk edits
+        self.query_layout = QHBoxLayout()
+        self.query_edit = QLineEdit()
+        self.query_edit.setPlaceholderText('set delay=5 where path ~ "/AREA/**" and enabled=true')
+        self.query_layout.addWidget(self.query_edit)
+        self.preview_query_button = QPushButton("Preview", self)
+        self.query_layout.addWidget(self.preview_query_button)
+        self.apply_query_button = QPushButton("Apply", self)
+        self.query_layout.addWidget(self.apply_query_button)
+        self.tree_view_layout.addLayout(self.query_layout)
+        self.query_result_label = QLabel("")
+        self.tree_view_layout.addWidget(self.query_result_label)
+
         # add the tree view to the window
         self.main_layout.addLayout(self.tree_view_layout, 0, 0)
 
@@ -357,6 +684,11 @@ class AlarmTreeEditorDisplay(Display):
 
         self.property_layout.addLayout(self.property_view_layout)
 
+        # pv totals of the selected group
+        self.totals_label = QLabel("")
+        self.totals_label.setWordWrap(True)
+        self.property_layout.addWidget(self.totals_label)
+
         # TODO: command, automated actions tables
         self.main_layout.addLayout(self.property_layout, 0, 1)
 
@@ -421,6 +753,7 @@ class AlarmTreeEditorDisplay(Display):
         self.delay_edit.setText(item.delay)
         self.count_edit.setText(item.count)
         self.filter_edit.setText(item.alarm_filter)
+        self._show_totals()
 
 
         if item.is_group:
@@ -516,7 +849,8 @@ class AlarmTreeEditorDisplay(Display):
         except Exception:
             folder = os.getcwd()
 
-        filename = QFileDialog.getOpenFileName(self, 'Open File...', folder, 'XML (*.xml);; ALH Config (*.alhConfig)')
+        filename = QFileDialog.getOpenFileName(self, 'Open File...', folder,
+                                               'XML (*.xml);; ALH Config (*.alhConfig);; Sharded Config (manifest.json)')
         filename = filename[0] if isinstance(filename, (list, tuple)) else filename
 
         if filename:
@@ -536,11 +870,206 @@ class AlarmTreeEditorDisplay(Display):
 
 
     def import_configuration(self, filename):
-        nodes = self.config_tool.parse_config(filename)
+        if self.disk_store_action.isChecked():
+            if os.path.basename(filename) == MANIFEST:
+                store = NodeStore.from_manifest(os.path.dirname(filename))
+
+            else:
+                store = NodeStore.from_file(filename)
+
+            # release the items and parsed store of a configuration opened in memory
+            self._item_model.import_hierarchy([[{"label": "Untitled"}, None]])
+            self.config_tool._clear()
+
+            model = StoredTreeModel(store, self)
+            self._connect_model(model)
+            self._set_model(model)
+            self.tree_label.setText(store.node(store.root).label)
+            return
+
+        self._set_model(self._item_model)
+
+        if os.path.basename(filename) == MANIFEST:
+            nodes = self.config_tool.parse_sharded(os.path.dirname(filename))
+
+        else:
+            nodes = self.config_tool.parse_config(filename)
+
         self.tree_view.model().import_hierarchy(nodes)
+        self.config_tool.bind_items(self.tree_view.model()._nodes)
         self.tree_label.setText(self.tree_view.model()._nodes[0].label)
 
 
+    @Slot()
+    def import_pvs(self):
+        dialog = BulkImportWindow(self)
+
+        if dialog.exec_():
+            model = self.tree_view.model()
+
+            if self._stored_model() is not None:
+                model.add_pvs(dialog.placements)
+                return
+
+            nodes = self.config_tool.build_nodes(model._root_item)
+            added = add_pvs_to_nodes(nodes, dialog.placements)
+
+            # single model reset instead of a row insertion per pv
+            if added:
+                model.import_hierarchy(nodes)
+                self.config_tool.bind_items(model._nodes)
+
+
+    def _get_query_store(self):
+        if self._query_store is None:
+            root = self.tree_view.model()._root_item
+            self._query_store = PropertyStore.from_nodes(self.config_tool.build_nodes(root))
+
+            # items in the document order of the store rows, with their row under their parent
+            self._query_items = [(root, 0)]
+            to_process = [(child, position) for position, child in reversed(list(enumerate(root.children)))]
+
+            while to_process:
+                item, position = to_process.pop()
+                self._query_items.append((item, position))
+                to_process += [(child, position) for position, child in reversed(list(enumerate(item.children)))]
+
+            self._query_rows = {item: row for row, (item, _) in enumerate(self._query_items)}
+
+        return self._query_store
+
+    def _invalidate_query_store(self, *args):
+        self._query_store = None
+        self._query_items = []
+        self._query_rows = {}
+
+    def _refresh_query_row(self, item):
+        row = self._query_rows.get(item)
+        if row is None:
+            return
+
+        store = self._query_store
+        if store.label[row] != item.label:
+            # paths of the item's subtree change
+            self._invalidate_query_store()
+            return
+
+        if store.is_group[row]:
+            return
+
+        for prop in BOOL_PROPERTIES:
+            value = getattr(item, prop)
+            if store.bools[prop][row] != (-1 if value is None else int(bool(value))):
+                store.set_property(row, prop, None if value is None else ("true" if value else "false"))
+
+        for prop in TEXT_PROPERTIES:
+            value = getattr(item, prop) or None
+            if store.texts[prop][row] != value:
+                store.set_property(row, prop, value)
+
+    def _query_index(self, row, indexes):
+        # model index of a query store row, built from the indexes of its ancestors
+        if row == 0:
+            return QModelIndex()
+
+        index = indexes.get(row)
+        if index is None:
+            parent_index = self._query_index(self._query_store.parent[row], indexes)
+            index = self.tree_view.model().index(self._query_items[row][1], 0, parent_index)
+            indexes[row] = index
+
+        return index
+
+    def _run_query(self, dry_run):
+        model = self.tree_view.model()
+
+        try:
+            if self._stored_model() is not None:
+                # evaluated in SQL, the model applies the assignments
+                store = model.store
+                rows = store.select(parse_query(self.query_edit.text()))
+
+            else:
+                store = self._get_query_store()
+                rows = run_query(store, self.query_edit.text(), dry_run=dry_run)
+
+        except QuerySyntaxError as e:
+            self.query_result_label.setText(f"Invalid query: {e}")
+            return None, []
+
+        return store, rows
+
+    @Slot()
+    def preview_query(self):
+        _, rows = self._run_query(dry_run=True)
+
+        if rows:
+            self.query_result_label.setText(f"{len(rows)} nodes affected")
+
+        elif self.query_edit.text():
+            self.query_result_label.setText("No matching nodes")
+
+    @Slot()
+    def apply_query(self):
+        store, rows = self._run_query(dry_run=False)
+
+        if store is None:
+            return
+
+        if not rows:
+            self.query_result_label.setText("No matching nodes")
+
+        elif parse_query(self.query_edit.text()).action == "set":
+            model = self.tree_view.model()
+            assignments = parse_query(self.query_edit.text()).assignments
+
+            if self._stored_model() is not None:
+                model.set_many(rows, **assignments)
+                # totals change even when no changed row is visible
+                self._show_totals()
+
+            else:
+                # edit the matched items in place, keeping expansion and selection
+                indexes = {}
+
+                for row in rows:
+                    model.set_data(self._query_index(row, indexes), role=Qt.EditRole, **assignments)
+
+            self.query_result_label.setText(f"{len(rows)} nodes updated")
+
+    @Slot()
+    def audit_pvs(self):
+        if self.audit_thread is not None and self.audit_thread.isRunning():
+            return
+
+        if self._stored_model() is not None:
+            pvnames = list(self._stored_model().store.pvnames())
+
+        else:
+            nodes = self.config_tool.build_nodes(self.tree_view.model()._root_item)
+            parents = {parent_idx for _, parent_idx in nodes[1:]}
+            pvnames = [data["label"] for idx, (data, _) in enumerate(nodes) if idx and idx not in parents]
+
+        self.audit_action.setEnabled(False)
+        self.audit_thread = AuditThread(pvnames, self.audit_cache, parent=self)
+        self.audit_thread.audit_complete.connect(self._show_audit_report)
+        self.audit_thread.start()
+
+    @Slot(object)
+    def _show_audit_report(self, report):
+        self.audit_action.setEnabled(True)
+
+        message = QMessageBox(self)
+        message.setWindowTitle("PV Audit")
+        message.setText(report.summary())
+
+        if report.disconnected or report.errors:
+            message.setDetailedText("\n".join(report.disconnected
+                                               + [f"Search error: {error}" for error in report.errors]))
+
+        message.exec_()
+
+
     @Slot()
     def save_configuration(self):
         modifiers = QApplication.keyboardModifiers()
@@ -553,13 +1082,172 @@ class AlarmTreeEditorDisplay(Display):
         filename = QFileDialog.getSaveFileName(self, 'Save File...', folder, 'Configration files (*.xml)')
         filename = filename[0] if isinstance(filename, (list, tuple)) else filename
 
-        self.config_tool.save_configuration(self.tree_view.model()._root_item, filename)
+        if not filename:
+            return
+
+        if self._stored_model() is not None:
+            self.config_tool.save_node_store(self._stored_model().store, filename)
+
+        else:
+            self.config_tool.save_configuration(self.tree_view.model()._root_item, filename)
+
+    @Slot()
+    def save_sharded_configuration(self):
+        if self._stored_model() is not None:
+            QMessageBox.information(self, "Save Sharded", "Disk-backed configurations are saved as a single file, "
+                                    "which the shard command line tool can split.")
+            return
+
+        directory = QFileDialog.getExistingDirectory(self, 'Save Sharded Configuration...', os.getcwd())
+
+        if directory:
+            self.config_tool.save_sharded(self.tree_view.model()._root_item, str(directory))
 
     def _update_config_name(self):
         name = self.tree_label.text()
+
+        if self._stored_model() is not None:
+            store = self._stored_model().store
+            store.set_properties(store.root, label=name)
+            return
+
         self.tree_view.model()._nodes[0].label = name
+        self.config_tool.mark_dirty(self.tree_view.model()._nodes[0])
+
+    @Slot(QModelIndex, QModelIndex, "QVector<int>")
+    def _data_changed(self, top_left, bottom_right, roles=()):
+        # live severity changes don't touch the configuration
+        if roles and all(role == SEVERITY_ROLE for role in roles):
+            return
+
+        self.item_change()
+        self._mark_data_dirty(top_left, bottom_right)
+        self._update_aggregates(top_left, bottom_right)
+        self._refresh_query_row(self.tree_view.model().getItem(top_left))
+
+    @Slot(QModelIndex, QModelIndex)
+    def _mark_data_dirty(self, top_left, bottom_right):
+        self.config_tool.mark_dirty(self.tree_view.model().getItem(top_left))
+
+    @Slot(QModelIndex, int, int)
+    def _mark_rows_dirty(self, parent, first, last):
+        self.config_tool.mark_dirty(self.tree_view.model().getItem(parent))
+
+    @Slot(QModelIndex, int, int, QModelIndex, int)
+    def _mark_rows_moved(self, source_parent, first, last, destination_parent, row):
+        model = self.tree_view.model()
+        self.config_tool.mark_dirty(model.getItem(source_parent))
+        self.config_tool.mark_dirty(model.getItem(destination_parent))
+
+    def _item_counts(self, item):
+        # items without children are pvs
+        if item.child_count() or item is self.tree_view.model()._root_item:
+            return None
+
+        return pv_counts(item.enabled, item.latching, item.annunciating, item.alarm_filter)
+
+    def _refresh_aggregate_item(self, item):
+        counts = self._item_counts(item)
+
+        if counts is not None:
+            self.aggregates.set_pv(item, counts)
+
+        elif self.aggregates.is_pv(item):
+            self.aggregates.remove_pv(item)
+
+    def _show_totals(self):
+        model = self.tree_view.model()
+        item = model.getItem(self.tree_view.selectionModel().currentIndex())
+
+        if self.aggregates.is_pv(item):
+            self.totals_label.setText("")
+
+        else:
+            self.totals_label.setText(format_totals(self.aggregates.totals(item)))
+
+    @Slot()
+    def _rebuild_aggregates(self):
+        if self._stored_model() is not None:
+            # the store keeps its own totals
+            self.aggregates = StoredAggregates(self._stored_model().store)
+            self._show_totals()
+            return
+
+        self.aggregates = SubtreeAggregates(lambda item: item.parent_item)
+        self.aggregates.add_tree(self.tree_view.model()._root_item, lambda item: item.children, self._item_counts)
+        self._show_totals()
+
+    @Slot(QModelIndex, QModelIndex)
+    def _update_aggregates(self, top_left, bottom_right):
+        self._refresh_aggregate_item(self.tree_view.model().getItem(top_left))
+        self._show_totals()
+
+    @Slot(QModelIndex, int, int)
+    def _aggregate_rows_inserted(self, parent, first, last):
+        parent_item = self.tree_view.model().getItem(parent)
+        self._refresh_aggregate_item(parent_item)
+
+        for child in parent_item.children[first:last + 1]:
+            self.aggregates.add_tree(child, lambda item: item.children, self._item_counts)
+            self.aggregates.attach(child)
+
+        self._show_totals()
+
+    @Slot(QModelIndex, int, int)
+    def _aggregate_rows_removing(self, parent, first, last):
+        for child in self.tree_view.model().getItem(parent).children[first:last + 1]:
+            self.aggregates.detach(child)
+            self.aggregates.forget(child, lambda item: item.children)
+
+    @Slot(QModelIndex, int, int)
+    def _aggregate_rows_removed(self, parent, first, last):
+        self._refresh_aggregate_item(self.tree_view.model().getItem(parent))
+        self._show_totals()
+
+    @Slot(QModelIndex, int, int, QModelIndex, int)
+    def _aggregate_rows_moving(self, source_parent, first, last, destination_parent, row):
+        self._moving_items = self.tree_view.model().getItem(source_parent).children[first:last + 1]
+
+        for item in self._moving_items:
+            self.aggregates.detach(item)
+
+    @Slot(QModelIndex, int, int, QModelIndex, int)
+    def _aggregate_rows_moved(self, source_parent, first, last, destination_parent, row):
+        # an empty group receiving items stops counting as a pv
+        self._refresh_aggregate_item(self.tree_view.model().getItem(destination_parent))
+
+        for item in self._moving_items:
+            self.aggregates.attach(item)
+
+        self._moving_items = []
+        self._refresh_aggregate_item(self.tree_view.model().getItem(source_parent))
+        self._show_totals()
+
+    @Slot(bool)
+    def toggle_live_state(self, checked):
+        if checked:
+            url = os.environ.get("KAFKA_URL", "localhost:9092")
+
+            try:
+                overlay = AlarmStateOverlay(self.tree_view.model(), url, self.tree_label.text(), self)
+
+            except Exception as e:
+                QMessageBox.warning(self, "Live State", f"Unable to connect to {url}: {e}")
+                self.live_state_action.setChecked(False)
+                return
+
+            self.tree_view.setItemDelegate(SeverityDelegate(overlay, self.tree_view))
+            overlay.start()
+            self.state_overlay = overlay
+
+        elif self.state_overlay is not None:
+            self.state_overlay.stop()
+            self.state_overlay = None
+            self.tree_view.setItemDelegate(self._default_delegate)
+            self.tree_view.viewport().update()
 
     def _import_legacy_file(self):
+        from nalms_alarm_tree_editor.alh_conversion import convert_alh_to_phoebus
 
         convert_alh_to_phoebus()
 
@@ -611,23 +1299,96 @@ class LegacyWindow(QDialog):
         filename = QFileDialog.getSaveFileName(self, 'Save File...', folder, 'Configration files (*.xml)')
         filename = filename[0] if isinstance(filename, (list, tuple)) else filename
 
+        from nalms_alarm_tree_editor.alh_conversion import convert_alh_to_phoebus
 
         convert_alh_to_phoebus(self.legacy_filename, filename)
         self.converted_filename = filename
         self.accept()
 
-        
 
 
+class AuditThread(QThread):
+    audit_complete = Signal(object)
 
+    def __init__(self, pvnames, cache, parent=None):
+        super(AuditThread, self).__init__(parent)
+        self.pvnames = pvnames
+        self.cache = cache
 
+    def run(self):
+        self.audit_complete.emit(audit(self.pvnames, cache=self.cache))
 
 
 
+class BulkImportWindow(QDialog):
 
-        
+    def __init__(self, parent=None):
+        super(BulkImportWindow, self).__init__(parent)
+
+        self.placements = {}
+
+        self.setWindowTitle("Import PVs")
+
+        # Create widgets
+        self.pv_edit = QPlainTextEdit()
+        self.pv_edit.setPlaceholderText("One PV per line")
+        self.load_pvs_button = QPushButton("Load PV File...")
+
+        self.rules_edit = QPlainTextEdit()
+        self.rules_edit.setPlaceholderText("<glob or re:regex> <group/path>, one rule per line")
+        self.load_rules_button = QPushButton("Load Rules File...")
+
+        self.default_group_edit = QLineEdit()
+        self.default_group_edit.setPlaceholderText("Group for unmatched PVs (skipped if empty)")
+
+        self.cancel_button = QPushButton("Cancel")
+        self.import_button = QPushButton("Import")
+
+        # Create layout and add widgets
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel("PVs"))
+        layout.addWidget(self.pv_edit)
+        layout.addWidget(self.load_pvs_button)
+        layout.addWidget(QLabel("Placement Rules"))
+        layout.addWidget(self.rules_edit)
+        layout.addWidget(self.load_rules_button)
+        layout.addWidget(self.default_group_edit)
+
+        button_box = QHBoxLayout()
+        button_box.addWidget(self.cancel_button)
+        button_box.addWidget(self.import_button)
 
-    
+        layout.addLayout(button_box)
+
+        self.setLayout(layout)
+
+        self.load_pvs_button.clicked.connect(lambda: self._load_file(self.pv_edit))
+        self.load_rules_button.clicked.connect(lambda: self._load_file(self.rules_edit))
+        self.cancel_button.clicked.connect(self.reject)
+        self.import_button.clicked.connect(self._place_pvs)
 
+    def _load_file(self, text_edit):
+        filename = QFileDialog.getOpenFileName(self, 'Open File...', os.getcwd())
+        filename = filename[0] if isinstance(filename, (list, tuple)) else filename
 
+        if filename:
+            with open(filename) as f:
+                text_edit.setPlainText(f.read())
 
+    @Slot()
+    def _place_pvs(self):
+        try:
+            rules = read_rules(self.rules_edit.toPlainText())
+
+        except Exception as e:
+            QMessageBox.warning(self, "Import PVs", str(e))
+            return
+
+        pvnames = read_pv_list(self.pv_edit.toPlainText())
+        default_group = self.default_group_edit.text().strip() or None
+        self.placements, unmatched = place_pvs(pvnames, rules, default_group=default_group)
+
+        if unmatched:
+            QMessageBox.information(self, "Import PVs", f"{len(unmatched)} PVs matched no rule and were skipped.")
+
+        self.accept()
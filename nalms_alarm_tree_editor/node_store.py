@@ -0,0 +1,725 @@
+"""
+Disk-backed storage of alarm tree nodes, for configurations too large to
+hold in memory. Nodes, their records and the PV totals of every group live
+in an SQLite database. Rows read by the editor are kept in a bounded least
+recently used cache, so memory use does not grow with the configuration.
+
+Configurations are streamed into the store with iterparse and streamed back
+out on save; the XML file remains the saved copy and the database is a
+scratch file removed on close.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import weakref
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+from nalms_alarm_tree_editor.aggregates import DEFAULTS, FIELDS, pv_counts
+from nalms_alarm_tree_editor.phoebus_config import _NODE_TAGS, _PROPERTY_TAGS, _record_fields
+from nalms_alarm_tree_editor.property_store import BOOL_PROPERTIES, TEXT_PROPERTIES
+from nalms_alarm_tree_editor.query import _glob_regex, _literal_prefix
+
+
+NODE_COLUMNS = ("id", "parent", "position", "label", "is_group") + BOOL_PROPERTIES + TEXT_PROPERTIES
+
+DEFAULT_CACHE_SIZE = 20000
+
+# rows written per executemany while loading
+_BATCH_SIZE = 5000
+
+# SQLite page cache, in KiB
+_PAGE_CACHE_KIB = 8192
+
+_ZERO = (0,) * len(FIELDS)
+
+_SCHEMA = f"""
+CREATE TABLE nodes (id INTEGER PRIMARY KEY, parent INTEGER, position INTEGER, label TEXT, is_group INTEGER,
+                    {", ".join(f"{prop} INTEGER" for prop in BOOL_PROPERTIES)},
+                    {", ".join(f"{prop} TEXT" for prop in TEXT_PROPERTIES)});
+CREATE TABLE records (node INTEGER, position INTEGER, tag TEXT, fields TEXT);
+CREATE TABLE totals (id INTEGER PRIMARY KEY, {", ".join(f"{field} INTEGER" for field in FIELDS)});
+"""
+
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS nodes_children ON nodes (parent, position);
+CREATE INDEX IF NOT EXISTS nodes_label ON nodes (label);
+CREATE INDEX IF NOT EXISTS records_node ON records (node, position);
+"""
+
+_SELECT_NODE = f"SELECT {', '.join(NODE_COLUMNS)} FROM nodes"
+
+
+class LRUCache:
+    """
+    Mapping that keeps its maxsize most recently used entries
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        value = self._entries.get(key)
+
+        if value is not None:
+            self._entries.move_to_end(key)
+
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _close_database(db, filename, temporary):
+    db.close()
+
+    if temporary and os.path.exists(filename):
+        os.unlink(filename)
+
+
+class StoredNode:
+    """
+    A row of the nodes table with the property attributes of a tree model
+    item. Unset flags are None and unset texts are empty.
+    """
+    __slots__ = NODE_COLUMNS
+
+    def __init__(self, row):
+        for column, value in zip(NODE_COLUMNS, row):
+            setattr(self, column, value)
+
+        for prop in BOOL_PROPERTIES:
+            value = getattr(self, prop)
+            setattr(self, prop, None if value is None else bool(value))
+
+        for prop in TEXT_PROPERTIES:
+            setattr(self, prop, getattr(self, prop) or "")
+
+        self.is_group = bool(self.is_group)
+
+    def counts(self):
+        return pv_counts(self.enabled, self.latching, self.annunciating, self.alarm_filter)
+
+
+class _OpenNode:
+    # node being loaded, written once its end tag is reached
+
+    def __init__(self, node_id, parent, position, label, is_group):
+        self.values = {"id": node_id, "parent": parent, "position": position, "label": label,
+                       "is_group": 1 if is_group else 0}
+        self.children = 0
+        self.records = []
+        self.totals = [0] * len(FIELDS) if is_group else None
+
+
+class NodeStore:
+    """
+    Nodes of a single configuration in an SQLite database. The root node is
+    the config element. filename defaults to a temporary file that is
+    removed on close.
+    """
+
+    def __init__(self, filename=None, cache_size=DEFAULT_CACHE_SIZE):
+        temporary = filename is None
+        if temporary:
+            handle, filename = tempfile.mkstemp(prefix="nalms_", suffix=".sqlite")
+            os.close(handle)
+
+        self.filename = filename
+        self._db = sqlite3.connect(filename)
+        # temporary databases are also removed if the store is never closed
+        self._finalizer = weakref.finalize(self, _close_database, self._db, filename, temporary)
+
+        # a scratch copy of the configuration doesn't need durability
+        self._db.executescript(f"PRAGMA journal_mode = OFF; PRAGMA synchronous = OFF; "
+                               f"PRAGMA cache_size = -{_PAGE_CACHE_KIB};")
+        self._db.executescript(_SCHEMA)
+
+        self.root = None
+        self._next_id = 1
+        self._nodes = LRUCache(cache_size)
+        self._children = LRUCache(cache_size)
+
+    @classmethod
+    def from_file(cls, filename, **kwargs):
+        store = cls(**kwargs)
+        store.load(filename)
+
+        return store
+
+    @classmethod
+    def from_manifest(cls, directory, **kwargs):
+        """
+        Loads a sharded configuration, one shard at a time
+        """
+        from nalms_alarm_tree_editor.sharding import read_manifest, ROOT_SHARD
+
+        manifest = read_manifest(directory)
+        store = cls(**kwargs)
+        store.root = store._insert(None, 0, manifest["config"], is_group=True)
+
+        for shard in manifest["shards"]:
+            store.load(os.path.join(directory, shard["file"]), parent=store.root,
+                       include_root=(shard["file"] != ROOT_SHARD))
+
+        return store
+
+    def close(self):
+        self._finalizer()
+
+    def load(self, source, parent=None, include_root=True):
+        """
+        Streams a configuration into the store. Without a parent the config
+        becomes the root node, otherwise the root element is added as the
+        last child of parent. Without include_root, the root element's
+        children and records are added to parent directly.
+        """
+        # stands in for parent, collecting the totals added below it
+        outer = _OpenNode(parent, None, None, None, True)
+        if parent is not None:
+            outer.children = self.child_count(parent)
+
+        stack = [outer]
+        elems = []
+        record = None
+        rows = []
+        records = []
+
+        def flush():
+            self._db.executemany(f"INSERT INTO nodes ({', '.join(NODE_COLUMNS)}) "
+                                 f"VALUES ({', '.join('?' * len(NODE_COLUMNS))})", rows)
+            self._db.executemany("INSERT INTO records VALUES (?, ?, ?, ?)", records)
+            del rows[:]
+            del records[:]
+
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            tag = elem.tag
+
+            if event == "start":
+                elems.append(elem)
+
+                if record is not None or tag not in _NODE_TAGS:
+                    if record is None and len(stack) > 1 and tag not in _PROPERTY_TAGS:
+                        record = elem
+
+                    continue
+
+                if len(elems) == 1 and not include_root:
+                    # children attach to parent, records go to the outer node
+                    stack.append(outer)
+                    continue
+
+                owner = stack[-1]
+                node = _OpenNode(self._next_id, owner.values["id"], owner.children, elem.attrib.get("name"),
+                                 tag != "pv")
+                self._next_id += 1
+                owner.children += 1
+                stack.append(node)
+
+                if self.root is None:
+                    self.root = node.values["id"]
+
+                continue
+
+            elems.pop()
+
+            if elem is record:
+                tag, fields = _record_fields(elem)
+                node = stack[-1]
+                records.append((node.values["id"], len(node.records), tag, json.dumps(fields)))
+                node.records.append(tag)
+                record = None
+
+            elif record is not None:
+                continue
+
+            elif tag in _NODE_TAGS:
+                node = stack.pop()
+
+                if node is not outer:
+                    counts = node.totals if node.totals is not None else self._open_counts(node)
+                    row = [node.values.get(column) for column in NODE_COLUMNS]
+                    rows.append(row)
+
+                    if node.totals is not None:
+                        self._db.execute("INSERT INTO totals VALUES (?, ?, ?, ?, ?, ?)", [node.values["id"]] + counts)
+
+                    owner = stack[-1] if stack else None
+                    if owner is not None and owner.totals is not None:
+                        for i, count in enumerate(counts):
+                            owner.totals[i] += count
+
+                if len(rows) >= _BATCH_SIZE:
+                    flush()
+
+                # drop parsed elements to keep memory constant
+                elem.clear()
+                if elems and len(elems[-1]) and elems[-1][-1] is elem:
+                    del elems[-1][-1]
+
+            elif tag in _PROPERTY_TAGS and len(stack) > 1:
+                prop = _PROPERTY_TAGS[tag]
+                value = elem.text
+
+                if prop in BOOL_PROPERTIES:
+                    value = {"true": 1, "false": 0}.get((value or "").strip().lower())
+
+                stack[-1].values[prop] = value
+
+        flush()
+
+        if parent is not None and any(outer.totals):
+            self._add_counts(parent, outer.totals)
+
+        self._db.executescript(_INDEXES)
+        self._db.commit()
+
+        return self.root
+
+    def _open_counts(self, node):
+        values = node.values
+        return list(pv_counts(*[None if values.get(prop) is None else values[prop] for prop in BOOL_PROPERTIES],
+                              values.get("alarm_filter")))
+
+    def node(self, node_id):
+        """
+        Returns the StoredNode of an id, from the cache when possible
+        """
+        node = self._nodes.get(node_id)
+
+        if node is None:
+            row = self._db.execute(f"{_SELECT_NODE} WHERE id = ?", (node_id,)).fetchone()
+            if row is None:
+                raise KeyError(node_id)
+
+            node = StoredNode(row)
+            self._nodes.put(node_id, node)
+
+        return node
+
+    def children(self, node_id):
+        """
+        Returns the ids of a node's children in order
+        """
+        children = self._children.get(node_id)
+
+        if children is None:
+            children = tuple(row[0] for row in self._db.execute(
+                "SELECT id FROM nodes WHERE parent = ? ORDER BY position", (node_id,)))
+            self._children.put(node_id, children)
+
+        return children
+
+    def child_count(self, node_id):
+        return len(self.children(node_id))
+
+    def child_nodes(self, node_id):
+        """
+        Returns the StoredNodes of a node's children without going through
+        the cache, for whole tree walks that shouldn't evict the editor's
+        nodes
+        """
+        return [StoredNode(row) for row in self._db.execute(f"{_SELECT_NODE} WHERE parent = ? ORDER BY position",
+                                                           (node_id,))]
+
+    def records(self, node_id):
+        """
+        Returns the (tag, *fields) records attached to a node
+        """
+        return [(tag,) + tuple(json.loads(fields)) for tag, fields in self._db.execute(
+            "SELECT tag, fields FROM records WHERE node = ? ORDER BY position", (node_id,))]
+
+    def child_records(self, node_id):
+        """
+        Returns a dictionary mapping each child of a node to its records
+        """
+        records = {}
+        for child, tag, fields in self._db.execute(
+                "SELECT records.node, records.tag, records.fields FROM records JOIN nodes ON records.node = nodes.id "
+                "WHERE nodes.parent = ? ORDER BY records.node, records.position", (node_id,)):
+            records.setdefault(child, []).append((tag,) + tuple(json.loads(fields)))
+
+        return records
+
+    def path(self, node_id):
+        labels = []
+        while node_id != self.root:
+            node = self.node(node_id)
+            labels.append(node.label)
+            node_id = node.parent
+
+        return "/" + "/".join(reversed(labels))
+
+    def find(self, path):
+        """
+        Returns the id of a node by path relative to the root, such as
+        "/LINAC/BPM01", or None
+        """
+        node_id = self.root
+        for label in path.strip("/").split("/") if path.strip("/") else []:
+            row = self._db.execute("SELECT id FROM nodes WHERE parent = ? AND label = ? ORDER BY position LIMIT 1",
+                                   (node_id, label)).fetchone()
+            if row is None:
+                return None
+
+            node_id = row[0]
+
+        return node_id
+
+    def pvnames(self):
+        for row in self._db.execute("SELECT label FROM nodes WHERE is_group = 0 ORDER BY id"):
+            yield row[0]
+
+    def totals(self, node_id):
+        """
+        Returns a dictionary of the totals below a group, or of the PV itself
+        """
+        return dict(zip(FIELDS, self._counts(node_id)))
+
+    def _counts(self, node_id):
+        node = self.node(node_id)
+        if not node.is_group:
+            return node.counts()
+
+        row = self._db.execute(f"SELECT {', '.join(FIELDS)} FROM totals WHERE id = ?", (node_id,)).fetchone()
+        return row or _ZERO
+
+    def _add_counts(self, node_id, delta):
+        # node_id and each of its ancestors
+        assignments = ", ".join(f"{field} = {field} + ?" for field in FIELDS)
+
+        while node_id is not None:
+            self._db.execute(f"UPDATE totals SET {assignments} WHERE id = ?", list(delta) + [node_id])
+            node_id = self.node(node_id).parent
+
+    def _forget(self, node_id):
+        self._nodes.pop(node_id)
+        self._children.pop(node_id)
+
+    def _shift_siblings(self, parent, position, offset):
+        # positions from position on move by offset
+        for child in self.children(parent)[position:]:
+            self._nodes.pop(child)
+
+        self._db.execute("UPDATE nodes SET position = position + ? WHERE parent = ? AND position >= ?",
+                         (offset, parent, position))
+        self._children.pop(parent)
+
+    def _make_group(self, node_id):
+        node = self.node(node_id)
+        if node.is_group:
+            return
+
+        # a pv receiving children becomes a group and stops counting as a pv
+        counts = node.counts()
+        if node.parent is not None:
+            self._add_counts(node.parent, [-count for count in counts])
+
+        self._db.execute("UPDATE nodes SET is_group = 1 WHERE id = ?", (node_id,))
+        self._db.execute(f"INSERT INTO totals VALUES ({', '.join('?' * (len(FIELDS) + 1))})", (node_id,) + _ZERO)
+        self._forget(node_id)
+
+    def _insert(self, parent, position, label, is_group=False):
+        node_id = self._next_id
+        self._next_id += 1
+
+        self._db.execute("INSERT INTO nodes (id, parent, position, label, is_group) VALUES (?, ?, ?, ?, ?)",
+                         (node_id, parent, position, label, 1 if is_group else 0))
+
+        if is_group:
+            self._db.execute(f"INSERT INTO totals VALUES ({', '.join('?' * (len(FIELDS) + 1))})", (node_id,) + _ZERO)
+
+        if parent is not None:
+            self._children.pop(parent)
+
+        return node_id
+
+    def insert_node(self, parent, position, label, is_group=False):
+        """
+        Inserts a node at position among the children of parent and returns
+        its id
+        """
+        self._make_group(parent)
+        self._shift_siblings(parent, position, 1)
+        node_id = self._insert(parent, position, label, is_group)
+
+        if not is_group:
+            self._add_counts(parent, self.node(node_id).counts())
+
+        self._db.commit()
+        return node_id
+
+    def _subtree(self, node_id):
+        return [row[0] for row in self._db.execute(
+            "WITH RECURSIVE subtree(id) AS (SELECT ? UNION ALL "
+            "SELECT nodes.id FROM nodes JOIN subtree ON nodes.parent = subtree.id) SELECT id FROM subtree",
+            (node_id,))]
+
+    def remove_node(self, node_id):
+        """
+        Removes a node and its subtree
+        """
+        node = self.node(node_id)
+        self._add_counts(node.parent, [-count for count in self._counts(node_id)])
+
+        ids = [(subtree_id,) for subtree_id in self._subtree(node_id)]
+        self._db.executemany("DELETE FROM nodes WHERE id = ?", ids)
+        self._db.executemany("DELETE FROM records WHERE node = ?", ids)
+        self._db.executemany("DELETE FROM totals WHERE id = ?", ids)
+
+        for (subtree_id,) in ids:
+            self._forget(subtree_id)
+
+        self._shift_siblings(node.parent, node.position, -1)
+        self._db.commit()
+
+    def move_node(self, node_id, parent, position):
+        """
+        Moves a node to position among the children of parent, position
+        counting the children without the moved node
+        """
+        node = self.node(node_id)
+        counts = [count for count in self._counts(node_id)]
+
+        self._add_counts(node.parent, [-count for count in counts])
+        self._shift_siblings(node.parent, node.position + 1, -1)
+
+        self._make_group(parent)
+        self._shift_siblings(parent, position, 1)
+        self._db.execute("UPDATE nodes SET parent = ?, position = ? WHERE id = ?", (parent, position, node_id))
+        self._forget(node_id)
+        self._children.pop(node.parent)
+        self._children.pop(parent)
+
+        self._add_counts(parent, counts)
+        self._db.commit()
+
+    def _update(self, node_id, properties):
+        # returns the change of the node's counts, not yet added to its ancestors
+        node = self.node(node_id)
+        old_counts = node.counts()
+        assignments = []
+        values = []
+
+        for prop, value in properties.items():
+            if prop in BOOL_PROPERTIES:
+                value = None if value is None else int(bool(value))
+
+            elif prop in TEXT_PROPERTIES:
+                value = value or None
+
+            elif prop != "label":
+                raise KeyError(f"Unknown property {prop}")
+
+            assignments.append(f"{prop} = ?")
+            values.append(value)
+
+        if not assignments:
+            return _ZERO
+
+        self._db.execute(f"UPDATE nodes SET {', '.join(assignments)} WHERE id = ?", values + [node_id])
+        self._forget(node_id)
+
+        if node.is_group:
+            return _ZERO
+
+        return [new - old for new, old in zip(self.node(node_id).counts(), old_counts)]
+
+    def set_properties(self, node_id, **properties):
+        """
+        Sets the label and properties of a node. Flags take True, False or
+        None and empty texts are stored as unset.
+        """
+        delta = self._update(node_id, properties)
+
+        if any(delta):
+            self._add_counts(self.node(node_id).parent, delta)
+
+        self._db.commit()
+
+    def set_many(self, node_ids, **properties):
+        """
+        Sets the same properties on many nodes in a single transaction. The
+        changes of the PV totals are summed per parent before they are
+        applied to the ancestors.
+        """
+        deltas = {}
+
+        for node_id in node_ids:
+            delta = self._update(node_id, properties)
+
+            if any(delta):
+                parent = self.node(node_id).parent
+                deltas[parent] = [total + count for total, count in zip(deltas.get(parent, _ZERO), delta)]
+
+        for parent, delta in deltas.items():
+            self._add_counts(parent, delta)
+
+        self._db.commit()
+
+    def add_pvs(self, placements):
+        """
+        Adds placed PVs, as returned by bulk_import.place_pvs, creating
+        missing groups. Existing nodes on a group path are reused, and PVs
+        already in the configuration are skipped. The PVs of each group are
+        inserted together and the store is committed once.
+
+        Returns the number of PVs added.
+        """
+        added = 0
+        seen = set()
+        counts = pv_counts(True, None, None, None)
+
+        for group_path, pvnames in placements.items():
+            group = self.root
+
+            for label in [label for label in group_path.split("/") if label]:
+                row = self._db.execute("SELECT id FROM nodes WHERE parent = ? AND label = ? ORDER BY position LIMIT 1",
+                                       (group, label)).fetchone()
+
+                if row is None:
+                    self._make_group(group)
+                    group = self._insert(group, self.child_count(group), label, is_group=True)
+
+                else:
+                    group = row[0]
+
+            new_pvs = []
+            for pvname in pvnames:
+                if pvname in seen or self._db.execute("SELECT 1 FROM nodes WHERE label = ? AND is_group = 0",
+                                                      (pvname,)).fetchone():
+                    continue
+
+                seen.add(pvname)
+                new_pvs.append(pvname)
+
+            if not new_pvs:
+                continue
+
+            self._make_group(group)
+            position = self.child_count(group)
+            first_id = self._next_id
+            self._next_id += len(new_pvs)
+
+            self._db.executemany("INSERT INTO nodes (id, parent, position, label, is_group, enabled) "
+                                 "VALUES (?, ?, ?, ?, 0, 1)",
+                                 [(first_id + i, group, position + i, pvname) for i, pvname in enumerate(new_pvs)])
+            self._children.pop(group)
+            self._add_counts(group, [count * len(new_pvs) for count in counts])
+            added += len(new_pvs)
+
+        self._db.commit()
+        return added
+
+    def select(self, query):
+        """
+        Returns the ids of the PVs matching the conditions of a parsed
+        query.Query, in document order. The conditions are evaluated in
+        SQL over the subtree of the longest literal path prefix, so no copy
+        of the nodes is held in memory.
+        """
+        start = self.root
+        prefixes = [(value if value.startswith("/") else "/" + value, operator)
+                    for field, operator, value in query.conditions if field == "path"]
+
+        for pattern, operator in prefixes:
+            prefix = pattern if operator == "=" else _literal_prefix(pattern)
+            node_id = self.find(prefix)
+
+            if node_id is None:
+                return []
+
+            if len(prefix) > len(self.path(start)):
+                start = node_id
+
+        clauses = ["nodes.is_group = 0"]
+        values = []
+        patterns = []
+
+        for field, operator, value in query.conditions:
+            if field in ("path", "label"):
+                column = "subtree.path" if field == "path" else "nodes.label"
+
+                if field == "path" and not value.startswith("/"):
+                    value = "/" + value
+
+                if operator == "~":
+                    patterns.append(_glob_regex(value, path=(field == "path")))
+                    clauses.append(f"query_match({len(patterns) - 1}, {column})")
+
+                else:
+                    clauses.append(f"{column} = ?")
+                    values.append(value)
+
+            elif field in BOOL_PROPERTIES:
+                # unset flags take their Phoebus default
+                clauses.append(f"COALESCE(nodes.{field}, {int(DEFAULTS[field])}) {operator} ?")
+                values.append(int(value))
+
+            else:
+                clauses.append(f"nodes.{field} {'=' if operator == '=' else 'IS NOT'} ?")
+                values.append(value)
+
+        self._db.create_function("query_match", 2,
+                                 lambda pattern, text: patterns[pattern].fullmatch(text or "") is not None)
+
+        # the sort key joins the zero padded positions from the start node
+        start_path = "" if start == self.root else self.path(start)
+        rows = self._db.execute(
+            "WITH RECURSIVE subtree(id, path, sort_key) AS (SELECT ?, ?, '' UNION ALL "
+            "SELECT nodes.id, subtree.path || '/' || nodes.label, subtree.sort_key || printf('%08d', nodes.position) "
+            "FROM nodes JOIN subtree ON nodes.parent = subtree.id) "
+            f"SELECT nodes.id FROM subtree JOIN nodes ON nodes.id = subtree.id WHERE {' AND '.join(clauses)} "
+            "ORDER BY subtree.sort_key", [start, start_path] + values)
+
+        return [row[0] for row in rows]
+
+
+class StoredAggregates:
+    """
+    The SubtreeAggregates interface over the totals a NodeStore maintains
+    itself. Nodes are the editor's handles on stored nodes, so updates
+    reported by the editor are already applied.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def add_tree(self, root, children_of, counts_of):
+        pass
+
+    def forget(self, root, children_of):
+        pass
+
+    def set_pv(self, node, counts):
+        pass
+
+    def remove_pv(self, node):
+        pass
+
+    def detach(self, node):
+        pass
+
+    def attach(self, node):
+        pass
+
+    def totals(self, node):
+        return self.store.totals(node.node_id)
+
+    def is_pv(self, node):
+        return not self.store.node(node.node_id).is_group
@@ -0,0 +1,450 @@
+import itertools
+import xml.etree.ElementTree as ET
+
+from nalms_alarm_tree_editor.property_store import PropertyStore, RECORD_FIELDS, RAW_RECORD
+from nalms_alarm_tree_editor.sharding import write_shards, load_shards, _write_atomic
+
+
+def _quote_attrib(value):
+    # xml.sax.saxutils.quoteattr pulls in urllib, keep startup light
+    value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    value = value.replace("\"", "&quot;").replace("\n", "&#10;")
+    return f"\"{value}\""
+
+
+_NODE_TAGS = ("config", "component", "pv")
+
+# property elements and their names in node data
+_PROPERTY_TAGS = {
+    "description": "description",
+    "enabled": "enabled",
+    "latching": "latching",
+    "annunciating": "annunciating",
+    "delay": "delay",
+    "count": "count",
+    "filter": "alarm_filter",
+}
+
+
+class _StoreRow:
+    """
+    Exposes a property store row with the attributes of a tree model item
+    """
+
+    def __init__(self, store, row):
+        self.label = store.label[row]
+
+        for prop, column in store.bools.items():
+            setattr(self, prop, None if column[row] < 0 else bool(column[row]))
+
+        for prop, column in store.texts.items():
+            setattr(self, prop, column[row])
+
+
+def _record_fields(elem):
+    # (tag, fields) of a record element, unrecognized elements are kept verbatim
+    if elem.tag in RECORD_FIELDS:
+        return elem.tag, [elem.findtext(field) for field in RECORD_FIELDS[elem.tag]]
+
+    tail, elem.tail = elem.tail, None
+    text = ET.tostring(elem, encoding="unicode")
+    elem.tail = tail
+
+    return RAW_RECORD, [text]
+
+
+def parse_store(source):
+    """
+    Parses a configuration into a PropertyStore. The root element is either
+    a config or, for sharded configurations, a single component.
+    """
+    store = PropertyStore()
+    stack = []
+    record = None
+
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        tag = elem.tag
+
+        if event == "start":
+            if tag in _NODE_TAGS and record is None and (stack or tag != "pv"):
+                parent = stack[-1] if stack else -1
+                stack.append(store.add_node(elem.attrib.get("name"), parent, is_group=(tag != "pv")))
+
+            elif record is None and stack and tag not in _PROPERTY_TAGS:
+                record = elem
+
+            continue
+
+        if elem is record:
+            store.add_record(stack[-1], *_record_fields(elem))
+            record = None
+
+        elif record is not None:
+            continue
+
+        elif tag in _NODE_TAGS and stack:
+            store.close_node(stack.pop())
+            elem.clear()
+
+        elif tag in _PROPERTY_TAGS and stack:
+            store.set_property(stack[-1], _PROPERTY_TAGS[tag], elem.text)
+
+    return store
+
+
+class PhoebusConfigTool:
+    """
+    Tool for building and parsing Phoebus configuration files
+
+    """
+
+    def __init__(self):
+        self._nodes = []
+        self._root = None
+        self._store = PropertyStore()
+
+        # record ids of the last node list and of bound model items
+        self._node_records = []
+        self._item_records = {}
+
+        # (sha256, store) of shards from the last sharded parse
+        self._shards = {}
+
+        # serialized bytes of each item, without its children, and item parents
+        self._fragments = {}
+        self._parents = {}
+
+    def _clear(self):
+        self._root = None
+        self._nodes = []
+        self._store = PropertyStore()
+        self._node_records = []
+        self._item_records = {}
+        self.invalidate()
+
+    @property
+    def store(self):
+        """
+        Property store of the last parsed configuration
+        """
+        return self._store
+
+    def invalidate(self):
+        """
+        Drops all cached fragments, forcing a full rebuild on the next save
+        """
+        self._fragments = {}
+        self._parents = {}
+
+    def mark_dirty(self, item):
+        """
+        Invalidates the cached fragments of an item and all of its ancestors
+        """
+        while item is not None:
+            self._fragments.pop(item, None)
+            item = self._parents.get(item)
+
+    def parse_config(self, filename):
+        """
+        Parses a configuration file into the property store and returns the
+        node list for the tree model
+        """
+        #clear
+        self._clear()
+
+        self._set_store(parse_store(filename))
+
+        return self._nodes
+
+
+    def _set_store(self, store):
+        self._store = store
+        self._nodes = []
+        self._node_records = []
+
+        if len(store):
+            self._config_name = store.label[0]
+            self._nodes = store.to_nodes()
+            self._node_records = list(store.record_ids)
+
+
+    def parse_sharded(self, directory, workers=None):
+        """
+        Parses a sharded configuration directory. Shards unchanged since the
+        last sharded parse of the same directory are not parsed again.
+        """
+        self._clear()
+
+        store, self._shards = load_shards(directory, previous=self._shards, workers=workers)
+        self._set_store(store)
+
+        return self._nodes
+
+
+    def bind_items(self, items):
+        """
+        Associates tree model items, in the order of the node list last
+        returned by parse_config or build_nodes, with their command and
+        automated action records
+        """
+        self._item_records = {item: records for item, records in zip(items, self._node_records) if records}
+        self.invalidate()
+
+
+    def select(self, path="/", pvs_only=True, **conditions):
+        """
+        Returns the node data of parsed nodes matching a property store query,
+        for example select("/LINAC", latching=False)
+        """
+        return [self._store.node_data(row) for row in self._store.select(path, pvs_only=pvs_only, **conditions)]
+
+
+    def build_nodes(self, root_node):
+        """
+        Builds the node list accepted by the tree model's import_hierarchy
+        from the current tree items
+        """
+        nodes = [[{"label": root_node.label}, None]]
+        node_records = [self._item_records.get(root_node, ())]
+        to_process = [(child, 0) for child in reversed(root_node.children)]
+
+        while to_process:
+            item, parent_idx = to_process.pop()
+            data = {"label": item.label}
+            node_records.append(self._item_records.get(item, ()))
+
+            if not item.child_count():
+                for prop in ("enabled", "latching", "annunciating"):
+                    value = getattr(item, prop)
+                    if value is not None:
+                        data[prop] = "true" if value else "false"
+
+                for prop in ("description", "delay", "count", "alarm_filter"):
+                    value = getattr(item, prop)
+                    if value:
+                        data[prop] = value
+
+            nodes.append([data, parent_idx])
+            item_idx = len(nodes) - 1
+            to_process += [(child, item_idx) for child in reversed(item.children)]
+
+        self._node_records = node_records
+
+        return nodes
+
+
+    def save_configuration(self, root_node, filename):
+        """
+        Saves the configuration, reusing the cached fragments of items that
+        have not been marked dirty. The file is written atomically.
+        """
+        chunks = itertools.chain([b"<?xml version='1.0' encoding='utf8'?>\n"],
+                                 self._serialize(root_node, is_root=True))
+        _write_atomic(filename, chunks)
+
+
+    def save_sharded(self, root_node, directory, workers=None):
+        """
+        Saves the configuration as one shard per top-level component plus a
+        manifest. Returns the number of shard files written.
+        """
+        root_chunks = [f"<config name={_quote_attrib(root_node.label)}>".encode("utf8")]
+        records = ET.Element("config")
+        self._handle_record_add(records, self._item_records.get(root_node, ()))
+        root_chunks += [ET.tostring(record, encoding="unicode").encode("utf8") for record in records]
+
+        components = []
+        for child in root_node.children:
+            self._parents[child] = root_node
+
+            if child.child_count():
+                components.append((child.label, b"".join(self._serialize(child))))
+
+            else:
+                root_chunks += self._serialize(child)
+
+        root_chunks.append(b"</config>")
+
+        return write_shards(directory, root_node.label, b"".join(root_chunks), components, workers=workers)
+
+
+    def save_store(self, filename):
+        """
+        Saves the parsed configuration directly from the property store,
+        without a tree model
+        """
+        store = self._store
+        elems = [ET.Element("config", name=store.label[0])]
+        self._handle_record_add(elems[0], store.record_ids[0])
+
+        for row in range(1, len(store)):
+            tag = "component" if store.is_group[row] else "pv"
+            elem = ET.SubElement(elems[store.parent[row]], tag, name=store.label[row])
+
+            if not store.is_group[row]:
+                self._handle_property_add(elem, _StoreRow(store, row))
+
+            self._handle_record_add(elem, store.record_ids[row])
+            elems.append(elem)
+
+        chunks = [b"<?xml version='1.0' encoding='utf8'?>\n", ET.tostring(elems[0], encoding="unicode").encode("utf8")]
+        _write_atomic(filename, chunks)
+
+
+    def save_node_store(self, node_store, filename):
+        """
+        Saves a configuration held in a disk-backed NodeStore. Nodes are
+        streamed from the store a group at a time, so memory use does not
+        depend on the size of the configuration.
+        """
+        _write_atomic(filename, self._node_store_chunks(node_store))
+
+
+    def _node_store_chunks(self, node_store):
+        yield b"<?xml version='1.0' encoding='utf8'?>\n"
+
+        root = node_store.node(node_store.root)
+        to_process = [(root, node_store.records(root.id))]
+
+        while to_process:
+            node, records = to_process.pop()
+
+            # end tags of groups are queued behind their children
+            if isinstance(node, bytes):
+                yield node
+                continue
+
+            if node.id == root.id or node.is_group:
+                tag = "config" if node.id == root.id else "component"
+                yield f"<{tag} name={_quote_attrib(node.label)}>".encode("utf8")
+
+                elems = ET.Element(tag)
+                self._add_records(elems, records)
+                for elem in elems:
+                    yield ET.tostring(elem, encoding="unicode").encode("utf8")
+
+                child_records = node_store.child_records(node.id)
+                to_process.append((f"</{tag}>".encode("utf8"), None))
+                to_process += [(child, child_records.get(child.id, ()))
+                               for child in reversed(node_store.child_nodes(node.id))]
+
+            else:
+                pv_comp = ET.Element("pv", name=node.label)
+                self._handle_property_add(pv_comp, node)
+                self._add_records(pv_comp, records)
+                yield ET.tostring(pv_comp, encoding="unicode").encode("utf8")
+
+
+    def _serialize(self, node, is_root=False):
+        """
+        Yields the serialized chunks of a subtree. Only each node's own tags
+        and records are cached, so the bytes of a subtree are not copied
+        again into every ancestor.
+        """
+        to_process = [(node, is_root)]
+
+        while to_process:
+            node, is_root = to_process.pop()
+
+            # end tags of groups are queued behind their children
+            if isinstance(node, bytes):
+                yield node
+                continue
+
+            fragment = self._fragments.get(node)
+            if fragment is None:
+                fragment = self._fragment(node, is_root)
+                self._fragments[node] = fragment
+
+            if isinstance(fragment, bytes):
+                yield fragment
+                continue
+
+            head, tail = fragment
+            yield head
+
+            to_process.append((tail, False))
+            for child in reversed(node.children):
+                self._parents[child] = node
+                to_process.append((child, False))
+
+
+    def _fragment(self, node, is_root):
+        # (start tag and records, end tag) of a group, the element of a pv
+        if is_root or node.child_count():
+            tag = "config" if is_root else "component"
+            head = [f"<{tag} name={_quote_attrib(node.label)}>".encode("utf8")]
+
+            # group records precede the group's children
+            records = ET.Element(tag)
+            self._handle_record_add(records, self._item_records.get(node, ()))
+            head += [ET.tostring(record, encoding="unicode").encode("utf8") for record in records]
+
+            return b"".join(head), f"</{tag}>".encode("utf8")
+
+        pv_comp = ET.Element("pv", name=node.label)
+        self._handle_property_add(pv_comp, node)
+        self._handle_record_add(pv_comp, self._item_records.get(node, ()))
+        return ET.tostring(pv_comp, encoding="unicode").encode("utf8")
+
+    def _handle_property_add(self, elem, alarm_tree_item):
+
+        if alarm_tree_item.enabled is not None:
+            enabled = ET.SubElement(elem, "enabled")
+           
+            if alarm_tree_item.enabled:
+                enabled.text = 'true'
+
+            else:
+                enabled.text = 'false'
+
+        if alarm_tree_item.latching is not None:
+            latching = ET.SubElement(elem, "latching")
+
+            if alarm_tree_item.latching:
+                latching.text = 'true'
+
+            else:
+                latching.text = 'false'
+
+        if alarm_tree_item.annunciating is not None:
+            annunciating = ET.SubElement(elem, "annunciating")
+
+            if alarm_tree_item.annunciating:
+                annunciating.text = 'true'
+
+            else:
+                annunciating.text = 'false'
+
+
+        if alarm_tree_item.description:
+            description = ET.SubElement(elem, "description")
+            description.text = alarm_tree_item.description
+
+
+        if alarm_tree_item.delay:
+            delay = ET.SubElement(elem, "delay")
+            delay.text = alarm_tree_item.delay
+
+        if alarm_tree_item.count:
+            count = ET.SubElement(elem, "count")
+            count.text = alarm_tree_item.count
+
+        if alarm_tree_item.alarm_filter:
+            alarm_filter = ET.SubElement(elem, "filter")
+            alarm_filter.text = alarm_tree_item.alarm_filter
+
+    def _handle_record_add(self, elem, record_ids):
+        self._add_records(elem, [self._store.record_table.get(record_id) for record_id in record_ids])
+
+    def _add_records(self, elem, records):
+        for tag, *values in records:
+            if tag == RAW_RECORD:
+                elem.append(ET.fromstring(values[0]))
+                continue
+
+            record = ET.SubElement(elem, tag)
+
+            for field, value in zip(RECORD_FIELDS[tag], values):
+                if value is not None:
+                    ET.SubElement(record, field).text = value
@@ -0,0 +1,449 @@
+"""
+Conversion of Phoebus configurations back to ALH, for ALH consoles that
+follow configurations maintained in Phoebus format. The configuration is
+streamed with iterparse and elements are discarded once written, so memory
+does not grow with the size of the tree.
+"""
+import os
+import re
+import xml.etree.ElementTree as ET
+from collections import Counter
+
+
+# numbers, operators and pv names of a filter expression
+_FILTER_TOKEN = re.compile(r"\s*(?:(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)|(?P<op>&&|\|\||[=!<>]=|[-+*/%()!<>])"
+                           r"|(?P<name>'[^']*'|[^\s&|=!<>()+\-*/%][^\s&|=!<>()+*/%]*))")
+
+_FORCE_VALUE = re.compile(r"^(?P<expression>.+?)\s*!=\s*(?P<value>-?\d+(?:\.\d*)?)\s*$")
+
+CALC_INPUTS = "ABCDEFGHIJKL"
+
+# pv names may be quoted in filters
+_QUOTE = "'"
+
+# force mask disabling the alarm while the force pv equals the force value
+FORCE_MASK = "-D---"
+
+
+def _tokenize_filter(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+
+    while position < len(expression):
+        match = _FILTER_TOKEN.match(expression, position)
+        if match is None or match.end() == position:
+            return None
+
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        position = match.end()
+
+    return tokens
+
+
+# operators that may start an operand
+_UNARY = ("!", "-", "+")
+
+
+def _well_formed(tokens):
+    """
+    Returns whether the tokens are a valid CALC expression: parentheses are
+    balanced and operands are separated by binary operators, so adjacent
+    names and function calls are rejected
+    """
+    depth = 0
+    # whether the last token ended an operand
+    after_operand = False
+
+    for kind, token in tokens:
+        if kind in ("name", "number"):
+            if after_operand:
+                return False
+
+            after_operand = True
+
+        elif token == "(":
+            if after_operand:
+                return False
+
+            depth += 1
+
+        elif token == ")":
+            depth -= 1
+            if depth < 0 or not after_operand:
+                return False
+
+        elif not after_operand and token not in _UNARY:
+            return False
+
+        else:
+            after_operand = False
+
+    return depth == 0 and after_operand
+
+
+def _outer_parentheses(tokens):
+    """
+    Returns whether the first and last tokens are a matching pair of
+    parentheses
+    """
+    if len(tokens) < 2 or tokens[0][1] != "(" or tokens[-1][1] != ")":
+        return False
+
+    depth = 0
+    for position, (_, token) in enumerate(tokens):
+        depth += {"(": 1, ")": -1}.get(token, 0)
+
+        if depth == 0 and position < len(tokens) - 1:
+            return False
+
+    return True
+
+
+def filter_to_forcepv(alarm_filter):
+    """
+    Returns the ALH directives equivalent to a Phoebus filter expression, or
+    None if the filter can't be expressed as a $FORCEPV
+    """
+    match = _FORCE_VALUE.match(alarm_filter)
+    expression, force_value = (match.group("expression"), match.group("value")) if match else (alarm_filter, None)
+
+    # a bare expression enables the alarm while it is non-zero
+    force = f"{force_value if force_value is not None else 0} NE"
+
+    tokens = _tokenize_filter(expression)
+    if not tokens or not _well_formed(tokens):
+        return None
+
+    # ALH fields can't contain whitespace
+    if any(kind == "name" and len(token.split()) != 1 for kind, token in tokens):
+        return None
+
+    if len(tokens) == 1 and tokens[0][0] == "name":
+        return [f"$FORCEPV {tokens[0][1].strip(_QUOTE)} {FORCE_MASK} {force}"]
+
+    if force_value is not None and _outer_parentheses(tokens):
+        tokens = tokens[1:-1]
+
+    # calc inputs A-L stand for the pvs of the expression
+    inputs = {}
+    calc = ""
+    for kind, token in tokens:
+        if kind == "name":
+            pvname = token.strip(_QUOTE)
+
+            if pvname not in inputs:
+                if len(inputs) == len(CALC_INPUTS):
+                    return None
+
+                inputs[pvname] = CALC_INPUTS[len(inputs)]
+
+            token = inputs[pvname]
+
+        calc += token
+
+    lines = [f"$FORCEPV CALC {FORCE_MASK} {force}", f"$FORCEPV_CALC {calc}"]
+    lines += [f"$FORCEPV_CALC_{letter} {pvname}" for pvname, letter in inputs.items()]
+
+    return lines
+
+
+def _alh_name(name):
+    # ALH fields are separated by whitespace
+    return re.sub(r"\s+", "_", (name or "").strip()) or "_"
+
+
+class _AlhOutput:
+    """
+    A single output file with the names of its open groups. A group reusing
+    the name of an open group would make later references ambiguous, so it
+    is written under a unique name with the original as its $ALIAS.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "w")
+        self.open_names = Counter()
+
+    def write(self, line):
+        self.file.write(line + "\n")
+
+    def open_group(self, name):
+        alh_name = _alh_name(name)
+        unique_name = alh_name
+        suffix = 1
+
+        while self.open_names[unique_name] or unique_name == "NULL":
+            suffix += 1
+            unique_name = f"{alh_name}_{suffix}"
+
+        self.open_names[unique_name] += 1
+        return unique_name
+
+    def close_group(self, alh_name):
+        self.open_names[alh_name] -= 1
+
+    def close(self):
+        self.file.close()
+
+
+class _Group:
+
+    def __init__(self, output, alh_name, parent_name):
+        self.output = output
+        self.alh_name = alh_name
+        self.parent_name = parent_name
+        self.has_children = False
+
+
+def _top_level_nodes(filename):
+    """
+    Returns up to two of the node tags directly under the config element
+    """
+    tags = []
+    depth = 0
+
+    with open(filename, "rb") as f:
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                depth += 1
+
+                if depth == 2 and elem.tag in ("component", "pv"):
+                    tags.append(elem.tag)
+
+                    if len(tags) > 1:
+                        break
+
+            else:
+                depth -= 1
+                elem.clear()
+
+    return tags
+
+
+class _Converter:
+
+    def __init__(self, output_filename, split_includes):
+        self.output_filename = output_filename
+        self.split_includes = split_includes
+        self.main = _AlhOutput(output_filename)
+        self.outputs = [self.main]
+        self.include_names = set()
+        self.groups = []
+        self.lost = Counter()
+
+    def _include_output(self, name):
+        stem, extension = os.path.splitext(self.output_filename)
+        base = f"{stem}_{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}"
+        filename = base + (extension or ".alhConfig")
+
+        suffix = 1
+        while filename in self.include_names:
+            suffix += 1
+            filename = f"{base}_{suffix}{extension or '.alhConfig'}"
+
+        self.include_names.add(filename)
+        output = _AlhOutput(filename)
+        self.outputs.append(output)
+
+        return output
+
+    def begin_group(self, name):
+        parent = self.groups[-1] if self.groups else None
+        output = parent.output if parent else self.main
+
+        if parent is not None:
+            parent.has_children = True
+
+        # top-level components sit directly below the ALH top group
+        if self.split_includes and len(self.groups) == 1:
+            include = self._include_output(name)
+            output.write(f"INCLUDE {parent.alh_name} {os.path.basename(include.filename)}")
+            output, parent = include, None
+
+        alh_name = output.open_group(name)
+        group = _Group(output, alh_name, parent.alh_name if parent else "NULL")
+        output.write(f"GROUP {group.parent_name} {alh_name}")
+
+        if alh_name != name:
+            output.write(f"$ALIAS {name}")
+
+        self.groups.append(group)
+
+    def end_group(self):
+        group = self.groups.pop()
+        group.output.close_group(group.alh_name)
+
+        if group.output is not self.main and (not self.groups or self.groups[-1].output is not group.output):
+            group.output.close()
+
+    def group_directives(self, lines):
+        group = self.groups[-1]
+
+        # directives follow the group's children, select the group again
+        if group.has_children:
+            group.output.write(f"GROUP {group.parent_name} {group.alh_name}")
+
+        for line in lines:
+            group.output.write(line)
+
+    def add_pv(self, elem):
+        group = self.groups[-1]
+        group.has_children = True
+        output = group.output
+
+        def text(tag):
+            value = elem.findtext(tag)
+            return value.strip() if value is not None else None
+
+        mask = ["-"] * 5
+        if (text("enabled") or "true").lower() == "false":
+            mask[1] = "D"
+
+        if (text("latching") or "true").lower() == "false":
+            mask[3] = "T"
+
+        line = f"CHANNEL {group.alh_name} {elem.attrib.get('name')}"
+        output.write(line + (" " + "".join(mask) if mask != ["-"] * 5 else ""))
+
+        if text("description"):
+            output.write(f"$ALIAS {' '.join(text('description').split())}")
+
+        if (text("annunciating") or "false").lower() == "true":
+            self.lost["annunciating"] += 1
+
+        count, delay = text("count"), text("delay")
+        if count and count != "0":
+            output.write(f"$ALARMCOUNTFILTER {count} {delay or 0}")
+
+        elif delay and delay != "0":
+            self.lost["delay without count"] += 1
+
+        alarm_filter = text("filter")
+        if alarm_filter:
+            lines = filter_to_forcepv(alarm_filter)
+
+            if lines is None:
+                self.lost["filter"] += 1
+
+            else:
+                for line in lines:
+                    output.write(line)
+
+        for line in self.record_directives(elem):
+            output.write(line)
+
+    def record_directives(self, elem):
+        lines = []
+
+        for record in elem:
+            details = record.findtext("details")
+
+            if record.tag == "guidance":
+                lines.append("$GUIDANCE")
+                lines += (details or "").strip().splitlines()
+                lines.append("$END")
+
+            elif record.tag == "command" and details:
+                lines.append(f"$COMMAND {' '.join(details.split())}")
+
+            elif record.tag in ("display", "automated_action"):
+                self.lost[record.tag] += 1
+
+        return lines
+
+    def close(self):
+        for output in self.outputs:
+            if not output.file.closed:
+                output.close()
+
+
+def convert_phoebus_to_alh(input_filename, output_filename, split_includes=False, warnings=None):
+    """
+    Converts a Phoebus configuration to an ALH configuration file. With
+    split_includes, each top-level component is written to its own file
+    included from the main file. Properties without an ALH equivalent are
+    added to warnings when a list is given and printed otherwise.
+
+    Returns the names of the files written.
+    """
+    report = warnings is None
+    if report:
+        warnings = []
+
+    # ALH has a single top group, which is the config's only component when
+    # it has one and a group named after the config otherwise
+    top_level = _top_level_nodes(input_filename)
+    wrap = top_level != ["component"]
+
+    converter = _Converter(output_filename, split_includes)
+    stack = []
+    # pvs and records are written once complete
+    pv = None
+    record = None
+
+    try:
+        for event, elem in ET.iterparse(input_filename, events=("start", "end")):
+            tag = elem.tag
+
+            if event == "start":
+                if record is not None or pv is not None:
+                    pass
+
+                elif tag == "pv":
+                    pv = elem
+
+                elif tag == "config":
+                    if wrap:
+                        converter.begin_group(elem.attrib.get("name"))
+
+                elif tag == "component":
+                    converter.begin_group(elem.attrib.get("name"))
+
+                elif tag in ("guidance", "display", "command", "automated_action"):
+                    record = elem
+
+                stack.append(elem)
+                continue
+
+            stack.pop()
+
+            if elem is record:
+                if converter.groups:
+                    converter.group_directives(converter.record_directives([elem]))
+
+                else:
+                    converter.lost[f"{tag} on the config"] += 1
+
+                record = None
+
+            elif elem is pv:
+                if converter.groups:
+                    converter.add_pv(elem)
+
+                else:
+                    converter.lost["pv outside a component"] += 1
+
+                pv = None
+
+            elif record is not None or pv is not None:
+                continue
+
+            elif tag == "component" or (tag == "config" and wrap):
+                converter.end_group()
+
+            # drop written elements to keep memory constant
+            elem.clear()
+            if stack and len(stack[-1]) and stack[-1][-1] is elem:
+                del stack[-1][-1]
+
+    finally:
+        converter.close()
+
+    for feature, count in sorted(converter.lost.items()):
+        warnings.append(f"{input_filename}: {feature} not converted on {count} nodes")
+
+    if report and warnings:
+        print("\n".join(warnings))
+
+    return [output.filename for output in converter.outputs]
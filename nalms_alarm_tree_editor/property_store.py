@@ -0,0 +1,305 @@
+"""
+Columnar storage of alarm tree node properties. Every property is a column
+with one entry per node, and commands and automated actions are interned in
+a shared record table. Nodes are stored in document order, so the subtree of
+a node occupies a contiguous range of rows.
+"""
+import sys
+from array import array
+
+
+BOOL_PROPERTIES = ("enabled", "latching", "annunciating")
+TEXT_PROPERTIES = ("description", "delay", "count", "alarm_filter")
+
+# short values that repeat across many nodes
+INTERNED_PROPERTIES = ("delay", "count", "alarm_filter")
+
+# child elements of guidance, display, command and automated_action records
+RECORD_FIELDS = {
+    "guidance": ("title", "details"),
+    "display": ("title", "details"),
+    "command": ("title", "details"),
+    "automated_action": ("title", "details", "delay"),
+}
+
+# tag of records holding any other child element of a node as serialized XML
+RAW_RECORD = "#element"
+
+_UNSET = -1
+
+
+def _to_bool(value):
+    if value is None:
+        return _UNSET
+
+    value = value.strip().lower()
+    if value == "true":
+        return 1
+
+    elif value == "false":
+        return 0
+
+    return _UNSET
+
+
+class RecordTable:
+    """
+    Interned command and automated action records shared by all nodes
+    """
+
+    def __init__(self):
+        self.records = []
+        self._ids = {}
+
+    def intern(self, tag, fields):
+        record = (tag,) + tuple(fields)
+        record_id = self._ids.get(record)
+
+        if record_id is None:
+            record_id = len(self.records)
+            self.records.append(record)
+            self._ids[record] = record_id
+
+        return record_id
+
+    def get(self, record_id):
+        return self.records[record_id]
+
+
+class PropertyStore:
+    """
+    Node properties for a single configuration. Row 0 is the configuration
+    root.
+    """
+
+    def __init__(self):
+        self.label = []
+        self.parent = array("l")
+        self.is_group = array("b")
+        self.subtree_end = array("l")
+
+        self.bools = {prop: array("b") for prop in BOOL_PROPERTIES}
+        self.texts = {prop: [] for prop in TEXT_PROPERTIES}
+
+        # tuples of record ids, shared empty tuple for nodes without records
+        self.record_ids = []
+        self.record_table = RecordTable()
+
+        self._paths = None
+        self._path_list = None
+        self._indexes = {}
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        """
+        Builds a store from a node list in document order, as returned by
+        parse_config or build_nodes. Nodes with children are groups.
+        """
+        store = cls()
+        parents = {parent_idx for _, parent_idx in nodes[1:]}
+        open_rows = []
+
+        for idx, (data, parent_idx) in enumerate(nodes):
+            while open_rows and open_rows[-1] != parent_idx:
+                store.close_node(open_rows.pop())
+
+            row = store.add_node(data["label"], -1 if parent_idx is None else parent_idx,
+                                 is_group=(idx in parents or idx == 0))
+
+            for prop, value in data.items():
+                if prop != "label":
+                    store.set_property(row, prop, value)
+
+            open_rows.append(row)
+
+        while open_rows:
+            store.close_node(open_rows.pop())
+
+        return store
+
+    def __len__(self):
+        return len(self.label)
+
+    def add_node(self, label, parent, is_group=False):
+        row = len(self.label)
+
+        self.label.append(label)
+        self.parent.append(parent)
+        self.is_group.append(1 if is_group else 0)
+        self.subtree_end.append(row + 1)
+
+        for column in self.bools.values():
+            column.append(_UNSET)
+
+        for column in self.texts.values():
+            column.append(None)
+
+        self.record_ids.append(())
+        self._paths = None
+        self._path_list = None
+        self._indexes = {}
+
+        return row
+
+    def extend(self, other, parent_row, include_root=True):
+        """
+        Appends the rows of another store under parent_row. Without
+        include_root, the other store's root row is dropped and its children
+        are attached to parent_row directly.
+        """
+        first = 0 if include_root else 1
+        offset = len(self.label) - first
+
+        self.label.extend(other.label[first:])
+        self.parent.extend(parent_row if parent < first else parent + offset for parent in other.parent[first:])
+        self.is_group.extend(other.is_group[first:])
+        self.subtree_end.extend(end + offset for end in other.subtree_end[first:])
+
+        for prop, column in other.bools.items():
+            self.bools[prop].extend(column[first:])
+
+        for prop, column in other.texts.items():
+            self.texts[prop].extend(column[first:])
+
+        # records are re-interned into this store's table
+        record_ids = [self.record_table.intern(record[0], record[1:]) for record in other.record_table.records]
+        self.record_ids.extend(tuple(record_ids[record_id] for record_id in ids) if ids else ()
+                               for ids in other.record_ids[first:])
+
+        self._paths = None
+        self._path_list = None
+        self._indexes = {}
+
+    def close_node(self, row):
+        """
+        Records the end of a node's subtree once all of its children are added
+        """
+        self.subtree_end[row] = len(self.label)
+
+    def set_property(self, row, prop, value):
+        self._indexes.pop(prop, None)
+
+        if prop in self.bools:
+            self.bools[prop][row] = _to_bool(value)
+
+        elif prop in self.texts:
+            if value is not None and prop in INTERNED_PROPERTIES:
+                value = sys.intern(value)
+
+            self.texts[prop][row] = value
+
+        else:
+            raise KeyError(f"Unknown property {prop}")
+
+    def add_record(self, row, tag, fields):
+        self.record_ids[row] += (self.record_table.intern(tag, fields),)
+
+    def records(self, row, tag=None):
+        """
+        Returns the (tag, *fields) records attached to a node
+        """
+        records = [self.record_table.get(record_id) for record_id in self.record_ids[row]]
+
+        if tag is not None:
+            records = [record for record in records if record[0] == tag]
+
+        return records
+
+    def node_data(self, row):
+        """
+        Returns the data dictionary for a node in the format produced by
+        PhoebusConfigTool.parse_config
+        """
+        data = {"label": self.label[row]}
+
+        for prop, column in self.bools.items():
+            if column[row] != _UNSET:
+                data[prop] = "true" if column[row] else "false"
+
+        for prop, column in self.texts.items():
+            if column[row] is not None:
+                data[prop] = column[row]
+
+        return data
+
+    def to_nodes(self):
+        nodes = [[self.node_data(0), None]]
+        nodes += [[self.node_data(row), self.parent[row]] for row in range(1, len(self.label))]
+
+        return nodes
+
+    def paths(self):
+        """
+        Returns the path of every row relative to the configuration root
+        """
+        if self._path_list is None:
+            paths = ["/"]
+            for row in range(1, len(self.label)):
+                parent_path = paths[self.parent[row]]
+                paths.append(parent_path.rstrip("/") + "/" + self.label[row])
+
+            self._path_list = paths
+
+        return self._path_list
+
+    def path(self, row):
+        return self.paths()[row]
+
+    def find(self, path):
+        """
+        Returns the row of a node by path relative to the configuration root,
+        such as "/LINAC/BPM01"
+        """
+        if self._paths is None:
+            self._paths = {path: row for row, path in enumerate(self.paths())}
+
+        return self._paths.get("/" + path.strip("/"))
+
+    def index(self, prop):
+        """
+        Returns a dictionary mapping each value of a property to the sorted
+        rows holding it. Indexes are built on first use and dropped when the
+        property changes.
+        """
+        index = self._indexes.get(prop)
+
+        if index is None:
+            column = self.bools[prop] if prop in self.bools else self.texts[prop]
+            index = {}
+
+            for row, value in enumerate(column):
+                index.setdefault(value, []).append(row)
+
+            self._indexes[prop] = index
+
+        return index
+
+    def select(self, path="/", pvs_only=True, **conditions):
+        """
+        Returns the rows under path whose properties equal the given values,
+        for example select("/LINAC", latching=False). Only the contiguous
+        row range of the subtree is scanned.
+        """
+        row = self.find(path)
+        if row is None:
+            return []
+
+        start, end = row, self.subtree_end[row]
+        rows = range(start, end)
+
+        if pvs_only:
+            is_group = self.is_group[start:end]
+            rows = [r for r, group in zip(rows, is_group) if not group]
+
+        for prop, value in conditions.items():
+            if prop in self.bools:
+                column = self.bools[prop]
+                expected = _UNSET if value is None else int(bool(value))
+
+            else:
+                column = self.texts[prop]
+                expected = value
+
+            rows = [r for r in rows if column[r] == expected]
+
+        return list(rows)
@@ -0,0 +1,338 @@
+"""
+Query language for bulk edits of a configuration's property store.
+
+    set delay=5, count=3 where path ~ "/LINAC/**/BPM*" and enabled=true
+    select where latching=false
+
+Queries match PVs. Conditions are joined with "and" and compare a property
+with "=" or "!=", or match path or label against a glob with "~". In path
+globs "*" matches within one level and "**" matches any number of levels.
+Flags missing from a PV compare as their Phoebus defaults.
+"""
+import bisect
+import heapq
+import re
+
+from nalms_alarm_tree_editor.aggregates import DEFAULTS
+from nalms_alarm_tree_editor.property_store import BOOL_PROPERTIES, TEXT_PROPERTIES
+
+
+# names accepted in queries for store properties
+PROPERTY_NAMES = {prop: prop for prop in BOOL_PROPERTIES + TEXT_PROPERTIES}
+PROPERTY_NAMES["filter"] = "alarm_filter"
+
+_TOKEN = re.compile(r'\s*(?:(?P<string>"(?:[^"\\]|\\.)*")|(?P<op>!=|=|~|,)|(?P<word>[^\s=!~,"]+))')
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+class Query:
+
+    def __init__(self, action, assignments, conditions):
+        self.action = action
+        # property -> value
+        self.assignments = assignments
+        # (field, operator, value)
+        self.conditions = conditions
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None or match.end() == position:
+            raise QuerySyntaxError(f"Unexpected input at: {text[position:]}")
+
+        if match.group("string") is not None:
+            value = match.group("string")[1:-1]
+            tokens.append(("value", re.sub(r"\\(.)", r"\1", value)))
+
+        elif match.group("op") is not None:
+            tokens.append(("op", match.group("op")))
+
+        else:
+            tokens.append(("word", match.group("word")))
+
+        position = match.end()
+
+    return tokens
+
+
+def _property_name(name):
+    prop = PROPERTY_NAMES.get(name.lower())
+    if prop is None:
+        raise QuerySyntaxError(f"Unknown property: {name}")
+
+    return prop
+
+
+def _normalize(prop, value):
+    if prop in BOOL_PROPERTIES:
+        if value.lower() not in ("true", "false"):
+            raise QuerySyntaxError(f"{prop} must be true or false")
+
+        return value.lower() == "true"
+
+    return value
+
+
+def parse_query(text):
+    """
+    Parses query text into a Query. Raises QuerySyntaxError for invalid
+    queries.
+    """
+    tokens = _tokenize(text)
+    position = 0
+
+    def take(kind=None, value=None):
+        nonlocal position
+        if position >= len(tokens):
+            raise QuerySyntaxError("Unexpected end of query")
+
+        token = tokens[position]
+        if (kind and token[0] != kind) or (value and token[1].lower() != value):
+            raise QuerySyntaxError(f"Unexpected {token[1]!r}")
+
+        position += 1
+        return token[1]
+
+    def take_value():
+        nonlocal position
+        if position >= len(tokens) or tokens[position][0] == "op":
+            raise QuerySyntaxError("Expected a value")
+
+        position += 1
+        return tokens[position - 1][1]
+
+    def at(value):
+        return position < len(tokens) and tokens[position][0] == "word" and tokens[position][1].lower() == value
+
+    action = take("word").lower()
+    if action not in ("set", "select"):
+        raise QuerySyntaxError("Query must start with set or select")
+
+    assignments = {}
+    if action == "set":
+        while True:
+            prop = _property_name(take("word"))
+            take("op", "=")
+            assignments[prop] = _normalize(prop, take_value())
+
+            if position < len(tokens) and tokens[position] == ("op", ","):
+                position += 1
+
+            else:
+                break
+
+    conditions = []
+    if at("where"):
+        position += 1
+
+        while True:
+            field = take("word").lower()
+            operator = take("op")
+            value = take_value()
+
+            if field in ("path", "label"):
+                if operator not in ("=", "~"):
+                    raise QuerySyntaxError(f"{field} supports = and ~")
+
+            else:
+                field = _property_name(field)
+                if operator not in ("=", "!="):
+                    raise QuerySyntaxError(f"{field} supports = and !=")
+
+                value = _normalize(field, value)
+
+            conditions.append((field, operator, value))
+
+            if at("and"):
+                position += 1
+
+            else:
+                break
+
+    if position != len(tokens):
+        raise QuerySyntaxError(f"Unexpected {tokens[position][1]!r}")
+
+    return Query(action, assignments, conditions)
+
+
+def _glob_regex(pattern, path=True):
+    regex = ""
+    for part in re.split(r"(\*\*/?|\*|\?)", pattern):
+        if part in ("**", "**/"):
+            regex += "(?:.*/)?" if part == "**/" and path else ".*"
+
+        elif part == "*":
+            regex += "[^/]*" if path else ".*"
+
+        elif part == "?":
+            regex += "[^/]" if path else "."
+
+        else:
+            regex += re.escape(part)
+
+    return re.compile(regex)
+
+
+def _literal_prefix(pattern):
+    """
+    Returns the leading path levels of a glob that contain no wildcards
+    """
+    parts = []
+    for part in pattern.strip("/").split("/"):
+        if any(char in part for char in "*?"):
+            break
+
+        parts.append(part)
+
+    return "/" + "/".join(parts)
+
+
+class QueryPlan:
+    """
+    Row range and predicate order used to evaluate a query's conditions.
+    Path prefixes restrict the scan to a subtree, indexed equality
+    predicates are intersected from the most selective, and the remaining
+    predicates are checked on the surviving rows.
+    """
+
+    def __init__(self, store, query):
+        self.start = 0
+        self.end = len(store)
+        self.index_lookups = []
+        self.residual = []
+
+        for field, operator, value in query.conditions:
+            if field == "path":
+                pattern = value if value.startswith("/") else "/" + value
+                prefix = pattern if operator == "=" else _literal_prefix(pattern)
+                row = store.find(prefix)
+
+                if row is None:
+                    self.start = self.end = 0
+
+                elif self.start <= row < self.end:
+                    self.start, self.end = row, min(self.end, store.subtree_end[row])
+
+                elif not (row <= self.start < store.subtree_end[row]):
+                    self.start = self.end = 0
+
+                if operator == "~":
+                    self.residual.append((field, operator, _glob_regex(pattern)))
+
+                else:
+                    self.residual.append((field, operator, pattern))
+
+            elif field == "label":
+                if operator == "~":
+                    value = _glob_regex(value, path=False)
+
+                self.residual.append((field, operator, value))
+
+            elif operator == "=":
+                index = store.index(field)
+
+                if field in BOOL_PROPERTIES:
+                    rows = index.get(int(value), [])
+
+                    # unset flags take their Phoebus default
+                    if DEFAULTS[field] == value:
+                        rows = list(heapq.merge(rows, index.get(-1, [])))
+
+                else:
+                    rows = index.get(value, [])
+
+                self.index_lookups.append(rows)
+
+            else:
+                self.residual.append((field, operator, value))
+
+        # most selective index first
+        self.index_lookups.sort(key=len)
+
+    def estimate(self):
+        """
+        Upper bound of rows that reach the residual predicates
+        """
+        if self.index_lookups:
+            return min(self.end - self.start, len(self.index_lookups[0]))
+
+        return self.end - self.start
+
+
+def _range_rows(rows, start, end):
+    return rows[bisect.bisect_left(rows, start):bisect.bisect_left(rows, end)]
+
+
+def select_rows(store, query):
+    """
+    Returns the PV rows matching the query's conditions
+    """
+    plan = QueryPlan(store, query)
+
+    if plan.start >= plan.end:
+        return []
+
+    if plan.index_lookups:
+        rows = _range_rows(plan.index_lookups[0], plan.start, plan.end)
+
+        for lookup in plan.index_lookups[1:]:
+            if not rows:
+                break
+
+            selected = set(_range_rows(lookup, plan.start, plan.end))
+            rows = [row for row in rows if row in selected]
+
+    else:
+        rows = range(plan.start, plan.end)
+
+    rows = [row for row in rows if not store.is_group[row]]
+
+    if plan.residual:
+        paths = store.paths()
+
+        for field, operator, value in plan.residual:
+            if field in ("path", "label"):
+                column = paths if field == "path" else store.label
+
+                if operator == "~":
+                    rows = [row for row in rows if value.fullmatch(column[row])]
+
+                else:
+                    rows = [row for row in rows if column[row] == value]
+
+            elif field in BOOL_PROPERTIES:
+                column, value, default = store.bools[field], int(value), int(DEFAULTS[field])
+                rows = [row for row in rows if (default if column[row] < 0 else column[row]) != value]
+
+            else:
+                column = store.texts[field]
+                rows = [row for row in rows if column[row] != value]
+
+    return rows
+
+
+def run_query(store, text, dry_run=False):
+    """
+    Runs a query against a property store. Returns the matching rows; for
+    set queries the assignments are applied unless dry_run is given.
+    """
+    query = parse_query(text)
+    rows = select_rows(store, query)
+
+    if query.action == "set" and not dry_run:
+        for prop, value in query.assignments.items():
+            if prop in BOOL_PROPERTIES:
+                value = "true" if value else "false"
+
+            for row in rows:
+                store.set_property(row, prop, value)
+
+    return rows
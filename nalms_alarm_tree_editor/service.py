@@ -0,0 +1,342 @@
+"""
+Long-running conversion and validation service. Parsed ALH trees and
+Phoebus configurations stay in memory between requests, so tools can send
+many small requests without paying for interpreter startup and parsing each
+time.
+
+Requests and responses are single JSON objects per line, sent over a Unix
+socket that only its owner can connect to, or a localhost TCP port:
+
+    {"op": "convert", "input": "top.alhConfig", "output": "top.xml"}
+    {"op": "validate", "filename": "top.xml"}
+    {"op": "diff", "old": "before.xml", "new": "after.xml"}
+    {"op": "stats"}
+
+The service has no authentication of its own. Serving on TCP requires an
+output directory, and convert requests can only write inside it.
+"""
+import asyncio
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from nalms_alarm_tree_editor.phoebus_config import PhoebusConfigTool
+
+
+DEFAULT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or os.path.expanduser("~"), "nalms_service.sock")
+
+# large configurations produce long responses, allow generous lines
+STREAM_LIMIT = 2 ** 26
+
+
+def _file_stamp(filename):
+    stat = os.stat(filename)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class ConfigCache:
+    """
+    Least recently used cache of parsed configurations. Entries record the
+    modification stamps of every file they were built from and are reloaded
+    when any of those files changes.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() on a miss. The
+        loader returns (value, filenames).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                value, stamps = entry
+
+                try:
+                    valid = all(_file_stamp(filename) == stamp for filename, stamp in stamps.items())
+
+                except OSError:
+                    valid = False
+
+                if valid:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self._entries[key]
+
+            self.misses += 1
+
+        value, filenames = loader()
+        stamps = {filename: _file_stamp(filename) for filename in filenames}
+
+        with self._lock:
+            self._entries[key] = (value, stamps)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ConversionService:
+    """
+    Handles service requests against a shared cache
+    """
+
+    def __init__(self, cache_size=32, output_dir=None):
+        self.cache = ConfigCache(cache_size)
+        self.output_dir = os.path.realpath(output_dir) if output_dir else None
+
+    def handle(self, request):
+        handler = getattr(self, f"_handle_{request.get('op')}", None)
+
+        if handler is None:
+            return {"ok": False, "error": f"Unknown operation: {request.get('op')}"}
+
+        try:
+            response = handler(request)
+
+        except Exception as e:
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+        response["ok"] = True
+        return response
+
+    def alh_graph(self, filename):
+        """
+        Returns the include graph of an ALH configuration and the files it
+        was built from
+        """
+        from nalms_alarm_tree_editor.alh_conversion import load_include_graph
+
+        filename = os.path.abspath(filename)
+
+        def load():
+            parsed = load_include_graph(filename)
+            return (parsed, list(parsed)), list(parsed)
+
+        return self.cache.get(("alh", filename), load)
+
+    def phoebus_config(self, filename):
+        """
+        Returns a PhoebusConfigTool holding a parsed configuration. ALH files
+        are converted first.
+        """
+        filename = os.path.abspath(filename)
+
+        if filename.endswith("alhConfig"):
+            from nalms_alarm_tree_editor.alh_conversion import write_graph_config
+
+            def load():
+                parsed, filenames = self.alh_graph(filename)
+                config_name = os.path.basename(filename).replace(".alhConfig", "")
+                config = io.BytesIO()
+                write_graph_config(parsed, filename, config_name, config)
+                config.seek(0)
+
+                config_tool = PhoebusConfigTool()
+                config_tool.parse_config(config)
+
+                return config_tool, filenames
+
+        else:
+            def load():
+                config_tool = PhoebusConfigTool()
+                config_tool.parse_config(filename)
+                return config_tool, [filename]
+
+        return self.cache.get(("phoebus", filename), load)
+
+    def output_path(self, output):
+        """
+        Returns the absolute path of a conversion output. With an output
+        directory, relative paths are taken from it and paths resolving
+        outside it are rejected.
+        """
+        if self.output_dir is None:
+            return os.path.abspath(output)
+
+        path = os.path.realpath(os.path.join(self.output_dir, output))
+        if os.path.commonpath([path, self.output_dir]) != self.output_dir:
+            raise PermissionError(f"Output is outside {self.output_dir}: {output}")
+
+        return path
+
+    def _handle_convert(self, request):
+        from nalms_alarm_tree_editor.alh_conversion import write_graph_config
+
+        output = self.output_path(request["output"])
+        config_name = request.get("config_name") or os.path.basename(output).replace(".xml", "")
+        input_filename = os.path.abspath(request["input"])
+        parsed, _ = self.alh_graph(input_filename)
+
+        with open(output, "wb") as f:
+            write_graph_config(parsed, input_filename, config_name, f)
+
+        return {"output": output}
+
+    def _handle_validate(self, request):
+        store = self.phoebus_config(request["filename"]).store
+        problems = []
+        seen = {}
+
+        for row in range(1, len(store)):
+            path = store.path(row)
+
+            if not store.label[row]:
+                problems.append(f"{path}: missing name")
+
+            if store.is_group[row]:
+                continue
+
+            if store.label[row] in seen:
+                problems.append(f"{path}: duplicate PV, also at {seen[store.label[row]]}")
+
+            else:
+                seen[store.label[row]] = path
+
+            for prop in ("delay", "count"):
+                value = store.texts[prop][row]
+                if value is not None and not value.strip().isdigit():
+                    problems.append(f"{path}: {prop} is not an integer: {value}")
+
+        return {"problems": problems, "pv_count": len(seen)}
+
+    def _handle_diff(self, request):
+        old = self.phoebus_config(request["old"]).store
+        new = self.phoebus_config(request["new"]).store
+
+        old_rows = {path: row for row, path in enumerate(old.paths())}
+        new_rows = {path: row for row, path in enumerate(new.paths())}
+
+        changed = {}
+        for path in old_rows.keys() & new_rows.keys():
+            old_data = old.node_data(old_rows[path])
+            new_data = new.node_data(new_rows[path])
+
+            old_records = old.records(old_rows[path])
+            new_records = new.records(new_rows[path])
+
+            if old_data != new_data or old_records != new_records:
+                changed[path] = {
+                    prop: [old_data.get(prop), new_data.get(prop)]
+                    for prop in old_data.keys() | new_data.keys()
+                    if old_data.get(prop) != new_data.get(prop)
+                }
+
+                if old_records != new_records:
+                    changed[path]["records"] = [old_records, new_records]
+
+        return {
+            "added": sorted(new_rows.keys() - old_rows.keys()),
+            "removed": sorted(old_rows.keys() - new_rows.keys()),
+            "changed": changed,
+        }
+
+    def _handle_stats(self, request):
+        return {"cached": len(self.cache), "hits": self.cache.hits, "misses": self.cache.misses}
+
+
+async def serve(address, service=None, workers=4):
+    """
+    Serves requests on address, either "unix:<path>" or "<host>:<port>",
+    running each request on a pool of worker threads. The Unix socket is
+    created with mode 0600. TCP connections can't be restricted to a user,
+    so serving on TCP requires a service with an output directory.
+    """
+    service = service or ConversionService()
+
+    if not address.startswith("unix:") and service.output_dir is None:
+        raise ValueError("Serving on TCP requires an output directory")
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    loop = asyncio.get_running_loop()
+
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line)
+
+                except ValueError as e:
+                    response = {"ok": False, "error": f"Invalid request: {e}"}
+
+                else:
+                    response = await loop.run_in_executor(pool, service.handle, request)
+
+                writer.write(json.dumps(response).encode("utf8") + b"\n")
+                await writer.drain()
+
+        finally:
+            writer.close()
+
+    if address.startswith("unix:"):
+        # create the socket without group and world access, rather than
+        # leaving a window open before a chmod
+        umask = os.umask(0o177)
+
+        try:
+            server = await asyncio.start_unix_server(handle_connection, path=address[5:], limit=STREAM_LIMIT)
+
+        finally:
+            os.umask(umask)
+
+    else:
+        host, _, port = address.rpartition(":")
+        server = await asyncio.start_server(handle_connection, host or "127.0.0.1", int(port), limit=STREAM_LIMIT)
+
+    try:
+        async with server:
+            await server.serve_forever()
+
+    finally:
+        pool.shutdown(wait=False)
+
+
+class ServiceClient:
+    """
+    Blocking client keeping one connection open for many requests
+    """
+
+    def __init__(self, address=f"unix:{DEFAULT_SOCKET}"):
+        import socket
+
+        if address.startswith("unix:"):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(address[5:])
+
+        else:
+            host, _, port = address.rpartition(":")
+            self._socket = socket.create_connection((host or "127.0.0.1", int(port)))
+
+        self._file = self._socket.makefile("rwb")
+
+    def request(self, op, **kwargs):
+        kwargs["op"] = op
+        self._file.write(json.dumps(kwargs).encode("utf8") + b"\n")
+        self._file.flush()
+
+        return json.loads(self._file.readline())
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
@@ -0,0 +1,229 @@
+"""
+Sharded layout for Phoebus configurations. Each top-level component is
+written to its own file, and a manifest lists the shards in order with their
+hashes. PVs and records placed directly under the config go to a root shard.
+
+    manifest.json
+    _config.xml
+    000_LINAC.xml
+    001_GUN.xml
+
+Shards are written on a thread pool and parsed on a process pool. Only
+shards whose contents changed are rewritten or re-parsed.
+"""
+import hashlib
+import json
+import os
+import re
+import stat
+import tempfile
+import xml.etree.ElementTree as ET
+
+
+MANIFEST = "manifest.json"
+ROOT_SHARD = "_config.xml"
+
+
+# the umask can only be read by replacing it, which is not safe once
+# shards are written from several threads
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+def _write_atomic(filename, chunks):
+    """
+    Writes chunks of bytes to a temporary file next to filename and renames
+    it into place. The file keeps the mode of the file it replaces, or gets
+    the mode open() would give a new file, rather than the 0600 of the
+    temporary file.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        try:
+            f.writelines(chunks)
+            f.flush()
+            os.fsync(f.fileno())
+            os.chmod(f.name, mode)
+
+        except Exception:
+            os.unlink(f.name)
+            raise
+
+    os.replace(f.name, filename)
+
+
+def _shard_filename(position, name):
+    return f"{position:03d}_{re.sub(r'[^A-Za-z0-9_.-]', '_', name or '')[:64]}.xml"
+
+
+def _hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST)) as f:
+        return json.load(f)
+
+
+def write_shards(directory, config_name, root_shard, components, workers=None):
+    """
+    Writes a sharded configuration. root_shard is the serialized config
+    element holding the records and PVs directly under the config, and
+    components is a list of (name, serialized component) pairs.
+
+    Returns the number of shard files written. Shards whose hash matches
+    the existing manifest are not rewritten.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    os.makedirs(directory, exist_ok=True)
+
+    try:
+        previous = {shard["file"]: shard["sha256"] for shard in read_manifest(directory)["shards"]}
+
+    except (OSError, ValueError, KeyError):
+        previous = {}
+
+    shards = [{"name": None, "file": ROOT_SHARD, "data": root_shard}]
+    shards += [{"name": name, "file": _shard_filename(position, name), "data": data}
+               for position, (name, data) in enumerate(components)]
+
+    to_write = []
+    for shard in shards:
+        shard["sha256"] = _hash(shard["data"])
+        path = os.path.join(directory, shard["file"])
+
+        if previous.get(shard["file"]) != shard["sha256"] or not os.path.exists(path):
+            to_write.append((path, [shard["data"]]))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda args: _write_atomic(*args), to_write))
+
+    manifest = {
+        "config": config_name,
+        "shards": [{key: shard[key] for key in ("name", "file", "sha256")} for shard in shards],
+    }
+    _write_atomic(os.path.join(directory, MANIFEST), [json.dumps(manifest, indent=1).encode("utf8")])
+
+    # remove shards of components that no longer exist
+    current = {shard["file"] for shard in shards}
+    for filename in previous:
+        if filename not in current and os.path.exists(os.path.join(directory, filename)):
+            os.remove(os.path.join(directory, filename))
+
+    return len(to_write)
+
+
+def write_config_shards(configuration, directory, workers=None):
+    """
+    Writes a config element, such as the one built by
+    alh_conversion.build_config, as a sharded configuration
+    """
+    root = ET.Element("config", name=configuration.attrib.get("name"))
+    components = []
+
+    for child in configuration:
+        if child.tag == "component":
+            components.append((child.attrib.get("name"), ET.tostring(child, encoding="unicode").encode("utf8")))
+
+        else:
+            root.append(child)
+
+    # keep an explicit end tag for assembly
+    root_shard = ET.tostring(root, encoding="unicode", short_empty_elements=False).encode("utf8")
+
+    return write_shards(directory, configuration.attrib.get("name"), root_shard, components, workers=workers)
+
+
+def assemble(directory, output_filename):
+    """
+    Joins a sharded configuration into a single configuration file for
+    tools that require one
+    """
+    manifest = read_manifest(directory)
+    end_tag = b"</config>"
+
+    chunks = [b"<?xml version='1.0' encoding='utf8'?>\n"]
+    for shard in manifest["shards"]:
+        with open(os.path.join(directory, shard["file"]), "rb") as f:
+            data = f.read().strip()
+
+        if shard["file"] == ROOT_SHARD:
+            if not data.endswith(end_tag):
+                raise ValueError(f"Malformed root shard in {directory}")
+
+            data = data[:-len(end_tag)]
+
+        chunks.append(data)
+
+    chunks.append(end_tag)
+    _write_atomic(output_filename, chunks)
+
+
+def _parse_shard(filename):
+    from nalms_alarm_tree_editor.phoebus_config import parse_store
+
+    return parse_store(filename)
+
+
+def load_shards(directory, previous=None, workers=None):
+    """
+    Parses a sharded configuration into a single PropertyStore.
+
+    previous maps shard filenames to (sha256, store) from an earlier load;
+    shards whose contents still hash the same are reused rather than parsed.
+    Returns the store and the updated shard mapping.
+    """
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    from nalms_alarm_tree_editor.property_store import PropertyStore
+
+    previous = previous or {}
+    manifest = read_manifest(directory)
+    filenames = [os.path.abspath(os.path.join(directory, shard["file"])) for shard in manifest["shards"]]
+
+    def file_hash(filename):
+        with open(filename, "rb") as f:
+            return _hash(f.read())
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes = list(pool.map(file_hash, filenames))
+
+    to_parse = [filename for filename, sha in zip(filenames, hashes)
+                if previous.get(filename, (None,))[0] != sha]
+
+    if len(to_parse) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parsed = dict(zip(to_parse, pool.map(_parse_shard, to_parse)))
+
+    else:
+        parsed = {filename: _parse_shard(filename) for filename in to_parse}
+
+    shards = {}
+    for filename, sha in zip(filenames, hashes):
+        shards[filename] = (sha, parsed[filename] if filename in parsed else previous[filename][1])
+
+    store = PropertyStore()
+    store.add_node(manifest["config"], -1, is_group=True)
+
+    for filename in filenames:
+        shard_store = shards[filename][1]
+
+        if os.path.basename(filename) == ROOT_SHARD:
+            for record in shard_store.records(0):
+                store.add_record(0, record[0], record[1:])
+
+            store.extend(shard_store, 0, include_root=False)
+
+        else:
+            store.extend(shard_store, 0)
+
+    store.close_node(0)
+
+    return store, shards
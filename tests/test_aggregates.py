@@ -0,0 +1,178 @@
+import random
+
+from nalms_alarm_tree_editor.aggregates import FIELDS, SubtreeAggregates, pv_counts
+from nalms_alarm_tree_editor.property_store import PropertyStore
+
+
+class Node:
+
+    def __init__(self, name, parent=None, counts=None):
+        self.name = name
+        self.parent = parent
+        self.children = []
+        # pv_counts of a PV, None for a group
+        self.counts = counts
+
+        if parent is not None:
+            parent.children.append(self)
+
+    def __repr__(self):
+        return self.name
+
+
+def _walk(root):
+    nodes = [root]
+    for node in nodes:
+        nodes += node.children
+
+    return nodes
+
+
+def _recount(node):
+    if node.counts is not None:
+        return dict(zip(FIELDS, node.counts))
+
+    totals = dict.fromkeys(FIELDS, 0)
+    for child in node.children:
+        for field, count in _recount(child).items():
+            totals[field] += count
+
+    return totals
+
+
+def _check(aggregates, root):
+    for node in _walk(root):
+        assert aggregates.totals(node) == _recount(node), node
+
+
+def _random_counts(generator):
+    flags = [generator.choice((None, True, False)) for _ in range(3)]
+    return pv_counts(*flags, generator.choice(("", "MODE")))
+
+
+def _aggregates(root):
+    aggregates = SubtreeAggregates(lambda node: node.parent)
+    aggregates.add_tree(root, lambda node: node.children, lambda node: node.counts)
+    return aggregates
+
+
+def test_totals_follow_add_remove_and_move():
+    generator = random.Random(11)
+    root = Node("root")
+    groups = [root]
+    aggregates = _aggregates(root)
+
+    for step in range(400):
+        operation = generator.choice(("add", "add", "add", "remove", "move", "move", "set", "set"))
+        nodes = _walk(root)[1:]
+
+        if operation == "add" or not nodes:
+            parent = generator.choice(groups)
+            is_group = generator.random() < 0.3
+            node = Node(f"N{step}", parent, None if is_group else _random_counts(generator))
+
+            # a subtree is built before it is attached
+            if is_group:
+                groups.append(node)
+                for child in range(generator.randrange(3)):
+                    Node(f"N{step}_{child}", node, _random_counts(generator))
+
+            aggregates.add_tree(node, lambda item: item.children, lambda item: item.counts)
+            aggregates.attach(node)
+
+        elif operation == "remove":
+            node = generator.choice(nodes)
+            aggregates.detach(node)
+            aggregates.forget(node, lambda item: item.children)
+            node.parent.children.remove(node)
+
+            removed = set(_walk(node))
+            groups = [group for group in groups if group not in removed]
+
+        elif operation == "move":
+            node = generator.choice(nodes)
+            targets = [group for group in groups if group not in set(_walk(node))]
+
+            aggregates.detach(node)
+            node.parent.children.remove(node)
+            node.parent = generator.choice(targets)
+            node.parent.children.append(node)
+            aggregates.attach(node)
+
+        else:
+            pvs = [node for node in nodes if node.counts is not None]
+            if pvs:
+                node = generator.choice(pvs)
+                node.counts = _random_counts(generator)
+                aggregates.set_pv(node, node.counts)
+
+        _check(aggregates, root)
+
+
+def test_pv_becoming_a_group():
+    root = Node("root")
+    group = Node("G", root)
+    pv = Node("PV", group, pv_counts(None, None, None, "MODE"))
+    aggregates = _aggregates(root)
+
+    aggregates.remove_pv(pv)
+    pv.counts = None
+    child = Node("CHILD", pv, pv_counts(False, None, True, ""))
+    aggregates.add_tree(child, lambda item: item.children, lambda item: item.counts)
+    aggregates.attach(child)
+
+    _check(aggregates, root)
+    assert aggregates.totals(root) == {"pvs": 1, "enabled": 0, "latching": 1, "annunciating": 1, "with_filter": 0}
+
+
+def test_from_store_matches_a_recount():
+    nodes = [[{"label": "config"}, None]]
+    generator = random.Random(5)
+    groups = [0]
+
+    for index in range(1, 300):
+        parent = generator.choice(groups)
+
+        if generator.random() < 0.2:
+            groups.append(index)
+            nodes.append([{"label": f"G{index}"}, parent])
+
+        else:
+            data = {"label": f"PV{index}"}
+            for prop in ("enabled", "latching", "annunciating"):
+                value = generator.choice((None, "true", "false"))
+                if value is not None:
+                    data[prop] = value
+
+            if generator.random() < 0.3:
+                data["alarm_filter"] = "MODE"
+
+            nodes.append([data, parent])
+
+    # the store lists nodes in document order
+    children = {}
+    for index, (_, parent) in enumerate(nodes[1:], start=1):
+        children.setdefault(parent, []).append(index)
+
+    order = []
+    to_process = [(0, None)]
+    while to_process:
+        index, parent = to_process.pop()
+        order.append((index, parent))
+        to_process += [(child, len(order) - 1) for child in reversed(children.get(index, []))]
+
+    store = PropertyStore.from_nodes([[nodes[index][0], parent] for index, parent in order])
+    aggregates = SubtreeAggregates.from_store(store)
+
+    tree = []
+    for row in range(len(store)):
+        data = store.node_data(row)
+        counts = None
+        if not store.is_group[row]:
+            counts = pv_counts(*[None if data.get(prop) is None else data[prop] == "true"
+                                 for prop in ("enabled", "latching", "annunciating")], data.get("alarm_filter"))
+
+        tree.append(Node(store.label[row], tree[store.parent[row]] if row else None, counts))
+
+    for row, node in enumerate(tree):
+        assert aggregates.totals(row) == _recount(node)
@@ -0,0 +1,120 @@
+import json
+import random
+import time
+
+from nalms_alarm_tree_editor.alarm_state import SEVERITIES, SeverityRollup, StandInBroker, StateCoalescer, \
+    StateListener, open_state_source, parse_state_message
+
+
+# path -> parent path
+PARENTS = {
+    "/A": None,
+    "/A/B": "/A",
+    "/A/B/PV1": "/A/B",
+    "/A/B/PV2": "/A/B",
+    "/A/C": "/A",
+    "/A/C/PV3": "/A/C",
+    "/A/PV4": "/A",
+}
+
+PVS = ["/A/B/PV1", "/A/B/PV2", "/A/C/PV3", "/A/PV4"]
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    return condition()
+
+
+def test_bursts_coalesce_to_the_latest_state():
+    coalescer = StateCoalescer()
+
+    for severity in SEVERITIES:
+        coalescer.put("/A/B/PV1", severity)
+
+    coalescer.put("/A/PV4", "MAJOR")
+
+    assert coalescer.drain() == {"/A/B/PV1": "UNDEFINED", "/A/PV4": "MAJOR"}
+    assert coalescer.received == len(SEVERITIES) + 1
+    assert coalescer.drain() == {}
+
+
+def test_stand_in_broker_feeds_the_coalescer():
+    broker = StandInBroker()
+    broker.publish_state("/A/PV4", "MINOR")
+    broker.publish("config:/A/PV4", json.dumps({"enabled": True}))
+
+    coalescer = StateCoalescer()
+    listener = StateListener(open_state_source(broker.url, "TEST"), coalescer)
+    listener.start()
+
+    try:
+        # the latest state is replayed to new connections
+        assert _wait_for(lambda: coalescer.received == 1)
+
+        broker.publish_many([("state:/A/B/PV1", json.dumps({"severity": severity})) for severity in SEVERITIES]
+                            + [("state:/A/PV4", None)])
+        assert _wait_for(lambda: coalescer.received == len(SEVERITIES) + 2)
+
+        assert coalescer.drain() == {"/A/PV4": None, "/A/B/PV1": "UNDEFINED"}
+
+    finally:
+        listener.stop()
+        listener.join(timeout=5)
+        broker.close()
+
+
+def test_state_messages_are_parsed():
+    assert parse_state_message(b"state:/A/PV4", '{"severity": "MAJOR"}') == ("/A/PV4", "MAJOR")
+    assert parse_state_message("state:/A/PV4", None) == ("/A/PV4", None)
+    assert parse_state_message("state:/A/PV4", '{"severity": "LOUD"}') == ("/A/PV4", None)
+    assert parse_state_message("command:/A/PV4", '{"severity": "MAJOR"}') is None
+
+
+def _expected_severity(levels, node):
+    below = [level for pv, level in levels.items() if pv == node or pv.startswith(node + "/")]
+    return SEVERITIES[max(below)] if below else None
+
+
+def test_rollup_raises_and_clears_ancestors():
+    rollup = SeverityRollup(PARENTS.get)
+
+    assert rollup.set("/A/B/PV1", "MINOR") == ["/A/B/PV1", "/A/B", "/A"]
+    assert rollup.set("/A/C/PV3", "MAJOR") == ["/A/C/PV3", "/A/C", "/A"]
+    assert rollup.severity("/A") == "MAJOR"
+    assert rollup.severity("/A/B") == "MINOR"
+
+    # the minor alarm stays after the major one clears
+    assert rollup.set("/A/C/PV3", None) == ["/A/C/PV3", "/A/C", "/A"]
+    assert rollup.severity("/A") == "MINOR"
+    assert rollup.severity("/A/C") is None
+
+    assert rollup.set("/A/B/PV1", "OK") == ["/A/B/PV1", "/A/B", "/A"]
+    assert rollup.severity("/A") == "OK"
+    assert rollup.set("/A/B/PV1", "OK") == []
+
+
+def test_rollup_matches_a_recompute():
+    rollup = SeverityRollup(PARENTS.get)
+    levels = {}
+    generator = random.Random(7)
+
+    for _ in range(500):
+        pv = generator.choice(PVS)
+        severity = generator.choice(SEVERITIES + (None,))
+        before = {node: rollup.severity(node) for node in PARENTS}
+
+        changed = rollup.set(pv, severity)
+
+        if severity is None:
+            levels.pop(pv, None)
+
+        else:
+            levels[pv] = SEVERITIES.index(severity)
+
+        for node in PARENTS:
+            assert rollup.severity(node) == _expected_severity(levels, node)
+
+        assert sorted(changed) == sorted(node for node in PARENTS if rollup.severity(node) != before[node])
@@ -0,0 +1,154 @@
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from nalms_alarm_tree_editor import alh_conversion, cli
+from nalms_alarm_tree_editor.alh_conversion import DIRECTIVE_HANDLERS, IncludeCycleError, _target, \
+    convert_alh_to_phoebus, load_include_graph, parse_alh_file, register_directive, resolve_include
+
+
+def _write_alh(path, group, pvname, guidance):
+    path.write_text(f"GROUP NULL {group}\nCHANNEL {group} {pvname}\n$GUIDANCE\n{guidance}\n$END\n")
+    return str(path)
+
+
+def _guidance(filename):
+    return [elem.text for elem in ET.parse(filename).iter("details")]
+
+
+def test_guidance_is_not_shared_between_include_graphs(tmp_path):
+    x = _write_alh(tmp_path / "x.alhConfig", "X", "P:X", "same text")
+    y = _write_alh(tmp_path / "y.alhConfig", "Y", "P:Y", "same text")
+
+    graph_x = load_include_graph(x)
+    graph_y = load_include_graph(y)
+    _write_alh(tmp_path / "x.alhConfig", "X", "P:X", "changed text")
+
+    # y's guidance still reads from y after x changes
+    (guidance,) = graph_y[y].items["Y/P:Y"].guidance
+    assert guidance.filename == y
+    assert guidance.read().strip() == "same text"
+    assert graph_x[x].items["X/P:X"].guidance[0] is not guidance
+
+
+def test_guidance_is_streamed_into_output(tmp_path):
+    source = _write_alh(tmp_path / "a.alhConfig", "A", "P:A", "check <limits> & reset")
+    output = str(tmp_path / "a.xml")
+
+    convert_alh_to_phoebus(source, output, warnings=[])
+
+    assert _guidance(output) == ["check <limits> & reset"]
+
+
+def test_directives_are_dispatched_through_the_table(tmp_path):
+    @register_directive("$TESTNOTE")
+    def _handle_test_note(alh_file, split):
+        _target(alh_file).test_note = " ".join(split[1:])
+
+    try:
+        source = tmp_path / "a.alhConfig"
+        source.write_text("GROUP NULL A\nCHANNEL A P:A\n$TESTNOTE check the supply\n$NOTADIRECTIVE 1\n")
+        alh_file = parse_alh_file(str(source))
+
+    finally:
+        del DIRECTIVE_HANDLERS["$TESTNOTE"]
+
+    assert alh_file.items["A/P:A"].test_note == "check the supply"
+    assert alh_file.warnings == [f"{source}:4: unknown directive $NOTADIRECTIVE"]
+
+
+def test_unconverted_directives_are_reported(tmp_path):
+    source = tmp_path / "a.alhConfig"
+    source.write_text("GROUP NULL A\n$SEVRCOMMAND UP_MAJOR beep.sh\n$BEEPSEVERITY MAJOR\n"
+                      "CHANNEL A P:A\n$ACKPV P:A:ACK 1\n$HEARTBEATPV P:HB 1 5\n$STATCOMMAND HIHI page.sh\n"
+                      "CHANNEL A P:B\n$STATCOMMAND LOLO page.sh\n")
+    warnings = []
+
+    convert_alh_to_phoebus(str(source), str(tmp_path / "a.xml"), warnings=warnings)
+
+    assert warnings == [f"{source}: {directive} has no Phoebus equivalent, not converted on {count} nodes"
+                        for directive, count in (("$ACKPV", 1), ("$BEEPSEVERITY", 1), ("$HEARTBEATPV", 1),
+                                                 ("$SEVRCOMMAND", 1), ("$STATCOMMAND", 2))]
+
+
+def test_duplicate_children_are_reported(tmp_path):
+    include = tmp_path / "b.alhConfig"
+    include.write_text("GROUP NULL B\nCHANNEL B P:B\n")
+    source = tmp_path / "a.alhConfig"
+    source.write_text("GROUP NULL A\nCHANNEL A P:A\nCHANNEL A P:A\nINCLUDE A b.alhConfig\nINCLUDE A b.alhConfig\n")
+    warnings = []
+
+    convert_alh_to_phoebus(str(source), str(tmp_path / "a.xml"), warnings=warnings)
+
+    assert warnings == [f"{source}: duplicate child A/P:A of group A", f"{include}: duplicate child A/B"]
+    assert [pv.attrib["name"] for pv in ET.parse(str(tmp_path / "a.xml")).iter("pv")] == ["P:A", "P:B"]
+
+
+def _write_includes(tmp_path, includes):
+    # filename -> names of the files it includes, each file holding one group
+    for filename, included in includes.items():
+        group = filename.split(".")[0].upper()
+        lines = [f"GROUP NULL {group}", f"CHANNEL {group} P:{group}"]
+        lines += [f"INCLUDE {group} {name}" for name in included]
+        (tmp_path / filename).write_text("\n".join(lines) + "\n")
+
+    return str(tmp_path / next(iter(includes)))
+
+
+def test_include_cycles_are_detected(tmp_path):
+    top = _write_includes(tmp_path, {"a.alhConfig": ["b.alhConfig"], "b.alhConfig": ["c.alhConfig"],
+                                     "c.alhConfig": ["b.alhConfig"]})
+
+    with pytest.raises(IncludeCycleError) as error:
+        load_include_graph(top)
+
+    b, c = str(tmp_path / "b.alhConfig"), str(tmp_path / "c.alhConfig")
+    assert str(error.value) == f"Include cycle: {b} -> {c} -> {b}"
+
+
+def test_shared_includes_are_parsed_once(tmp_path, monkeypatch):
+    top = _write_includes(tmp_path, {"a.alhConfig": ["b.alhConfig", "c.alhConfig", "d.alhConfig"],
+                                     "b.alhConfig": ["d.alhConfig"], "c.alhConfig": ["d.alhConfig", "d.alhConfig"],
+                                     "d.alhConfig": []})
+    parsed_files = []
+
+    def parse(filename, **kwargs):
+        parsed_files.append(os.path.basename(filename))
+        return parse_alh_file(filename, **kwargs)
+
+    monkeypatch.setattr(alh_conversion, "parse_alh_file", parse)
+    output = str(tmp_path / "a.xml")
+    convert_alh_to_phoebus(top, output, warnings=[])
+
+    assert sorted(parsed_files) == ["a.alhConfig", "b.alhConfig", "c.alhConfig", "d.alhConfig"]
+    assert [pv.attrib["name"] for pv in ET.parse(output).iter("pv")] == ["P:A", "P:B", "P:D", "P:C"]
+
+
+def test_include_paths_are_resolved_once_per_load(tmp_path, monkeypatch):
+    top = _write_includes(tmp_path, {"a.alhConfig": ["c.alhConfig", "b.alhConfig"], "b.alhConfig": ["c.alhConfig"],
+                                     "c.alhConfig": []})
+    resolved = []
+
+    def resolve(including_file, include_filename):
+        resolved.append(include_filename)
+        return resolve_include(including_file, include_filename)
+
+    monkeypatch.setattr(alh_conversion, "resolve_include", resolve)
+
+    load_include_graph(top)
+    assert sorted(resolved) == ["b.alhConfig", "c.alhConfig"]
+
+    # nothing is kept between loads
+    load_include_graph(top)
+    assert len(resolved) == 4
+
+
+def test_cli_reports_include_cycles(tmp_path, capsys):
+    top = _write_includes(tmp_path, {"a.alhConfig": ["a.alhConfig"]})
+
+    with pytest.raises(SystemExit) as error:
+        cli.main(["convert", top, str(tmp_path / "a.xml")])
+
+    assert error.value.code == 2
+    assert capsys.readouterr().err.startswith("Include cycle: ")
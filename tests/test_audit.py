@@ -0,0 +1,40 @@
+import asyncio
+
+from nalms_alarm_tree_editor.audit import AuditCache, audit_pvs, start_stand_in_server
+
+
+async def _audit_twice(pvnames, served, cache):
+    transport, address = await start_stand_in_server(served)
+
+    try:
+        report = await audit_pvs(pvnames, addresses=[address], timeout=0.5, cache=cache)
+
+    finally:
+        transport.close()
+
+    # nothing answers now, results must come from the cache
+    cached = await audit_pvs(pvnames, addresses=[address], timeout=0.5, cache=cache)
+
+    return report, cached
+
+
+def test_audit_against_stand_in_server():
+    cache = AuditCache(ttl=60)
+    report, cached = asyncio.run(_audit_twice(["P:1", "P:2", "MISSING", "P:1"], ["P:1", "P:2", "OTHER"], cache))
+
+    assert sorted(report.connected) == ["P:1", "P:2"]
+    assert report.disconnected == ["MISSING"]
+    assert report.cached == 0
+    assert report.errors == []
+
+    assert sorted(cached.connected) == ["P:1", "P:2"]
+    assert cached.disconnected == ["MISSING"]
+    assert cached.cached == 3
+
+
+def test_expired_results_are_searched_again():
+    cache = AuditCache(ttl=0)
+    _, cached = asyncio.run(_audit_twice(["P:1"], ["P:1"], cache))
+
+    assert cached.cached == 0
+    assert cached.disconnected == ["P:1"]
@@ -0,0 +1,34 @@
+import xml.etree.ElementTree as ET
+
+from nalms_alarm_tree_editor.db_generation import generate_config
+from nalms_alarm_tree_editor.sharding import read_manifest
+
+
+def _iocs(tmp_path):
+    (tmp_path / "iocA").mkdir(parents=True)
+    (tmp_path / "iocA" / "a.db").write_text('record(ai, "P:1") { field(HHSV, "MAJOR") field(DESC, "one") }\n'
+                                            'record(ai, "P:2") { field(HSV, "MINOR") }\n')
+    (tmp_path / "iocB").mkdir()
+    # P:1 is also defined by the other IOC
+    (tmp_path / "iocB" / "b.db").write_text('record(ai, "P:1") { field(HHSV, "MAJOR") }\n'
+                                            'record(ai, "P:3") { field(LSV, "MINOR") }\n'
+                                            'record(ai, "$(P):4") { field(LSV, "MINOR") }\n')
+    return str(tmp_path)
+
+
+def test_generate_counts_the_pvs_written(tmp_path):
+    output = str(tmp_path / "out.xml")
+    pv_count, skipped = generate_config([_iocs(tmp_path / "iocs")], output, workers=1)
+    config = ET.parse(output).getroot()
+
+    assert (pv_count, skipped) == (3, 1)
+    assert [pv.attrib["name"] for pv in config.iter("pv")] == ["P:1", "P:2", "P:3"]
+    assert [component.attrib["name"] for component in config] == ["iocA", "iocB"]
+
+
+def test_sharded_generate_counts_the_pvs_written(tmp_path):
+    output = str(tmp_path / "shards")
+    pv_count, _ = generate_config([_iocs(tmp_path / "iocs")], output, workers=1, sharded=True)
+
+    assert pv_count == 3
+    assert [shard["name"] for shard in read_manifest(output)["shards"]] == [None, "iocA", "iocB"]
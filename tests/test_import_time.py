@@ -0,0 +1,42 @@
+import json
+import os
+import subprocess
+import sys
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the headless modules import in about 20 ms, leave room for slow machines
+IMPORT_BUDGET = 0.5
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import nalms_alarm_tree_editor.cli
+import nalms_alarm_tree_editor.phoebus_config
+import nalms_alarm_tree_editor.alh_conversion
+elapsed = time.perf_counter() - start
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+def _import_headless():
+    env = dict(os.environ, PYTHONPATH=REPO)
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], env=env, cwd=REPO,
+                            check=True, stdout=subprocess.PIPE).stdout
+
+    return json.loads(output)
+
+
+def test_headless_import_budget():
+    result = _import_headless()
+
+    assert result["elapsed"] < IMPORT_BUDGET
+
+
+def test_headless_import_has_no_gui():
+    modules = set(_import_headless()["modules"])
+
+    for gui_module in ("qtpy", "pydm"):
+        assert gui_module not in modules
+        assert not any(name.startswith(gui_module + ".") for name in modules)
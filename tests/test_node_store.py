@@ -0,0 +1,81 @@
+from nalms_alarm_tree_editor.node_store import NodeStore
+from nalms_alarm_tree_editor.phoebus_config import PhoebusConfigTool, parse_store
+from nalms_alarm_tree_editor.query import parse_query, select_rows
+
+
+CONFIG = """<config name="T"><component name="AREA"><pv name="A:1"><enabled>true</enabled></pv></component></config>"""
+
+
+def test_add_pvs_appends_groups_and_skips_existing(tmp_path):
+    source = tmp_path / "T.xml"
+    source.write_text(CONFIG)
+    store = NodeStore.from_file(str(source))
+
+    added = store.add_pvs({"AREA": ["A:1", "A:2", "A:3"], "NEW/SUB": ["N:1", "A:2"]})
+
+    assert added == 3
+    assert [store.node(child).label for child in store.children(store.find("/AREA"))] == ["A:1", "A:2", "A:3"]
+    assert [store.node(child).label for child in store.children(store.find("/NEW/SUB"))] == ["N:1"]
+    assert store.totals(store.root)["pvs"] == 4
+    assert store.totals(store.find("/NEW"))["enabled"] == 1
+
+
+QUERIES = [
+    "select",
+    "select where enabled=true",
+    "select where enabled!=true and latching=true",
+    "select where annunciating=false",
+    'select where path ~ "/G1/**"',
+    'select where path ~ "/*/*/PV?"',
+    'select where path = "/G0/S1/PV2" and enabled=false',
+    'select where label ~ "PV1*" and filter != "MODE"',
+    'select where delay = "5"',
+    'select where path ~ "/MISSING/**"',
+]
+
+
+def _synthetic_config():
+    pvs = []
+    for group in range(3):
+        pvs.append(f'<component name="G{group}">')
+
+        for sub in range(3):
+            pvs.append(f'<component name="S{sub}">')
+
+            for pv in range(12):
+                flags = "".join(f"<{flag}>{'true' if (pv >> bit) & 1 else 'false'}</{flag}>"
+                                for bit, flag in enumerate(("enabled", "latching", "annunciating")) if (pv + bit) % 3)
+                extra = "<delay>5</delay>" if pv % 4 == 0 else "<filter>MODE</filter>" if pv % 4 == 1 else ""
+                pvs.append(f'<pv name="PV{pv}">{flags}{extra}</pv>')
+
+            pvs.append("</component>")
+
+        pvs.append("</component>")
+
+    return f'<config name="T">{"".join(pvs)}</config>'
+
+
+def test_select_matches_the_property_store(tmp_path):
+    source = tmp_path / "T.xml"
+    source.write_text(_synthetic_config())
+    store = NodeStore.from_file(str(source))
+    property_store = parse_store(str(source))
+
+    for query in QUERIES:
+        expected = [property_store.path(row) for row in select_rows(property_store, parse_query(query))]
+        assert [store.path(node_id) for node_id in store.select(parse_query(query))] == expected, query
+
+
+def test_set_many_updates_totals(tmp_path):
+    source = tmp_path / "T.xml"
+    source.write_text(_synthetic_config())
+    store = NodeStore.from_file(str(source))
+
+    store.set_many(store.select(parse_query('select where path ~ "/G1/**"')), enabled=False, annunciating=True)
+    PhoebusConfigTool().save_node_store(store, str(tmp_path / "saved.xml"))
+    reloaded = NodeStore.from_file(str(tmp_path / "saved.xml"))
+
+    for path in ("/", "/G0", "/G1", "/G1/S2"):
+        assert store.totals(store.find(path)) == reloaded.totals(reloaded.find(path))
+
+    assert store.totals(store.find("/G1"))["enabled"] == 0
@@ -0,0 +1,42 @@
+import os
+import stat
+import xml.etree.ElementTree as ET
+
+from nalms_alarm_tree_editor.phoebus_config import PhoebusConfigTool
+
+
+CONFIG = """<?xml version='1.0' encoding='utf8'?>
+<config name="T"><display><title>Top</title><details>top.bob</details></display><component name="G"><display><title>Panel</title><details>g.bob</details></display><custom a="1">text<inner>x</inner></custom><pv name="P1"><enabled>true</enabled><description>d</description><display><title>P</title><details>p.bob</details></display><vendor_extension key="v" /></pv></component></config>"""
+
+
+def _canonical(filename):
+    return ET.tostring(ET.parse(filename).getroot(), encoding="unicode")
+
+
+def test_save_store_keeps_display_and_unknown_elements(tmp_path):
+    source = tmp_path / "config.xml"
+    source.write_text(CONFIG)
+
+    config_tool = PhoebusConfigTool()
+    config_tool.parse_config(str(source))
+    config_tool.save_store(str(source))
+
+    assert _canonical(str(source)) == ET.tostring(ET.fromstring(CONFIG.split("\n", 1)[1]), encoding="unicode")
+
+
+def test_save_keeps_the_file_mode(tmp_path):
+    source = tmp_path / "config.xml"
+    source.write_text(CONFIG)
+    os.chmod(str(source), 0o644)
+
+    config_tool = PhoebusConfigTool()
+    config_tool.parse_config(str(source))
+    config_tool.save_store(str(source))
+
+    assert stat.S_IMODE(os.stat(str(source)).st_mode) == 0o644
+
+    umask = os.umask(0o022)
+    os.umask(umask)
+    config_tool.save_store(str(tmp_path / "new.xml"))
+
+    assert stat.S_IMODE(os.stat(str(tmp_path / "new.xml")).st_mode) == 0o666 & ~umask
@@ -0,0 +1,27 @@
+from nalms_alarm_tree_editor.property_store import PropertyStore
+from nalms_alarm_tree_editor.query import run_query
+
+
+NODES = [
+    [{"label": "config"}, None],
+    [{"label": "GROUP"}, 0],
+    [{"label": "DEFAULT"}, 1],
+    [{"label": "ENABLED", "enabled": "true"}, 1],
+    [{"label": "DISABLED", "enabled": "false", "latching": "false"}, 1],
+]
+
+
+def _labels(query):
+    store = PropertyStore.from_nodes(NODES)
+    return [store.label[row] for row in run_query(store, query)]
+
+
+def test_unset_flags_match_their_defaults():
+    assert _labels("select where enabled=true") == ["DEFAULT", "ENABLED"]
+    assert _labels("select where latching=true") == ["DEFAULT", "ENABLED"]
+    assert _labels("select where annunciating=false") == ["DEFAULT", "ENABLED", "DISABLED"]
+
+
+def test_unset_flags_compare_as_defaults_for_not_equal():
+    assert _labels("select where enabled!=true") == ["DISABLED"]
+    assert _labels("select where enabled!=false") == ["DEFAULT", "ENABLED"]
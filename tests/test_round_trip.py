@@ -0,0 +1,181 @@
+import xml.etree.ElementTree as ET
+
+from nalms_alarm_tree_editor.alh_conversion import convert_alh_to_phoebus
+from nalms_alarm_tree_editor.phoebus_conversion import convert_phoebus_to_alh, filter_to_forcepv
+
+
+CONFIG = """<config name="ROUND_TRIP">
+  <component name="AREA">
+    <guidance><title>Guidance</title><details>Call the area expert</details></guidance>
+    <command><title>Command</title><details>area_panel.sh</details></command>
+    <pv name="AREA:PV1">
+      <description>First pv</description>
+      <enabled>true</enabled>
+      <guidance><title>Guidance</title><details>Check the supply</details></guidance>
+      <command><title>Command</title><details>probe AREA:PV1</details></command>
+      <command><title>Command</title><details>strip_chart AREA:PV1</details></command>
+    </pv>
+    <pv name="AREA:PV2">
+      <enabled>false</enabled>
+      <latching>false</latching>
+      <delay>5</delay>
+      <count>3</count>
+      <filter>AREA:MODE != 1</filter>
+    </pv>
+    <component name="SUB">
+      <pv name="AREA:PV3">
+        <enabled>true</enabled>
+        <filter>AREA:MODE</filter>
+      </pv>
+    </component>
+  </component>
+</config>
+"""
+
+
+def _pvs(filename):
+    pvs = {}
+
+    for pv in ET.parse(filename).iter("pv"):
+        pvs[pv.attrib["name"]] = {
+            "description": pv.findtext("description"),
+            "enabled": pv.findtext("enabled"),
+            "latching": pv.findtext("latching"),
+            "delay": pv.findtext("delay"),
+            "count": pv.findtext("count"),
+            "filter": pv.findtext("filter"),
+            "guidance": [record.findtext("details") for record in pv.iter("guidance")],
+            "commands": [record.findtext("details") for record in pv.iter("command")],
+        }
+
+    return pvs
+
+
+def _round_trip(tmp_path):
+    source = tmp_path / "ROUND_TRIP.xml"
+    source.write_text(CONFIG)
+
+    alh = str(tmp_path / "round_trip.alhConfig")
+    convert_phoebus_to_alh(str(source), alh, warnings=[])
+
+    output = str(tmp_path / "output" / "ROUND_TRIP.xml")
+    (tmp_path / "output").mkdir()
+    convert_alh_to_phoebus(alh, output, warnings=[])
+
+    return str(source), output
+
+
+def test_pvs_survive_round_trip(tmp_path):
+    source, output = _round_trip(tmp_path)
+    expected = _pvs(source)
+
+    # a bare filter comes back as the equivalent comparison with zero
+    expected["AREA:PV3"]["filter"] = "AREA:MODE != 0"
+
+    assert _pvs(output) == expected
+
+
+def test_group_records_survive_round_trip(tmp_path):
+    source, output = _round_trip(tmp_path)
+    area = ET.parse(output).getroot().find("component")
+
+    assert area.attrib["name"] == "AREA"
+    assert [record.findtext("details") for record in area.findall("guidance")] == ["Call the area expert"]
+    assert [record.findtext("details") for record in area.findall("command")] == ["area_panel.sh"]
+
+
+def test_bare_filter_has_force_and_reset_values():
+    assert filter_to_forcepv("AREA:MODE") == ["$FORCEPV AREA:MODE -D--- 0 NE"]
+    assert filter_to_forcepv("A:1 && B:2")[0] == "$FORCEPV CALC -D--- 0 NE"
+
+
+def _synthetic_config(groups, subgroups, pvs):
+    lines = ['<config name="ROUND_TRIP">']
+
+    for group in range(groups):
+        lines.append(f'<component name="G{group}">')
+
+        for subgroup in range(subgroups):
+            lines.append(f'<component name="G{group}_S{subgroup}">')
+
+            for pv in range(pvs):
+                name = f"G{group}:S{subgroup}:PV{pv}"
+                lines.append(f'<pv name="{name}"><description>{name} desc</description>'
+                             f'<enabled>{"true" if pv % 3 else "false"}</enabled>')
+
+                # latching is the default and only written when disabled
+                if pv % 2:
+                    lines.append("<latching>false</latching>")
+
+                if pv % 5 == 0:
+                    lines.append(f"<delay>{pv % 7 + 1}</delay><count>{pv % 4 + 1}</count>")
+
+                if pv % 4 == 0:
+                    lines.append(f"<filter>G{group}:MODE &amp;&amp; G{group}:S{subgroup}:READY</filter>")
+
+                elif pv % 4 == 1:
+                    lines.append(f"<filter>G{group}:MODE != {pv % 3}</filter>")
+
+                lines.append("</pv>")
+
+            lines.append("</component>")
+
+        lines.append("</component>")
+
+    lines.append("</config>")
+    return "\n".join(lines)
+
+
+def _convert_both_ways(tmp_path, config, split_includes=False):
+    source = tmp_path / "ROUND_TRIP.xml"
+    source.write_text(config)
+
+    alh = str(tmp_path / "round_trip.alhConfig")
+    warnings = []
+    convert_phoebus_to_alh(str(source), alh, split_includes=split_includes, warnings=warnings)
+
+    (tmp_path / "output").mkdir()
+    output = str(tmp_path / "output" / "ROUND_TRIP.xml")
+    convert_alh_to_phoebus(alh, output, warnings=[])
+
+    return str(source), output, warnings
+
+
+def _filters_as_comparisons(pvs):
+    # bare filters come back compared with zero
+    for pv in pvs.values():
+        if pv["filter"] is not None and "!=" not in pv["filter"]:
+            pv["filter"] = f"({pv['filter'].replace(' ', '')}) != 0"
+
+    return pvs
+
+
+def test_large_tree_survives_round_trip(tmp_path):
+    source, output, warnings = _convert_both_ways(tmp_path, _synthetic_config(20, 10, 50))
+
+    assert len(_pvs(output)) == 10000
+    assert _pvs(output) == _filters_as_comparisons(_pvs(source))
+    assert warnings == []
+
+
+def test_large_split_tree_survives_round_trip(tmp_path):
+    source, output, warnings = _convert_both_ways(tmp_path, _synthetic_config(8, 5, 40), split_includes=True)
+
+    assert _pvs(output) == _filters_as_comparisons(_pvs(source))
+    assert warnings == []
+
+
+def test_adjacent_operands_are_not_converted(tmp_path):
+    config = CONFIG.replace("<filter>AREA:MODE</filter>", "<filter>AREA:MODE filter</filter>")
+    config = config.replace("<filter>AREA:MODE != 1</filter>", "<filter>check(AREA:MODE)</filter>")
+    source, output, warnings = _convert_both_ways(tmp_path, config)
+    pvs = _pvs(output)
+
+    assert pvs["AREA:PV2"]["filter"] is None
+    assert pvs["AREA:PV3"]["filter"] is None
+    assert any("filter not converted on 2 nodes" in warning for warning in warnings)
+
+
+def test_invalid_calc_expressions_are_rejected():
+    for alarm_filter in ("a1pv1 filter", "foo(bar)", "(A:1)(B:2)", "A:1 &&", "()", "A:1 != "):
+        assert filter_to_forcepv(alarm_filter) is None
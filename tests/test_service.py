@@ -0,0 +1,91 @@
+import asyncio
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+from nalms_alarm_tree_editor.service import ConversionService, ServiceClient, serve
+
+
+ALH = "GROUP NULL AREA\nCHANNEL AREA AREA:PV1\nCHANNEL AREA AREA:PV2\n"
+
+
+def _run(loop, task):
+    try:
+        loop.run_until_complete(task)
+
+    except asyncio.CancelledError:
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    socket_path = tmp_path / "service.sock"
+    (tmp_path / "out").mkdir()
+
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(serve(f"unix:{socket_path}", ConversionService(output_dir=str(tmp_path / "out"))))
+    thread = threading.Thread(target=_run, args=(loop, task))
+    thread.start()
+
+    deadline = time.monotonic() + 5
+    while not socket_path.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    client = ServiceClient(f"unix:{socket_path}")
+    yield client, tmp_path
+
+    client.close()
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join()
+    loop.close()
+
+
+def test_socket_is_private(server):
+    _, tmp_path = server
+
+    assert stat.S_IMODE(os.stat(str(tmp_path / "service.sock")).st_mode) == 0o600
+
+
+def test_convert_validate_and_stats(server):
+    client, tmp_path = server
+    (tmp_path / "top.alhConfig").write_text(ALH)
+
+    response = client.request("convert", input=str(tmp_path / "top.alhConfig"), output="top.xml")
+    assert response == {"ok": True, "output": str(tmp_path / "out" / "top.xml")}
+
+    response = client.request("validate", filename=response["output"])
+    assert response == {"ok": True, "problems": [], "pv_count": 2}
+
+    client.request("convert", input=str(tmp_path / "top.alhConfig"), output="again.xml")
+    assert client.request("stats") == {"ok": True, "cached": 2, "hits": 1, "misses": 2}
+
+
+def test_outputs_outside_the_directory_are_rejected(server):
+    client, tmp_path = server
+    (tmp_path / "top.alhConfig").write_text(ALH)
+
+    for output in (str(tmp_path / "top.xml"), "../top.xml"):
+        response = client.request("convert", input=str(tmp_path / "top.alhConfig"), output=output)
+
+        assert not response["ok"]
+        assert response["error"].startswith("PermissionError")
+
+    assert not (tmp_path / "top.xml").exists()
+
+
+def test_bad_requests_get_errors(server):
+    client, _ = server
+
+    assert client.request("rename") == {"ok": False, "error": "Unknown operation: rename"}
+
+    client._file.write(b"not json\n")
+    client._file.flush()
+    assert client._file.readline().startswith(b'{"ok": false, "error": "Invalid request')
+
+
+def test_tcp_requires_an_output_directory():
+    with pytest.raises(ValueError):
+        asyncio.run(serve("127.0.0.1:0", ConversionService()))
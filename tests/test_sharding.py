@@ -0,0 +1,83 @@
+import os
+import stat
+import xml.etree.ElementTree as ET
+
+from nalms_alarm_tree_editor.sharding import MANIFEST, ROOT_SHARD, assemble, load_shards, read_manifest, \
+    write_config_shards
+
+
+CONFIG = """<config name="SHARDED">
+  <guidance><title>Guidance</title><details>Top level</details></guidance>
+  <pv name="ROOT:PV"><enabled>true</enabled></pv>
+  <component name="LINAC"><pv name="LINAC:PV1"><enabled>true</enabled></pv><pv name="LINAC:PV2"><enabled>false</enabled></pv></component>
+  <component name="GUN"><component name="SUB"><pv name="GUN:PV1"><enabled>true</enabled></pv></component></component>
+</config>"""
+
+
+def _canonical(elem):
+    for node in elem.iter():
+        node.text = (node.text or "").strip() or None
+        node.tail = None
+
+    return ET.tostring(elem, encoding="unicode")
+
+
+def _labels(store):
+    return [store.label[row] for row in range(len(store))]
+
+
+def _write(directory, config=CONFIG):
+    return write_config_shards(ET.fromstring(config), str(directory))
+
+
+def test_shards_assemble_to_the_configuration(tmp_path):
+    assert _write(tmp_path / "shards") == 3
+    assert [shard["file"] for shard in read_manifest(str(tmp_path / "shards"))["shards"]] == \
+        [ROOT_SHARD, "000_LINAC.xml", "001_GUN.xml"]
+
+    output = str(tmp_path / "assembled.xml")
+    assemble(str(tmp_path / "shards"), output)
+
+    assert _canonical(ET.parse(output).getroot()) == _canonical(ET.fromstring(CONFIG))
+
+
+def test_unchanged_shards_are_not_rewritten(tmp_path):
+    _write(tmp_path)
+
+    assert _write(tmp_path) == 0
+    assert _write(tmp_path, CONFIG.replace("LINAC:PV2", "LINAC:PV3")) == 1
+
+
+def test_load_reuses_unchanged_shards(tmp_path):
+    _write(tmp_path)
+    store, shards = load_shards(str(tmp_path), workers=1)
+
+    assert _labels(store) == ["SHARDED", "ROOT:PV", "LINAC", "LINAC:PV1", "LINAC:PV2", "GUN", "SUB", "GUN:PV1"]
+
+    _write(tmp_path, CONFIG.replace("LINAC:PV2", "LINAC:PV3"))
+    store, reloaded = load_shards(str(tmp_path), previous=shards, workers=1)
+
+    linac = os.path.abspath(str(tmp_path / "000_LINAC.xml"))
+    gun = os.path.abspath(str(tmp_path / "001_GUN.xml"))
+
+    # only the changed shard is parsed again
+    assert reloaded[gun][1] is shards[gun][1]
+    assert reloaded[linac][1] is not shards[linac][1]
+    assert "LINAC:PV3" in _labels(store)
+
+
+def test_shards_get_the_default_file_mode(tmp_path):
+    umask = os.umask(0o022)
+    os.umask(umask)
+    _write(tmp_path)
+
+    for filename in (MANIFEST, ROOT_SHARD, "000_LINAC.xml"):
+        assert stat.S_IMODE(os.stat(str(tmp_path / filename)).st_mode) == 0o666 & ~umask
+
+
+def test_rewritten_shards_keep_their_mode(tmp_path):
+    _write(tmp_path)
+    os.chmod(str(tmp_path / "000_LINAC.xml"), 0o640)
+    _write(tmp_path, CONFIG.replace("LINAC:PV2", "LINAC:PV3"))
+
+    assert stat.S_IMODE(os.stat(str(tmp_path / "000_LINAC.xml")).st_mode) == 0o640